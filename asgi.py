@@ -0,0 +1,641 @@
+"""
+ASGI entry point. /api/start, /api/ask_question, /api/ask_question_premium and
+/api/related_question_premium run on asyncio with AsyncOpenAI, so a user waiting on a run
+costs a coroutine instead of a thread. Every other route is served by the Flask app.
+
+Like the Flask routes, every request has a deadline (REQUEST_DEADLINE, or a shorter
+X-Request-Timeout), each API key's calls go through its circuit breaker with the same retries,
+and a run is cancelled when its client disconnects. Runs take the same per-thread locks and
+scheduler slots as the Flask routes in this process, identical free questions share one run
+through the same answer_flights, and stage timings go to the same /metrics histograms.
+
+Run with: uvicorn asgi:app --workers N
+"""
+import asyncio
+import contextvars
+import json
+import math
+import random
+from contextlib import asynccontextmanager, contextmanager
+from threading import Lock
+from time import monotonic
+
+import httpx
+from asgiref.wsgi import WsgiToAsgi
+from openai import AsyncOpenAI, OpenAIError
+from ratelimit import RateLimitException
+
+import webserver
+from webserver import (
+    LLM_BACKEND, OPENAI_BASE_URL, RATE_LIMIT_MAX_WAIT, REQUEST_DEADLINE, RETRY_ATTEMPTS, RETRY_BASE_DELAY,
+    RETRY_MAX_DELAY, RUN_CANCEL_STATES, RUN_DEADLINE, RUN_POLL_BACKOFF, RUN_POLL_INITIAL_DELAY, RUN_POLL_MAX_DELAY,
+    RUN_TERMINAL_STATES, SCHEDULER_WEIGHTS, CircuitOpenError, DeadlineExceededError, QueueFullError, answer_cache,
+    answer_flights, assistant_registry, bearer_token, create_app, credential_pool, faq_index, feedback_writer,
+    http_client_options, is_transient_error, latency_histograms, latest_assistant_message, log, normalize_question,
+    record_run_wait, related_cache, request_metrics, request_state, run_assistant, scheduler,
+    schedule_related_questions, shared_answer, thread_locks, thread_locks_guard, thread_pool, verify_session_token,
+)
+
+# Longest sleep between checks while a coroutine waits on a thread lock or an identical
+# question, which are shared with the Flask routes' threads and so cannot wake it directly
+SHARED_WAIT_POLL_MAX = 0.05  # In seconds
+
+flask_app = create_app()
+wsgi_app = WsgiToAsgi(flask_app)
+
+async_clients = {}  # API key name -> AsyncOpenAI client
+# Monotonic time by which the current request must finish; set per request in app()
+request_deadline = contextvars.ContextVar("request_deadline", default=math.inf)
+# (endpoint, user_type) labels of the current request's stage timings, and the timings for its
+# Server-Timing header. Coroutines share the event loop thread, so request_metrics cannot hold them.
+request_labels = contextvars.ContextVar("request_labels", default=("background", "none"))
+request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+def async_remaining():
+    return request_deadline.get() - monotonic()
+
+
+async def within_deadline(coro, what):
+    """
+    Await coro, raising DeadlineExceededError if the request deadline passes first.
+    """
+    remaining = async_remaining()
+    if remaining <= 0:
+        if asyncio.iscoroutine(coro):
+            coro.close()
+        raise DeadlineExceededError(f"Request deadline passed before {what}")
+    try:
+        return await asyncio.wait_for(coro, None if remaining == math.inf else remaining)
+    except asyncio.TimeoutError:
+        raise DeadlineExceededError(f"Request deadline passed waiting for {what}") from None
+
+
+@contextmanager
+def async_timed_stage(stage):
+    """
+    Counterpart of webserver.timed_stage for coroutines, labelled through request_labels.
+    """
+    started = monotonic()
+    try:
+        yield
+    finally:
+        seconds = monotonic() - started
+        latency_histograms.observe(stage, *request_labels.get(), seconds)
+        timings = request_timings.get()
+        if timings is not None:
+            timings.append((stage, seconds))
+
+
+async def wait_until(ready, what):
+    """
+    Check ready() with a backoff capped at SHARED_WAIT_POLL_MAX until it returns True, without
+    blocking the event loop. Raises DeadlineExceededError if the request deadline passes first.
+    """
+    delay = 0.001
+    while not ready():
+        remaining = async_remaining()
+        if remaining <= 0:
+            raise DeadlineExceededError(f"Request deadline passed waiting for {what}")
+        await asyncio.sleep(min(delay, remaining))
+        delay = min(delay * 2, SHARED_WAIT_POLL_MAX)
+
+
+class AsyncGrant:
+    """
+    Entry in a webserver.scheduler queue for a coroutine. release() hands it a slot from
+    whichever thread frees one, so the coroutine is woken through its event loop.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+        self.granted = False
+
+    def set(self):
+        self.granted = True
+        self.loop.call_soon_threadsafe(self._wake)
+
+    def is_set(self):
+        return self.granted
+
+    def _wake(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+async def async_acquire(cls):
+    """
+    Async counterpart of scheduler.acquire, with the request deadline as the timeout.
+    """
+    started = monotonic()
+    granted = AsyncGrant()
+    if scheduler.join(cls, granted):
+        return
+    try:
+        await within_deadline(granted.future, f"a slot in the {cls} queue")
+    except DeadlineExceededError:
+        if scheduler.leave(cls, granted):
+            raise
+    except BaseException:
+        # Cancelled because the client left; a slot handed over in the meantime is given back
+        if not scheduler.leave(cls, granted):
+            scheduler.release(scheduler.avg_hold)
+        raise
+    scheduler.admit(cls, monotonic() - started)
+
+
+class async_openai_slot:
+    """
+    Async counterpart of webserver.openai_slot, on the same per-thread locks and scheduler:
+    a run started here and one started by a Flask route on the same thread never overlap,
+    and both paths share the slots, priorities and queue caps.
+    """
+
+    def __init__(self, thread_id=None, user_type="free"):
+        self.thread_id = thread_id
+        self.cls = user_type if user_type in SCHEDULER_WEIGHTS else "free"
+        self.entry = None
+        self.locked = False
+        self.started = None
+
+    async def __aenter__(self):
+        credential_pool.check(self.thread_id)
+        try:
+            if self.thread_id:
+                with thread_locks_guard:
+                    self.entry = thread_locks.setdefault(self.thread_id, [Lock(), 0])
+                    self.entry[1] += 1
+                with async_timed_stage("thread_lock_wait"):
+                    await wait_until(lambda: self.entry[0].acquire(blocking=False), "the thread")
+                self.locked = True
+            with async_timed_stage("scheduler_wait"):
+                await async_acquire(self.cls)
+        except BaseException:
+            self._leave()
+            raise
+        self.started = monotonic()
+
+    async def __aexit__(self, *exc_info):
+        scheduler.release(monotonic() - self.started)
+        self._leave()
+
+    def _leave(self):
+        if self.entry is None:
+            return
+        if self.locked:
+            self.entry[0].release()
+        with thread_locks_guard:
+            self.entry[1] -= 1
+            if self.entry[1] == 0:
+                thread_locks.pop(self.thread_id, None)
+
+
+async def async_flight(key, fn):
+    """
+    Async counterpart of answer_flights.do(key, fn, shared_answer), on the same flights as the
+    Flask routes. A leader cancelled with its client hands the question to a waiting caller.
+    """
+    while True:
+        call, leader = answer_flights.join(key)
+        if leader:
+            break
+        try:
+            await wait_until(call[0].is_set, "an identical question")
+        except BaseException:
+            answer_flights.leave(call)
+            raise
+        if call[4]:
+            return answer_flights.outcome(call)
+
+    try:
+        try:
+            call[1] = await fn()
+        except Exception as e:
+            call[2] = e
+        call[4] = shared_answer(call[1], call[2])
+    finally:
+        answer_flights.land(key, call)
+    return answer_flights.outcome(call)
+
+
+async def async_wait_for_token(bucket, max_wait=RATE_LIMIT_MAX_WAIT):
+    waited = 0
+    while True:
+        # try_acquire is a blocking SQLite transaction, kept off the event loop
+        wait = await asyncio.to_thread(bucket.try_acquire)
+        if wait == 0:
+            return
+        if waited + wait > max_wait:
+            raise RateLimitException(f"{bucket.name} rate limit exceeded", wait)
+        await asyncio.sleep(wait)
+        waited += wait
+
+
+async def async_call(breaker, name, fn, *args, bounded=True, hold=False, **kwargs):
+    """
+    Async counterpart of webserver.ResilientBackend._call: every attempt is admitted by the
+    API key's circuit breaker and must start before the request deadline, and transient
+    errors are retried with full-jitter exponential backoff. With hold=True the outcome of a
+    successful call is left for the caller to record, and (result, probe) is returned.
+    """
+    attempt = 0
+    while True:
+        remaining = async_remaining() if bounded else math.inf
+        if remaining <= 0:
+            raise DeadlineExceededError(f"Request deadline passed before {name}")
+        probe = breaker.before_call()
+        try:
+            result = await fn(*args, **kwargs)
+        except asyncio.CancelledError:
+            if probe:
+                breaker.record(True, probe)  # An abandoned probe proves nothing, so stay open
+            raise
+        except Exception as e:
+            transient = is_transient_error(e)
+            breaker.record(transient, probe)
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+            left = async_remaining() if bounded else math.inf
+            if not transient or attempt >= RETRY_ATTEMPTS or delay >= left:
+                raise
+            attempt += 1
+            log.info("Retrying backend call", extra={"fields": {
+                "call": name, "attempt": attempt, "delay": round(delay, 3), "error": str(e)}})
+            await asyncio.sleep(delay)
+            continue
+        if hold:
+            return result, probe
+        breaker.record(False, probe)
+        return result
+
+
+@asynccontextmanager
+async def async_stream_run(breaker, client, thread_id, assistant_id, timeout):
+    """
+    Async counterpart of webserver.ResilientBackend.stream_run: connect through async_call
+    and record the outcome once the stream is closed.
+    """
+    async def enter():
+        manager = client.beta.threads.runs.stream(thread_id=thread_id, assistant_id=assistant_id, timeout=timeout)
+        return manager, await manager.__aenter__()
+
+    (manager, stream), probe = await async_call(breaker, "runs.stream", enter, hold=True)
+    try:
+        yield stream
+    except BaseException as e:
+        breaker.record(is_transient_error(e), probe)
+        if not await manager.__aexit__(type(e), e, e.__traceback__):
+            raise
+    else:
+        breaker.record(False, probe)
+        await manager.__aexit__(None, None, None)
+
+
+async def async_cancel_run(breaker, client, thread_id, run_id):
+    try:
+        await async_call(breaker, "runs.cancel", client.beta.threads.runs.cancel,
+                         thread_id=thread_id, run_id=run_id, bounded=False)
+    except Exception as e:
+        log.warning("Could not cancel run", extra={"fields": {"run_id": run_id, "thread_id": thread_id, "error": str(e)}})
+
+
+async def async_run_assistant(breaker, client, thread_id, assistant_id, label, deadline=RUN_DEADLINE):
+    """
+    Async counterpart of webserver.run_assistant: follow the run event stream when the SDK
+    supports it, otherwise poll with the same backoff and deadline. The run is cancelled if
+    it needs action, misses the deadline, or the request is cancelled because its client left.
+    """
+    started = monotonic()
+    deadline = min(deadline, async_remaining())
+    status = "in_progress"
+    run_id = None
+    polls = 0
+    try:
+        if hasattr(client.beta.threads.runs, "stream"):
+            try:
+                async with async_stream_run(breaker, client, thread_id, assistant_id, deadline) as stream:
+                    async for event in stream:
+                        if event.event.startswith("thread.run.") and not event.event.startswith("thread.run.step"):
+                            run_id = event.data.id
+                            status = event.data.status
+                        if status in RUN_TERMINAL_STATES:
+                            break
+                        if monotonic() - started > deadline:
+                            status = "deadline_exceeded"
+                            break
+            except httpx.TimeoutException:
+                status = "deadline_exceeded"  # The stream's read timeout is the deadline
+        else:
+            run = await async_call(breaker, "runs.create", client.beta.threads.runs.create,
+                                   thread_id=thread_id, assistant_id=assistant_id)
+            run_id = run.id
+            delay = RUN_POLL_INITIAL_DELAY
+            while True:
+                try:
+                    run_status = await async_call(breaker, "runs.retrieve", client.beta.threads.runs.retrieve,
+                                                  thread_id=thread_id, run_id=run_id)
+                except DeadlineExceededError:
+                    status = "deadline_exceeded"
+                    break
+                polls += 1
+                status = run_status.status
+                if status in RUN_TERMINAL_STATES:
+                    break
+                remaining = deadline - (monotonic() - started)
+                if remaining <= 0:
+                    status = "deadline_exceeded"
+                    break
+                await asyncio.sleep(min(delay, remaining))
+                delay = min(delay * RUN_POLL_BACKOFF, RUN_POLL_MAX_DELAY)
+    except asyncio.CancelledError:
+        if run_id:
+            # Shielded so the cancel call itself is not cancelled along with the request
+            await asyncio.shield(async_cancel_run(breaker, client, thread_id, run_id))
+        record_run_wait("client_disconnected", polls, round(monotonic() - started, 3))
+        raise
+
+    if run_id and status in RUN_CANCEL_STATES:
+        await async_cancel_run(breaker, client, thread_id, run_id)
+    stats = {"mode": "stream" if polls == 0 else "poll", "polls": polls, "wait_time": round(monotonic() - started, 3)}
+    record_run_wait(status, polls, stats["wait_time"])
+    log.info("Run finished", extra={"fields": dict(stats, thread_id=thread_id, label=label, status=status)})
+    return status, stats
+
+
+def backend_chat(question, thread_id, assistant_id, label):
+    """
+    Blocking chat against webserver.backend, for backends without an async client. Runs on a
+    worker thread, where the request deadline and stage labels are handed to the backend through
+    request_state and request_metrics.
+    """
+    request_state.deadline = request_deadline.get()
+    request_metrics.endpoint, request_metrics.user_type = request_labels.get()
+    request_metrics.timings = request_timings.get()
+    try:
+        webserver.backend.create_message(thread_id, question)
+        status, run_stats = run_assistant(thread_id, assistant_id, label)
+        if status != "completed":
+            return 502, {"error": f"Run {status}", "run_stats": run_stats}
+        return 200, {"response": latest_assistant_message(thread_id), "run_stats": run_stats}
+    finally:
+        request_state.__dict__.clear()
+        request_metrics.__dict__.clear()
+
+
+async def async_chat(question, thread_id, assistant_name, rate_limit, label, user_type):
+    """
+    Ask question on thread_id and return (status code, body) in the same shape as the Flask
+    chat functions. The calls go to the API key that created the thread, with its budget, and
+    the run waits in user_type's scheduler queue.
+    """
+    credential, provider_thread_id = credential_pool.split(thread_id)
+    # Fail before spending a token while the key's circuit is open
+    credential.breaker.check()
+    with async_timed_stage("rate_limit_wait"):
+        await async_wait_for_token(credential.buckets[rate_limit])
+    assistant_id = await asyncio.to_thread(assistant_registry.get, assistant_name, credential.name)
+    async with async_openai_slot(thread_id, user_type):
+        client = async_clients.get(credential.name)
+        if client is None:
+            return await asyncio.to_thread(backend_chat, question, thread_id, assistant_id, label)
+        breaker = credential.breaker
+        with async_timed_stage("messages_create"):
+            await async_call(breaker, "messages.create", client.beta.threads.messages.create,
+                             thread_id=provider_thread_id, role="user", content=question)
+        with async_timed_stage("run_wait"):
+            status, run_stats = await async_run_assistant(breaker, client, provider_thread_id, assistant_id, label)
+        if status != "completed":
+            return 502, {"error": f"Run {status}", "run_stats": run_stats}
+        with async_timed_stage("messages_list"):
+            messages = await async_call(breaker, "messages.list", client.beta.threads.messages.list,
+                                        thread_id=provider_thread_id, limit=1)
+    return 200, {"response": messages.data[0].content[0].text.value, "run_stats": run_stats}
+
+
+async def ask_free_assistant(question, user_type, thread_id):
+    status, answer_data = await async_chat(question, thread_id, "free", "gpt3", "FREE", user_type)
+    if status == 200:
+        answer_cache.put(await asyncio.to_thread(assistant_registry.get, "free"), question, answer_data["response"])
+    return status, answer_data
+
+
+async def start_conversation(data):
+    free_thread_id = await asyncio.to_thread(thread_pool.acquire)
+    premium_thread_id = await asyncio.to_thread(thread_pool.acquire)
+    return 200, {"free_thread_id": free_thread_id, "premium_thread_id": premium_thread_id}
+
+
+async def ask_question(data):
+    question = data["question"]
+    user_type = data["user_status"]  # Free or Premium
+    thread_id = data["thread_id"]
+
+    if not thread_id:
+        return 400, {"error": "Missing thread_id"}
+    if user_type not in ("free", "premium"):
+        return 400, {"response": "Invalid user_type"}
+
+    free_assistant_id = await asyncio.to_thread(assistant_registry.get, "free")
+    with async_timed_stage("answer_cache"):
+        answer_text = answer_cache.get(free_assistant_id, question)
+    if answer_text is None and user_type == "free":
+        with async_timed_stage("faq_search"):
+            answer_text = faq_index.search(question)
+    if answer_text is None:
+        credential_pool.split(thread_id)  # An unknown key suffix is a 400 for this caller only
+        flight_key = (free_assistant_id, normalize_question(question))
+        with async_timed_stage("answer_flight"):
+            status, answer_data = await async_flight(
+                flight_key, lambda: ask_free_assistant(question, user_type, thread_id))
+        if status != 200:
+            return status, answer_data
+        answer_text = answer_data["response"]
+
+    with async_timed_stage("feedback_enqueue"):
+        record_id = await asyncio.to_thread(
+            feedback_writer.add, question=question, answer=answer_text, username=data["username"],
+            user_type=user_type, thread_id=thread_id, thread_type=data["thread_type"],
+        )
+    return 200, {"question": question, "answer": answer_text, "record_id": record_id}
+
+
+async def ask_question_premium(data):
+    question = data["question"]
+    user_type = data["user_status"]  # Free or Premium
+    thread_id = data["thread_id"]
+
+    if user_type != "premium":
+        return 400, {"response": "Invalid user_type"}
+    if not thread_id:
+        # Clients that send no premium thread get one from the pool and keep the returned thread_id
+        with async_timed_stage("thread_pool_acquire"):
+            thread_id = await asyncio.to_thread(thread_pool.acquire)
+
+    status, answer_data = await async_chat(question, thread_id, "premium", "gpt4", "PREMIUM", user_type)
+    if status != 200:
+        return status, answer_data
+    answer_text = answer_data["response"]
+
+    with async_timed_stage("feedback_enqueue"):
+        record_id = await asyncio.to_thread(
+            feedback_writer.add, question=question, answer=answer_text, username=data["username"],
+            user_type=user_type, thread_id=thread_id, thread_type=data["thread_type"],
+        )
+    return 200, {"question": question, "answer": answer_text, "record_id": record_id, "thread_id": thread_id}
+
+
+async def related_question_premium(data):
+    question = data["question"]
+    user_type = data["user_status"]  # Free or Premium
+
+    # Same cache-or-pending contract as the Flask endpoint; generation runs on its executor
+    rephrase_assistant_id = await asyncio.to_thread(assistant_registry.get, "rephrase")
+    cached = related_cache.get(rephrase_assistant_id, question)
+    if cached is None:
+        if schedule_related_questions(flask_app, question, user_type) == "failed":
+            return 200, {"result": "failed"}
+        return 202, {"question": question, "result": "pending"}
+
+    related_question1, related_question2, related_question3 = json.loads(cached)
+    return 200, {"question": question, "related_question1": related_question1,
+                 "related_question2": related_question2, "related_question3": related_question3}
+
+
+ASYNC_ROUTES = {
+    ("GET", "/api/start"): start_conversation,
+    ("POST", "/api/ask_question"): ask_question,
+    ("POST", "/api/ask_question_premium"): ask_question_premium,
+    ("POST", "/api/related_question_premium"): related_question_premium,
+}
+
+
+async def read_json(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    return json.loads(body) if body else {}
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def send_json(send, status, data, headers=()):
+    body = json.dumps(data).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()), *headers],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+def with_server_timing(send, headers, started):
+    """
+    Wrap send to add a Server-Timing header with the request's stage timings, under the same
+    conditions as the Flask routes.
+    """
+    async def send_timed(message):
+        timings = request_timings.get()
+        if (message["type"] == "http.response.start" and timings is not None
+                and (flask_app.config["SERVER_TIMING"] or b"x-request-timing" in headers)):
+            entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings]
+            entries.append(f"total;dur={(monotonic() - started) * 1000:.1f}")
+            message = dict(message, headers=[*message["headers"], (b"server-timing", ", ".join(entries).encode())])
+        await send(message)
+    return send_timed
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            # The simulated backend has no async client; async_chat runs it on worker threads
+            if LLM_BACKEND == "openai":
+                async_clients.update({
+                    # Retries are done by async_call, so the SDK's own retry loop is turned off
+                    credential.name: AsyncOpenAI(api_key=credential.api_key, base_url=OPENAI_BASE_URL, max_retries=0,
+                                                 http_client=httpx.AsyncClient(**http_client_options()))
+                    for credential in credential_pool.credentials.values()
+                })
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            for client in async_clients.values():
+                await client.close()
+            await asyncio.to_thread(feedback_writer.stop)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    route = ASYNC_ROUTES.get((scope.get("method"), scope.get("path"))) if scope["type"] == "http" else None
+    if route is None:
+        return await wsgi_app(scope, receive, send)
+
+    started = monotonic()
+    headers = dict(scope["headers"])
+    send = with_server_timing(send, headers, started)
+    timeout = REQUEST_DEADLINE
+    try:
+        timeout = min(timeout, float(headers.get(b"x-request-timeout", timeout)))
+    except ValueError:
+        pass
+    request_deadline.set(started + timeout)
+    # Same session check as the Flask routes: a valid token names the user, a bad one is a 401
+    token = bearer_token(headers.get(b"authorization", b"").decode("latin-1"))
+    session_username = verify_session_token(flask_app.secret_key, token) if token else None
+    if token and session_username is None:
+        return await send_json(send, 401, {"message": "Invalid or expired session token"})
+    request_labels.set((route.__name__, "none"))
+    try:
+        data = await read_json(receive)
+        if session_username:
+            data["username"] = session_username
+        user_type = data.get("user_status") if isinstance(data, dict) else None
+        request_labels.set((route.__name__, user_type if user_type in SCHEDULER_WEIGHTS else "none"))
+        request_timings.set([])
+        # The route runs as its own task so it can be cancelled, cancelling its run, if the
+        # client disconnects first
+        task = asyncio.ensure_future(route(data))
+        disconnect = asyncio.ensure_future(wait_for_disconnect(receive))
+        await asyncio.wait({task, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+        if not task.done():
+            task.cancel()
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+            log.info("Client disconnected", extra={"fields": {"path": scope["path"]}})
+            return
+        disconnect.cancel()
+        status, body = task.result()
+        await send_json(send, status, body)
+    except QueueFullError as e:
+        await send_json(send, 429, {"error": "Server is busy. Please try again later."},
+                        [(b"retry-after", str(e.retry_after).encode())])
+    except RateLimitException as e:
+        retry_after = max(1, math.ceil(getattr(e, "period_remaining", 1)))
+        await send_json(send, 429, {"error": "Rate limit exceeded. Please try again later."},
+                        [(b"retry-after", str(retry_after).encode())])
+    except CircuitOpenError as e:
+        await send_json(send, 503, {"error": "The assistant is temporarily unavailable. Please try again later."},
+                        [(b"retry-after", str(e.retry_after).encode())])
+    except DeadlineExceededError as e:
+        log.warning("Request deadline exceeded", extra={"fields": {"error": str(e)}})
+        await send_json(send, 504, {"error": "The request took too long. Please try again."})
+    except OpenAIError as e:
+        log.warning("LLM backend error", extra={"fields": {"error": str(e)}})
+        await send_json(send, 502, {"error": "The assistant could not answer. Please try again later."})
+    except (KeyError, TypeError, ValueError) as e:
+        await send_json(send, 400, {"error": f"Invalid request: {e}"})
+    except Exception:
+        log.exception("An error occurred")
+        await send_json(send, 500, {"error": "An unexpected error occurred. Please try again later."})
+    finally:
+        latency_histograms.observe("request", *request_labels.get(), monotonic() - started)
@@ -0,0 +1,932 @@
+"""
+Offline load benchmark. Serves the app against the simulated LLM backend in a throwaway
+directory and drives it with concurrent users, then prints throughput and latency
+percentiles per endpoint. No OpenAI key or network access is needed.
+
+Usage: python benchmark.py --users 50 --duration 30 --distinct-questions 20
+Simulator latencies and failure rates are read from SIM_* (see SimulatedBackend.from_env).
+With --stand-in the simulator runs behind a local HTTP server speaking the Assistants API,
+and the app talks to it through the OpenAI SDK and its pooled transport (OPENAI_* settings).
+--keys N spreads the load over N API keys, each with its own simulator (so a thread used with
+the wrong key fails), and --key-rate caps every key's budget to show capacity scaling with keys.
+
+python benchmark.py --log-overhead instead measures the per-request cost of logging, print()
+against the queued logger, and python benchmark.py --single-flight 50 checks that 50 concurrent
+identical questions are answered by one upstream run.
+
+python benchmark.py --concurrency 200 serves the app twice against the stand-in API, once on the
+threaded WSGI server and once on the ASGI entry point (asgi.py, under uvicorn), asks 200 new
+questions at once on each and reports the peak number of runs in flight upstream and the
+server's memory per open request.
+
+python benchmark.py --feedback-writes 20000 stores 20000 FeedbackData rows from 8 threads, first
+with a commit per row as the handlers used to, then through the write-behind FeedbackWriter.
+
+python benchmark.py --login-storm 16 has 16 clients log in over and over while 4 others ask new
+questions, with password hashes computed on the request threads (as login used to) and then
+in the process pool, and reports login throughput and the askers' latency.
+
+python benchmark.py --storage 1000000 fills the users and feedback tables with a million rows
+each and runs concurrent logins, thread lookups and feedback inserts against the SQLite file,
+first as created by the original code (rollback journal, no indexes) and then after the
+production profile (WAL, SQLITE_PRAGMAS and the declared indexes) has been applied to it.
+
+python benchmark.py --faq-index 1000000 builds the FAQ index over a million generated liked
+questions and reports the build time, the index's memory and the lookup latency for
+near-duplicate and for new questions.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+from collections import Counter, defaultdict
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+from time import monotonic, perf_counter, sleep
+
+WORK_DIR = tempfile.mkdtemp(prefix="benchmark-")
+os.environ["LLM_BACKEND"] = "simulated"
+os.environ.setdefault("RATE_LIMIT_DB_PATH", os.path.join(WORK_DIR, "ratelimit.db"))
+os.environ.setdefault("LOG_LEVEL", "WARNING")  # Keep the report readable
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(WORK_DIR)  # assistant.json and the SQLite database are created here
+
+from werkzeug.serving import WSGIRequestHandler, make_server  # noqa: E402
+
+import webserver  # noqa: E402
+
+
+class StandInAPI(BaseHTTPRequestHandler):
+    """
+    Local stand-in for the Assistants API endpoints the app calls, answering from a
+    SimulatedBackend. With --stand-in the app uses its real OpenAI backend against this
+    server, so the SDK, the pooled HTTP transport and run streaming are all exercised.
+    Every API key sees only its own assistants and threads, as with separate projects.
+    """
+
+    protocol_version = "HTTP/1.1"  # Keep-alive, like the real API
+    sims = {}  # API key -> SimulatedBackend
+    sims_lock = threading.Lock()
+    routes = [
+        ("POST", re.compile(r"/v1/assistants$"), "create_assistant"),
+        ("POST", re.compile(r"/v1/threads$"), "create_thread"),
+        ("POST", re.compile(r"/v1/threads/(?P<thread_id>[^/]+)/messages$"), "create_message"),
+        ("GET", re.compile(r"/v1/threads/(?P<thread_id>[^/]+)/messages$"), "list_messages"),
+        ("POST", re.compile(r"/v1/threads/(?P<thread_id>[^/]+)/runs$"), "create_run"),
+        ("GET", re.compile(r"/v1/threads/(?P<thread_id>[^/]+)/runs/(?P<run_id>[^/]+)$"), "retrieve_run"),
+        ("POST", re.compile(r"/v1/threads/(?P<thread_id>[^/]+)/runs/(?P<run_id>[^/]+)/cancel$"), "cancel_run"),
+    ]
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def dispatch(self, method):
+        path, _, query = self.path.partition("?")
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else {}
+        api_key = self.headers.get("Authorization", "").removeprefix("Bearer ")
+        with self.sims_lock:
+            if api_key not in self.sims:
+                self.sims[api_key] = webserver.SimulatedBackend.from_env()
+                # IDs unique across keys, so a thread sent to the wrong key is not found
+                self.sims[api_key].ids = itertools.count(len(self.sims) * 1_000_000)
+            self.sim = self.sims[api_key]
+        for route_method, pattern, name in self.routes:
+            match = pattern.match(path)
+            if route_method == method and match:
+                thread_id = match.groupdict().get("thread_id")
+                if thread_id and thread_id not in self.sim.threads:
+                    self.send_json({"error": {"message": f"No thread found with id '{thread_id}'."}}, 404)
+                    return
+                try:
+                    getattr(self, name)(body, parse_qs(query), **match.groupdict())
+                except webserver.SimulatedAPIError as e:
+                    self.send_json({"error": {"message": str(e), "type": "server_error"}}, e.status_code)
+                return
+        self.send_json({"error": {"message": f"No route for {method} {path}"}}, 404)
+
+    def send_json(self, data, status=200):
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_event(self, event, data):
+        self.wfile.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode())
+        self.wfile.flush()
+
+    @staticmethod
+    def run_object(thread_id, run_id, status):
+        return {"id": run_id, "object": "thread.run", "thread_id": thread_id, "status": status}
+
+    def create_assistant(self, body, query):
+        self.send_json({"id": self.sim.create_assistant(body.get("instructions"), body.get("model"), body.get("tools")),
+                        "object": "assistant"})
+
+    def create_thread(self, body, query):
+        self.send_json({"id": self.sim.create_thread(), "object": "thread"})
+
+    def create_message(self, body, query, thread_id):
+        self.sim.create_message(thread_id, body["content"])
+        self.send_json({"id": f"msg_{thread_id}", "object": "thread.message", "thread_id": thread_id})
+
+    def list_messages(self, body, query, thread_id):
+        limit = int(query.get("limit", ["20"])[0])
+        data = [{"id": f"msg_{n}", "object": "thread.message", "role": "assistant",
+                 "content": [{"type": "text", "text": {"value": text, "annotations": []}}]}
+                for n, text in enumerate(self.sim.list_messages(thread_id, limit))]
+        self.send_json({"object": "list", "data": data, "has_more": False})
+
+    def retrieve_run(self, body, query, thread_id, run_id):
+        self.send_json(self.run_object(thread_id, run_id, self.sim.retrieve_run(thread_id, run_id)))
+
+    def cancel_run(self, body, query, thread_id, run_id):
+        self.sim.cancel_run(thread_id, run_id)
+        self.send_json(self.run_object(thread_id, run_id, "cancelling"))
+
+    def create_run(self, body, query, thread_id):
+        if not body.get("stream"):
+            run_id = self.sim.create_run(thread_id, body["assistant_id"])
+            self.send_json(self.run_object(thread_id, run_id, "queued"))
+            return
+        # Streamed run: relay the simulator's run events
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        with self.sim.stream_run(thread_id, body["assistant_id"], webserver.RUN_DEADLINE) as stream:
+            for event in stream:
+                if event.event != "thread.message.delta":
+                    run_id = event.data.id
+                    self.send_event(event.event, self.run_object(thread_id, run_id, event.data.status))
+                    continue
+                message = {"id": f"msg_{run_id}", "object": "thread.message", "thread_id": thread_id,
+                           "role": "assistant", "status": "in_progress", "content": []}
+                self.send_event("thread.message.created", message)
+                self.send_event("thread.message.delta", {"id": message["id"], "object": "thread.message.delta", "delta": {
+                    "content": [{"index": 0, "type": "text", "text": {"value": event.data.delta.content[0].text.value}}]}})
+        self.wfile.write(b"event: done\ndata: [DONE]\n\n")
+        self.close_connection = True
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # Room for a burst of connections from --concurrency
+
+
+def start_stand_in():
+    """
+    Serve StandInAPI on a free local port and point the app's OpenAI backend at it.
+    """
+    server = StandInServer(("127.0.0.1", 0), StandInAPI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    webserver.LLM_BACKEND = "openai"
+    webserver.OPENAI_BASE_URL = f"http://127.0.0.1:{server.server_port}/v1"
+    return server
+
+
+def use_keys(keys, key_rate=None):
+    """
+    Replace the app's credential pool with keys stand-in API keys (any key is accepted),
+    optionally capping every rate budget to key_rate requests per second per key.
+    """
+    if key_rate:
+        webserver.RATE_LIMITS = {kind: (key_rate, 1) for kind in webserver.RATE_LIMITS}
+    names = [webserver.DEFAULT_KEY_NAME] if keys == 1 else [f"key{n}" for n in range(1, keys + 1)]
+    webserver.credential_pool = webserver.CredentialPool({name: f"stand-in-{name}" for name in names})
+
+
+def simulators():
+    """
+    The simulator behind each API key, by key name.
+    """
+    credentials = webserver.credential_pool.credentials.values()
+    if StandInAPI.sims:
+        return {c.name: StandInAPI.sims[c.api_key] for c in credentials if c.api_key in StandInAPI.sims}
+    return {c.name: c.backend.backend for c in credentials}
+
+
+def backend_calls():
+    calls = Counter()
+    for sim in simulators().values():
+        calls.update(sim.stats()["calls"])
+    return calls
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)  # endpoint -> seconds
+        self.statuses = defaultdict(lambda: defaultdict(int))  # endpoint -> status -> count
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, status, seconds):
+        with self.lock:
+            self.latencies[endpoint].append(seconds)
+            self.statuses[endpoint][status] += 1
+
+    def report(self, elapsed):
+        print(f"{'endpoint':<32} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}  statuses")
+        for endpoint in sorted(self.latencies):
+            values = sorted(self.latencies[endpoint])
+            statuses = ", ".join(f"{code}: {count}" for code, count in sorted(self.statuses[endpoint].items()))
+            print(f"{endpoint:<32} {len(values) / elapsed:>8.1f} {percentile(values, 0.5) * 1000:>8.0f} "
+                  f"{percentile(values, 0.95) * 1000:>8.0f} {percentile(values, 0.99) * 1000:>8.0f}  {statuses}")
+
+
+def call(base_url, recorder, method, path, payload=None):
+    data = json.dumps(payload).encode() if payload is not None else None
+    req = urllib.request.Request(base_url + path, data=data, method=method,
+                                 headers={"Content-Type": "application/json"})
+    started = monotonic()
+    try:
+        with urllib.request.urlopen(req, timeout=120) as response:
+            status, body = response.status, response.read()
+    except urllib.error.HTTPError as e:
+        status, body = e.code, e.read()
+    except OSError:
+        status, body = "error", b""
+    recorder.record(path, status, monotonic() - started)
+    try:
+        return status, json.loads(body)
+    except ValueError:
+        return status, {}
+
+
+def simulate_user(user_number, base_url, recorder, questions, stop_at, premium_share):
+    rng = random.Random(user_number)
+    username = f"bench-user-{user_number}"
+    status, data = call(base_url, recorder, "GET", "/api/start")
+    free_thread_id = data.get("free_thread_id")
+    premium_thread_id = data.get("premium_thread_id")
+    while monotonic() < stop_at:
+        question = rng.choice(questions)
+        if rng.random() < premium_share:
+            status, data = call(base_url, recorder, "POST", "/api/ask_question_premium", {
+                "question": question, "user_status": "premium", "thread_id": premium_thread_id,
+                "username": username, "thread_type": "premium",
+            })
+            premium_thread_id = data.get("thread_id", premium_thread_id)
+            call(base_url, recorder, "POST", "/api/related_question_premium",
+                 {"question": question, "user_status": "premium"})
+        else:
+            status, data = call(base_url, recorder, "POST", "/api/ask_question", {
+                "question": question, "user_status": "free", "thread_id": free_thread_id,
+                "username": username, "thread_type": "free",
+            })
+        if status == 200 and "record_id" in data and rng.random() < 0.3:
+            call(base_url, recorder, "POST", "/submit_feedback",
+                 {"record_id": data["record_id"], "feedback": rng.choice(["Like", "Dislike"])})
+
+
+# Shape of a typical polled request: 20 status polls and a 1 kB answer
+LOG_OVERHEAD_POLLS = 20
+LOG_OVERHEAD_ANSWER = "x" * 1000
+# Drain rate of the simulated slow stdout consumer (a log shipper or a busy terminal)
+LOG_OVERHEAD_PIPE_RATE = 2_000_000  # In bytes per second
+
+
+def slow_pipe():
+    """
+    Return a line-buffered text file writing into a pipe that a background thread drains at
+    LOG_OVERHEAD_PIPE_RATE, so writers block once the pipe buffer fills like a stalled stdout.
+    """
+    read_fd, write_fd = os.pipe()
+
+    def drain():
+        chunk = 16384
+        while os.read(read_fd, chunk):
+            sleep(chunk / LOG_OVERHEAD_PIPE_RATE)
+
+    threading.Thread(target=drain, daemon=True).start()
+    return os.fdopen(write_fd, "w", buffering=1)
+
+
+def print_request_lines(n, out):
+    print(f"Assistant ID: asst_{n}", file=out)
+    for _ in range(LOG_OVERHEAD_POLLS):
+        print(f"Thread ID thread_{n} FREE Run status: in_progress", file=out)
+    print(f"Thread ID thread_{n} FREE Run COMPLETED after {LOG_OVERHEAD_POLLS} polls in 3.2s", file=out)
+    print(f"Assistant response: {LOG_OVERHEAD_ANSWER}", file=out)
+
+
+def log_request_lines(n):
+    webserver.log.debug("Using assistant", extra={"fields": {"assistant_id": f"asst_{n}"}})
+    for poll in range(LOG_OVERHEAD_POLLS):
+        webserver.log_poll(thread_id=f"thread_{n}", label="FREE", status="in_progress", poll=poll)
+    webserver.log.info("Run finished", extra={"fields": {
+        "thread_id": f"thread_{n}", "label": "FREE", "status": "completed", "polls": LOG_OVERHEAD_POLLS}})
+    webserver.log.debug("Assistant response", extra={"fields": {"response": LOG_OVERHEAD_ANSWER}})
+
+
+def time_requests(requests, emit):
+    """
+    Return the mean and worst time in microseconds spent logging one request.
+    """
+    worst = 0
+    started = perf_counter()
+    for n in range(requests):
+        request_started = perf_counter()
+        emit(n)
+        worst = max(worst, perf_counter() - request_started)
+    return (perf_counter() - started) / requests * 1e6, worst * 1e6
+
+
+def log_overhead(requests):
+    """
+    Time the log lines one request produces: print() as the handlers used to, against the
+    queued logger at the production level (INFO), both writing to a slowly drained pipe.
+    """
+    print(f"{requests} requests, {LOG_OVERHEAD_POLLS} polls each, stdout drained at {LOG_OVERHEAD_PIPE_RATE} B/s")
+    out = slow_pipe()
+    mean, worst = time_requests(requests, lambda n: print_request_lines(n, out))
+    print(f"print():        mean {mean:8.1f} us  worst {worst:10.1f} us per request")
+
+    webserver.log.setLevel("INFO")
+    webserver.start_logging(slow_pipe())
+    mean, worst = time_requests(requests, log_request_lines)
+    print(f"queued logger:  mean {mean:8.1f} us  worst {worst:10.1f} us per request "
+          f"({webserver.log_queue_handler.dropped} records dropped while the pipe was full)")
+
+
+def single_flight(base_url, users):
+    """
+    Ask the same new question from many users at once and check that one run answered them all
+    while every caller still got its own record_id. Returns True if it did.
+    """
+    recorder = Recorder()
+    thread_ids = [call(base_url, recorder, "GET", "/api/start")[1]["free_thread_id"] for _ in range(users)]
+    runs_before = backend_calls()["runs.create"]
+    barrier = threading.Barrier(users)
+    results = [None] * users
+
+    def ask(n):
+        barrier.wait()
+        results[n] = call(base_url, recorder, "POST", "/api/ask_question", {
+            "question": "What is single-flight coalescing?", "user_status": "free",
+            "thread_id": thread_ids[n], "username": f"bench-user-{n}", "thread_type": "free",
+        })
+
+    askers = [threading.Thread(target=ask, args=(n,)) for n in range(users)]
+    for asker in askers:
+        asker.start()
+    for asker in askers:
+        asker.join()
+
+    runs = backend_calls()["runs.create"] - runs_before
+    record_ids = {data.get("record_id") for status, data in results if status == 200}
+    answers = {data.get("answer") for status, data in results}
+    print(f"{users} identical questions: {runs} upstream run(s), {len(record_ids)} record_ids, "
+          f"{len(answers)} distinct answer(s)")
+    print("answer_flights:", json.dumps(webserver.answer_flights.stats(), sort_keys=True))
+    return runs == 1 and len(record_ids) == users and len(answers) == 1
+
+
+# Wait for the server under test to answer, and for its memory to settle after a burst
+CONCURRENCY_STARTUP_TIMEOUT = 60  # In seconds
+CONCURRENCY_SAMPLE_INTERVAL = 0.05  # In seconds
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def serve(kind, port, upstream, concurrency):
+    """
+    Serve the app on port against the stand-in API at upstream, on the threaded WSGI server
+    (kind "sync") or the ASGI entry point under uvicorn ("async"). Runs in its own process,
+    started by --concurrency, so its memory can be measured alone.
+    """
+    webserver.LLM_BACKEND = "openai"
+    webserver.OPENAI_BASE_URL = upstream
+    webserver.DEFAULT_CONFIG["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{os.path.join(WORK_DIR, 'data.db')}"
+    use_keys(1, key_rate=concurrency * 10)  # Measure the servers, not the rate budget
+    if kind == "sync":
+        app = webserver.create_app()
+        make_server("127.0.0.1", port, app, threaded=True, request_handler=QuietRequestHandler).serve_forever()
+        return
+    import uvicorn
+    import asgi
+    asgi.LLM_BACKEND = "openai"
+    asgi.OPENAI_BASE_URL = upstream
+    uvicorn.run(asgi.app, host="127.0.0.1", port=port, log_level="warning", backlog=1024)
+
+
+def rss_kb(pid):
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def active_runs():
+    """
+    Runs in progress on the stand-in API right now, over every API key.
+    """
+    now = monotonic()
+    count = 0
+    for sim in list(StandInAPI.sims.values()):
+        with sim.lock:
+            count += sum(1 for status, finishes_at, _ in sim.runs.values()
+                         if status == "in_progress" and finishes_at > now)
+    return count
+
+
+def measure_concurrency(kind, upstream, concurrency):
+    """
+    Start a server of the given kind, ask concurrency new questions at once on their own
+    threads, and return a summary line with the statuses, the peak number of runs in flight
+    upstream and the server's memory growth per open request.
+    """
+    port = free_port()
+    # Every streamed run holds an upstream connection, so the pool must fit them all; idle
+    # connections stay at the usual keep-alive size
+    env = dict(os.environ, OPENAI_MAX_CONCURRENCY=str(concurrency),
+               OPENAI_MAX_CONNECTIONS=str(concurrency), OPENAI_MAX_KEEPALIVE="16",
+               THREAD_POOL_HIGH_WATERMARK=str(concurrency))
+    env.pop("RATE_LIMIT_DB_PATH", None)  # Each server gets its own rate limit state
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", kind, "--port", str(port),
+                               "--upstream", upstream, "--concurrency", str(concurrency)], env=env)
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        recorder = Recorder()
+        deadline = monotonic() + CONCURRENCY_STARTUP_TIMEOUT
+        while call(base_url, recorder, "GET", "/api/start")[0] != 200:
+            if monotonic() > deadline or server.poll() is not None:
+                return f"{kind:<6} server did not start"
+            sleep(0.2)
+        thread_ids = [call(base_url, recorder, "GET", "/api/start")[1].get("free_thread_id")
+                      for _ in range(concurrency)]
+        sleep(1)
+        idle_kb = rss_kb(server.pid)
+
+        statuses = Counter()
+        barrier = threading.Barrier(concurrency + 1)
+
+        def ask(n):
+            barrier.wait()
+            status, _ = call(base_url, recorder, "POST", "/api/ask_question", {
+                "question": f"Concurrency question {kind} {n}?", "user_status": "free",
+                "thread_id": thread_ids[n], "username": f"bench-user-{n}", "thread_type": "free",
+            })
+            statuses[status] += 1
+
+        askers = [threading.Thread(target=ask, args=(n,)) for n in range(concurrency)]
+        for asker in askers:
+            asker.start()
+        barrier.wait()
+        started = monotonic()
+        peak_runs = peak_kb = 0
+        while any(asker.is_alive() for asker in askers):
+            runs = active_runs()
+            if runs >= peak_runs:
+                peak_runs, peak_kb = runs, max(peak_kb, rss_kb(server.pid))
+            sleep(CONCURRENCY_SAMPLE_INTERVAL)
+        elapsed = monotonic() - started
+        per_request = (peak_kb - idle_kb) / peak_runs if peak_runs else 0
+        return (f"{kind:<6} {elapsed:>6.1f}s  peak runs in flight {peak_runs:>5}  idle RSS {idle_kb / 1024:>6.1f} MB  "
+                f"peak RSS {peak_kb / 1024:>6.1f} MB  {per_request:>7.1f} kB per open request  "
+                f"statuses {dict(sorted(statuses.items(), key=str))}")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def concurrency(requests):
+    """
+    Compare the threaded WSGI server with the ASGI entry point at requests open questions.
+    """
+    os.environ.setdefault("SIM_RUN_DURATION", "5,0")  # Long enough for every request to be open at once
+    os.environ.setdefault("SIM_CALL_LATENCY", "0.005,0")
+    server = start_stand_in()
+    upstream = f"http://127.0.0.1:{server.server_port}/v1"
+    print(f"{requests} concurrent new questions, runs take {os.environ['SIM_RUN_DURATION'].split(',')[0]}s")
+    for kind in ("sync", "async"):
+        print(measure_concurrency(kind, upstream, requests), flush=True)
+
+
+FEEDBACK_WRITE_THREADS = 8  # Request threads storing rows at once in --feedback-writes
+
+
+def feedback_writes(rows):
+    """
+    Store rows FeedbackData rows from FEEDBACK_WRITE_THREADS threads with one commit per row,
+    then through a FeedbackWriter, and print rows and commits per second for each.
+    """
+    app = webserver.create_app({"SQLALCHEMY_DATABASE_URI": f"sqlite:///{os.path.join(WORK_DIR, 'feedback.db')}",
+                                "DEFER_PROCESS_INIT": True})
+    row = {"question": "How are commits grouped?", "answer": "In batches. " * 40, "username": "bench-user",
+           "user_type": "free", "thread_id": "thread_bench", "thread_type": "free"}
+    per_thread = rows // FEEDBACK_WRITE_THREADS
+    writer = webserver.FeedbackWriter(webserver.FEEDBACK_BATCH_SIZE, webserver.FEEDBACK_FLUSH_INTERVAL,
+                                      webserver.FEEDBACK_ID_BLOCK)
+
+    def commit_each():
+        with app.app_context():
+            for _ in range(per_thread):
+                webserver.db.session.add(webserver.FeedbackData(**row))
+                webserver.db.session.commit()
+
+    def write_behind():
+        for _ in range(per_thread):
+            writer.add(**row)
+
+    print(f"{per_thread * FEEDBACK_WRITE_THREADS} rows from {FEEDBACK_WRITE_THREADS} threads")
+    for name, target in (("commit per row", commit_each), ("write-behind", write_behind)):
+        if target is write_behind:
+            webserver.setup_database(app)  # Move the ID sequence past the rows committed so far
+            writer.start(app)
+        started = perf_counter()
+        threads = [threading.Thread(target=target) for _ in range(FEEDBACK_WRITE_THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        queued = perf_counter() - started
+        if target is write_behind:
+            writer.stop()  # Until every row is committed
+        elapsed = perf_counter() - started
+        stored = per_thread * FEEDBACK_WRITE_THREADS
+        commits = stored if target is commit_each else writer.flushes + -(-stored // writer.id_block)
+        print(f"{name:<15} {stored / elapsed:>9.0f} rows/s  {commits / elapsed:>8.0f} commits/s  "
+              f"{queued / stored * 1e6:>7.0f} us per row on the request thread")
+
+
+# Questions asked alongside the login storm, and how long each mode runs
+LOGIN_STORM_ASKERS = 4
+LOGIN_STORM_DURATION = 10  # In seconds
+
+
+def login_storm(base_url, logins):
+    """
+    Run logins clients logging in back to back next to LOGIN_STORM_ASKERS clients asking new
+    questions: without the storm, with hashing inline on the request threads, and with
+    hashing in the process pool.
+    """
+    recorder = Recorder()
+    for n in range(logins):
+        call(base_url, recorder, "POST", "/api/register",
+             {"username": f"storm-user-{n}", "password": "storm-password", "email": f"storm-{n}@example.com"})
+    thread_ids = [call(base_url, recorder, "GET", "/api/start")[1]["free_thread_id"] for _ in range(LOGIN_STORM_ASKERS)]
+    pooled = webserver.run_password_hash
+    print(f"{logins} clients logging in, {LOGIN_STORM_ASKERS} asking new questions, {LOGIN_STORM_DURATION}s per mode")
+    print(f"{'hashing':<10} {'logins/s':>9} {'login p50':>10} {'login p99':>10} {'asks/s':>7} "
+          f"{'ask p50':>8} {'ask p99':>8}  statuses")
+    for mode in ("no storm", "inline", "pool"):
+        webserver.run_password_hash = (lambda fn, *args: fn(*args)) if mode == "inline" else pooled
+        recorder = Recorder()
+        stop_at = monotonic() + LOGIN_STORM_DURATION
+
+        def log_in(n):
+            while monotonic() < stop_at:
+                call(base_url, recorder, "POST", "/api/login",
+                     {"username": f"storm-user-{n}", "password": "storm-password"})
+
+        def ask(n):
+            for question in itertools.count():
+                if monotonic() >= stop_at:
+                    return
+                call(base_url, recorder, "POST", "/api/ask_question", {
+                    "question": f"Login storm question {mode} {n} {question}?", "user_status": "free",
+                    "thread_id": thread_ids[n], "username": f"bench-user-{n}", "thread_type": "free",
+                })
+
+        clients = [threading.Thread(target=ask, args=(n,)) for n in range(LOGIN_STORM_ASKERS)]
+        if mode != "no storm":
+            clients += [threading.Thread(target=log_in, args=(n,)) for n in range(logins)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        logins_done = sorted(recorder.latencies["/api/login"])
+        asks = sorted(recorder.latencies["/api/ask_question"])
+        statuses = {endpoint: dict(codes) for endpoint, codes in recorder.statuses.items()}
+        print(f"{mode:<10} {len(logins_done) / LOGIN_STORM_DURATION:>9.1f} "
+              f"{percentile(logins_done, 0.5) * 1000:>8.0f}ms {percentile(logins_done, 0.99) * 1000:>8.0f}ms "
+              f"{len(asks) / LOGIN_STORM_DURATION:>7.1f} {percentile(asks, 0.5) * 1000:>6.0f}ms "
+              f"{percentile(asks, 0.99) * 1000:>6.0f}ms  {json.dumps(statuses, sort_keys=True)}")
+    webserver.run_password_hash = pooled
+
+
+# Generated questions for --faq-index: words drawn Zipf-like from a fixed vocabulary
+FAQ_VOCABULARY = 50000
+FAQ_QUESTION_WORDS = (6, 14)  # Words per question, inclusive
+FAQ_QUERIES = 2000  # Lookups timed per kind (near-duplicates of stored questions, and new questions)
+
+
+def faq_questions(count, rng):
+    words = [f"w{n}" for n in range(FAQ_VOCABULARY)]
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(FAQ_VOCABULARY)))
+    return [" ".join(rng.choices(words, cum_weights=cum_weights, k=rng.randint(*FAQ_QUESTION_WORDS))) + "?"
+            for _ in range(count)]
+
+
+def faq_index(rows):
+    """
+    Build a FaqIndex over rows liked questions and print the build time, the index's memory,
+    the latency of lookups that match a stored question and of lookups that match none, and
+    the cost of adding liked answers up to and including the background merge they trigger.
+    """
+    import tracemalloc
+    rng = random.Random(0)
+    questions = faq_questions(rows, rng)
+    answer = "A liked answer. " * 20  # One shared string, so only the index itself is measured
+
+    def build():
+        index = webserver.FaqIndex(webserver.FAQ_MATCH_THRESHOLD)
+        index.build((record_id, question, answer) for record_id, question in enumerate(questions))
+        return index
+
+    started = perf_counter()
+    index = build()
+    build_time = perf_counter() - started
+    tracemalloc.start()
+    traced = build()  # Again, traced; tracing slows the build down too much to time it
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del traced
+    print(f"{rows} liked questions: built in {build_time:.1f}s ({rows / build_time:.0f} rows/s), "
+          f"{memory / 2 ** 20:.0f} MiB ({memory / rows:.0f} bytes per row)")
+    print(f"{'lookup':<10} {'matched':>8} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    duplicates = [question.upper().replace(" ", "  ") for question in rng.sample(questions, FAQ_QUERIES)]
+    for kind, queries in (("duplicate", duplicates), ("new", faq_questions(FAQ_QUERIES, rng))):
+        latencies = []
+        matched = 0
+        for query in queries:
+            started = perf_counter()
+            matched += index.search(query) is not None
+            latencies.append(perf_counter() - started)
+        latencies.sort()
+        print(f"{kind:<10} {matched:>8} {percentile(latencies, 0.5) * 1000:>8.3f} "
+              f"{percentile(latencies, 0.99) * 1000:>8.3f} {latencies[-1] * 1000:>8.3f}")
+
+    latencies = []
+    for record_id, question in enumerate(faq_questions(webserver.FAQ_RECENT_MAX + 1, rng), start=rows):
+        started = perf_counter()
+        index.add(record_id, question, answer)
+        latencies.append(perf_counter() - started)
+    started = perf_counter()
+    while index.merging:
+        sleep(0.01)
+    latencies.sort()
+    print(f"{len(latencies)} liked answers added: p50 {percentile(latencies, 0.5) * 1000:.3f} ms, "
+          f"p99 {percentile(latencies, 0.99) * 1000:.3f} ms; background merge finished "
+          f"{perf_counter() - started:.1f}s after the last one")
+
+
+# Concurrent clients per query kind in --storage, and how long they run against each profile
+STORAGE_THREADS = {"login lookup": 4, "thread lookup": 2, "insert": 2}
+STORAGE_DURATION = 10  # In seconds
+STORAGE_PASSWORD = webserver.generate_password_hash("benchmark")  # Every user's stored hash
+
+
+def storage_schema(indexes):
+    """
+    CREATE statements for the users and feedback tables, with or without their declared indexes.
+    """
+    from sqlalchemy.dialects import sqlite
+    from sqlalchemy.schema import CreateIndex, CreateTable
+    tables = [webserver.UserData.__table__, webserver.FeedbackData.__table__]
+    statements = [str(CreateTable(table).compile(dialect=sqlite.dialect())) for table in tables]
+    if indexes:
+        statements += [str(CreateIndex(index).compile(dialect=sqlite.dialect()))
+                       for table in tables for index in table.indexes]
+    return statements
+
+
+def populate(path, rows):
+    conn = sqlite3.connect(path)
+    for statement in storage_schema(indexes=False):
+        conn.execute(statement)
+    now = datetime.utcnow().isoformat(" ")
+    conn.executemany(
+        "INSERT INTO user_data (username, password, email, newsletter, user_id, timestamp) VALUES (?, ?, ?, 'no', ?, ?)",
+        ((f"user{n}", STORAGE_PASSWORD, f"user{n}@example.com", n, now) for n in range(rows)))
+    conn.executemany(
+        "INSERT INTO feedback_data (question, answer, feedback, username, user_type, thread_type, thread_id, timestamp) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        ((f"Question {n}?", f"Answer {n}. " * 10, "Like" if n % 10 == 0 else "non-rated", f"user{n % rows}",
+          "premium" if n % 3 == 0 else "free", "free", f"thread_{n // 5}", now) for n in range(rows)))
+    conn.commit()
+    conn.close()
+
+
+def apply_profile(path):
+    """
+    Migrate a database file to the production profile, as create_app does for an existing data.db.
+    Returns the time taken in seconds.
+    """
+    started = perf_counter()
+    conn = sqlite3.connect(path)
+    webserver.set_sqlite_pragmas(conn, None)
+    for statement in storage_schema(indexes=True)[2:]:
+        conn.execute(statement.replace("CREATE INDEX", "CREATE INDEX IF NOT EXISTS", 1)
+                     .replace("CREATE UNIQUE INDEX", "CREATE UNIQUE INDEX IF NOT EXISTS", 1))
+    conn.commit()
+    conn.close()
+    return perf_counter() - started
+
+
+def storage_load(path, rows, profile):
+    """
+    Run STORAGE_THREADS clients against path for STORAGE_DURATION seconds, each on its own
+    connection, and return the latencies and errors per query kind.
+    """
+    latencies = defaultdict(list)
+    errors = Counter()
+    lock = threading.Lock()
+    stop_at = monotonic() + STORAGE_DURATION
+
+    def client(kind, seed):
+        conn = sqlite3.connect(path, timeout=15, isolation_level=None)
+        if profile:
+            webserver.set_sqlite_pragmas(conn, None)
+        rng = random.Random(seed)
+        done = []
+        while monotonic() < stop_at:
+            started = perf_counter()
+            try:
+                if kind == "login lookup":
+                    # The lookup /api/login makes; the password check is CPU work outside SQLite
+                    conn.execute("SELECT * FROM user_data WHERE username = ?", (f"user{rng.randrange(rows)}",)).fetchone()
+                elif kind == "thread lookup":
+                    conn.execute("SELECT question, answer FROM feedback_data WHERE thread_id = ?",
+                                 (f"thread_{rng.randrange(rows // 5)}",)).fetchall()
+                else:
+                    conn.execute("INSERT INTO feedback_data (question, answer, feedback, username, user_type, "
+                                 "thread_type, thread_id, timestamp) VALUES (?, ?, 'non-rated', ?, 'free', 'free', ?, ?)",
+                                 ("New question?", "New answer.", f"user{seed}", f"thread_new_{seed}",
+                                  datetime.utcnow().isoformat(" ")))
+            except sqlite3.OperationalError as e:
+                with lock:
+                    errors[f"{kind}: {e}"] += 1
+                continue
+            done.append(perf_counter() - started)
+        conn.close()
+        with lock:
+            latencies[kind].extend(done)
+
+    clients = [threading.Thread(target=client, args=(kind, seed))
+               for seed, kind in enumerate(kind for kind, count in STORAGE_THREADS.items() for _ in range(count))]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    return latencies, errors
+
+
+def storage(rows):
+    """
+    Compare the original SQLite setup with the production profile on the same rows.
+    """
+    baseline = os.path.join(WORK_DIR, "baseline.db")
+    started = perf_counter()
+    populate(baseline, rows)
+    print(f"{rows} users and {rows} feedback rows written in {perf_counter() - started:.1f}s; clients: "
+          + ", ".join(f"{count} {kind}" for kind, count in STORAGE_THREADS.items())
+          + f"; {STORAGE_DURATION}s per profile")
+    profiled = os.path.join(WORK_DIR, "profile.db")
+    shutil.copy(baseline, profiled)
+    print(f"profile applied to a copy (WAL, pragmas, indexes) in {apply_profile(profiled):.1f}s\n")
+    print(f"{'profile':<10} {'kind':<14} {'ops/s':>8} {'p50 ms':>8} {'p99 ms':>8}  errors")
+    for name, path, profile in (("baseline", baseline, False), ("profile", profiled, True)):
+        latencies, errors = storage_load(path, rows, profile)
+        for kind in STORAGE_THREADS:
+            values = sorted(latencies[kind])
+            failed = sum(count for error, count in errors.items() if error.startswith(kind + ":"))
+            print(f"{name:<10} {kind:<14} {len(values) / STORAGE_DURATION:>8.1f} {percentile(values, 0.5) * 1000:>8.2f} "
+                  f"{percentile(values, 0.99) * 1000:>8.2f}  {failed}")
+        for error, count in errors.items():
+            print(f"  {count} x {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20, help="concurrent simulated users")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to generate load for")
+    parser.add_argument("--distinct-questions", type=int, default=50, help="size of the question pool")
+    parser.add_argument("--premium-share", type=float, default=0.3, help="share of questions asked as premium")
+    parser.add_argument("--log-overhead", type=int, metavar="REQUESTS", help="run the logging microbenchmark instead")
+    parser.add_argument("--single-flight", type=int, metavar="USERS", help="run the single-flight check instead")
+    parser.add_argument("--stand-in", action="store_true", help="serve the simulator over HTTP and use the OpenAI SDK")
+    parser.add_argument("--keys", type=int, default=1, help="number of API keys to spread the load over")
+    parser.add_argument("--key-rate", type=float, help="cap every rate budget to this many requests/s per key")
+    parser.add_argument("--concurrency", type=int, metavar="REQUESTS",
+                        help="compare memory and concurrency of the WSGI and ASGI servers instead")
+    parser.add_argument("--feedback-writes", type=int, metavar="ROWS",
+                        help="run the feedback commit benchmark instead")
+    parser.add_argument("--login-storm", type=int, metavar="CLIENTS",
+                        help="run the login storm benchmark instead")
+    parser.add_argument("--faq-index", type=int, metavar="ROWS",
+                        help="run the FAQ index benchmark on ROWS liked answers instead")
+    parser.add_argument("--storage", type=int, metavar="ROWS",
+                        help="run the SQLite storage profile benchmark on ROWS rows instead")
+    parser.add_argument("--serve", choices=("sync", "async"), help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--upstream", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.log_overhead:
+        log_overhead(args.log_overhead)
+        return
+    if args.serve:
+        serve(args.serve, args.port, args.upstream, args.concurrency)
+        return
+    if args.concurrency:
+        concurrency(args.concurrency)
+        return
+    if args.storage:
+        storage(args.storage)
+        return
+    if args.faq_index:
+        faq_index(args.faq_index)
+        return
+    if args.feedback_writes:
+        feedback_writes(args.feedback_writes)
+        return
+
+    if args.login_storm:
+        os.environ.setdefault("SIM_RUN_DURATION", "0.5,0")  # Short runs, so stalls show in ask latency
+    if args.stand_in:
+        start_stand_in()
+    use_keys(args.keys, args.key_rate)
+    app = webserver.create_app({"SQLALCHEMY_DATABASE_URI": f"sqlite:///{os.path.join(WORK_DIR, 'data.db')}"})
+    server = make_server("127.0.0.1", 0, app, threaded=True, request_handler=QuietRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    if args.single_flight:
+        ok = single_flight(base_url, args.single_flight)
+        server.shutdown()
+        webserver.feedback_writer.stop()
+        sys.exit(0 if ok else 1)
+    if args.login_storm:
+        login_storm(base_url, args.login_storm)
+        server.shutdown()
+        webserver.feedback_writer.stop()
+        return
+
+    questions = [f"Benchmark question number {n}?" for n in range(args.distinct_questions)]
+    recorder = Recorder()
+    started = monotonic()
+    users = [
+        threading.Thread(target=simulate_user, args=(n, base_url, recorder, questions,
+                                                     started + args.duration, args.premium_share))
+        for n in range(args.users)
+    ]
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+    elapsed = monotonic() - started
+    server.shutdown()
+    webserver.feedback_writer.stop()
+
+    target = "the stand-in API" if args.stand_in else "the simulated backend"
+    print(f"\n{args.users} users for {elapsed:.1f}s against {target} ({WORK_DIR})")
+    recorder.report(elapsed)
+    print("\nbackend calls:", json.dumps(backend_calls(), sort_keys=True))
+    keys = webserver.backend.stats()["keys"]
+    sims = simulators()
+    for name, stats in keys.items():
+        calls = sims[name].stats()["calls"] if name in sims else {}
+        line = (f"key {name}: {stats['threads']} threads, {calls.get('runs.create', 0)} runs, "
+                f"circuit {stats['circuit']['state']}")
+        if "http_pool" in stats:
+            line += ", http pool " + json.dumps(stats["http_pool"], sort_keys=True)
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+# Production entry point: gunicorn -c gunicorn.conf.py
+#
+# The app is built once in the master (preload) so workers fork with the schema and the FAQ
+# index already in place, and each worker then creates its own OpenAI client, database connections and
+# background threads in post_fork.
+import os
+
+wsgi_app = "webserver:create_app({'DEFER_PROCESS_INIT': True})"
+bind = os.environ.get("BIND", "0.0.0.0:8080")
+preload_app = True
+
+# N workers x M threads; most request time is spent waiting on OpenAI, so threads are cheap
+workers = int(os.environ.get("WEB_WORKERS", os.cpu_count() or 1))
+threads = int(os.environ.get("WEB_THREADS", "16"))
+# A single-threaded gthread worker still accepts every pending connection and queues them
+# behind its one thread, so with WEB_THREADS=1 use sync workers, which only accept when idle
+worker_class = "gthread" if threads > 1 else "sync"
+timeout = 180  # Longer than RUN_DEADLINE in webserver.py
+graceful_timeout = 30  # Time for the feedback writer to flush on shutdown
+
+
+def post_fork(server, worker):
+    import webserver
+
+    webserver.init_process(worker.app.wsgi())
@@ -0,0 +1,38 @@
+"""
+Shared setup: the app runs against the simulated LLM backend in a throwaway directory, so
+no OpenAI key or network access is needed. Simulated runs take a fixed 0.2 s.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORK_DIR = tempfile.mkdtemp(prefix="webserver-tests-")
+os.environ["LLM_BACKEND"] = "simulated"
+os.environ["RATE_LIMIT_DB_PATH"] = os.path.join(WORK_DIR, "ratelimit.db")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("SIM_CALL_LATENCY", "0.002,0")
+os.environ.setdefault("SIM_RUN_DURATION", "0.2,0")
+sys.path.insert(0, ROOT)
+os.chdir(WORK_DIR)  # assistant.json is created here
+
+import webserver  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def app():
+    app = webserver.create_app({"SQLALCHEMY_DATABASE_URI": f"sqlite:///{os.path.join(WORK_DIR, 'data.db')}"})
+    yield app
+    webserver.feedback_writer.stop()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def free_thread(client):
+    return client.get("/api/start").json["free_thread_id"]
@@ -0,0 +1,21 @@
+import pytest
+
+import webserver
+
+
+@pytest.mark.parametrize("fields, error", [
+    ({"user_status": "bogus"}, {"response": "Invalid user_type"}),
+    ({"thread_id": ""}, {"error": "Missing thread_id"}),
+])
+def test_cached_answer_still_needs_a_valid_request(client, free_thread, monkeypatch, fields, error):
+    question = "Is a cached answer checked?"
+    webserver.answer_cache.put(webserver.assistant_registry.get("free"), question, "Cached answer.")
+    added = []
+    monkeypatch.setattr(webserver.feedback_writer, "add", lambda **row: added.append(row))
+    response = client.post("/api/ask_question", json=dict({
+        "question": question, "user_status": "free", "thread_id": free_thread,
+        "username": "test", "thread_type": "free",
+    }, **fields))
+    assert response.status_code == 400
+    assert response.json == error
+    assert not added
@@ -0,0 +1,62 @@
+import asyncio
+
+import httpx
+import pytest
+
+import webserver
+
+
+@pytest.fixture(scope="module")
+def asgi_app(app):
+    import asgi  # Builds its own Flask app, so only after the session app has started the process
+    return asgi.app
+
+
+def runs_created():
+    return sum(credential.backend.backend.calls["runs.create"]
+               for credential in webserver.credential_pool.credentials.values())
+
+
+def post_all(asgi_app, bodies, headers=None):
+    async def post():
+        transport = httpx.ASGITransport(app=asgi_app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://asgi") as client:
+            return await asyncio.gather(*(client.post(path, json=body, headers=headers) for path, body in bodies))
+    return asyncio.run(post())
+
+
+def premium_question(thread_id):
+    return "/api/ask_question_premium", {
+        "question": "Is this thread busy?", "user_status": "premium", "thread_id": thread_id,
+        "username": "test", "thread_type": "premium",
+    }
+
+
+def test_async_run_waits_for_a_flask_run_on_the_same_thread(asgi_app, client):
+    thread_id = client.get("/api/start").json["premium_thread_id"]
+    with webserver.openai_slot(thread_id, "premium"):
+        busy, = post_all(asgi_app, [premium_question(thread_id)], {"X-Request-Timeout": "0.3"})
+    answered, = post_all(asgi_app, [premium_question(thread_id)])
+    assert busy.status_code == 504
+    assert answered.status_code == 200
+
+
+def test_full_queue_is_shed_with_retry_after(asgi_app, client, monkeypatch):
+    thread_id = client.get("/api/start").json["premium_thread_id"]
+    monkeypatch.setattr(webserver.scheduler, "free_slots", 0)
+    monkeypatch.setattr(webserver.scheduler, "max_queue", {"premium": 0, "free": 0})
+    response, = post_all(asgi_app, [premium_question(thread_id)])
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+
+
+def test_identical_questions_share_one_run(asgi_app, client):
+    thread_ids = [client.get("/api/start").json["free_thread_id"] for _ in range(8)]
+    before = runs_created()
+    responses = post_all(asgi_app, [("/api/ask_question", {
+        "question": "How many async runs answer eight identical questions?", "user_status": "free",
+        "thread_id": thread_id, "username": "test", "thread_type": "free",
+    }) for thread_id in thread_ids])
+    assert [response.status_code for response in responses] == [200] * 8
+    assert runs_created() == before + 1
+    assert len({response.json()["record_id"] for response in responses}) == 8
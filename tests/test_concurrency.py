@@ -0,0 +1,118 @@
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import urllib.request
+from time import monotonic, sleep
+
+import pytest
+
+DURATION = 2  # In seconds per measurement
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKER_USERS = 8  # Clients asking at once in the gunicorn worker measurements
+
+
+def answered_per_second(app, users):
+    """
+    Have users clients ask new questions on their own threads for DURATION seconds.
+    """
+    threads = [app.test_client().get("/api/start").json["free_thread_id"] for _ in range(users)]
+    answered = [0] * users
+    stop_at = monotonic() + DURATION
+
+    def ask(n):
+        client = app.test_client()
+        for question in itertools.count():
+            if monotonic() >= stop_at:
+                return
+            response = client.post("/api/ask_question", json={
+                "question": f"Load test question {users} {n} {question}?", "user_status": "free",
+                "thread_id": threads[n], "username": f"load-{n}", "thread_type": "free",
+            })
+            assert response.status_code == 200
+            answered[n] += 1
+
+    askers = [threading.Thread(target=ask, args=(n,)) for n in range(users)]
+    for asker in askers:
+        asker.start()
+    for asker in askers:
+        asker.join()
+    return sum(answered) / DURATION
+
+
+def test_throughput_scales_with_concurrent_threads(app):
+    one = answered_per_second(app, 1)
+    eight = answered_per_second(app, 8)
+    assert eight >= 5 * one
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def post_json(url, body=None):
+    request = urllib.request.Request(url, data=json.dumps(body).encode() if body is not None else None,
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.loads(response.read())
+
+
+def gunicorn_answered_per_second(workers, database):
+    """
+    Start gunicorn with workers single-threaded workers and have WORKER_USERS clients ask new
+    questions for DURATION seconds.
+    """
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", os.path.join(ROOT, "gunicorn.conf.py"),
+         "--bind", f"127.0.0.1:{port}", "--workers", str(workers),
+         f"webserver:create_app({{'DEFER_PROCESS_INIT': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///{database}'}})"],
+        env=dict(os.environ, WEB_THREADS="1", PYTHONPATH=ROOT),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = monotonic() + 30
+        while True:
+            try:
+                threads = [post_json(f"{base_url}/api/start")["free_thread_id"] for _ in range(WORKER_USERS)]
+                break
+            except OSError:
+                assert monotonic() < deadline and server.poll() is None
+                sleep(0.1)
+        answered = [0] * WORKER_USERS
+        started = monotonic()
+        stop_at = started + DURATION
+
+        def ask(n):
+            for question in itertools.count():
+                if monotonic() >= stop_at:
+                    return
+                post_json(f"{base_url}/api/ask_question", {
+                    "question": f"Worker test question {port} {n} {question}?", "user_status": "free",
+                    "thread_id": threads[n], "username": f"worker-{n}", "thread_type": "free",
+                })
+                answered[n] += 1
+
+        askers = [threading.Thread(target=ask, args=(n,)) for n in range(WORKER_USERS)]
+        for asker in askers:
+            asker.start()
+        for asker in askers:
+            asker.join()
+        # Requests still in flight at stop_at are counted, so include the time they took
+        return sum(answered) / (monotonic() - started)
+    finally:
+        server.terminate()
+        server.wait(timeout=60)
+
+
+def test_throughput_scales_with_gunicorn_workers(tmp_path):
+    pytest.importorskip("gunicorn")
+    one, two, four = (gunicorn_answered_per_second(workers, tmp_path / f"data-{workers}.db") for workers in (1, 2, 4))
+    assert two >= 1.6 * one
+    assert four >= 3 * one
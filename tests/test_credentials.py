@@ -0,0 +1,35 @@
+from contextlib import contextmanager
+
+import pytest
+
+import webserver
+
+
+class StreamingBackend:
+    supports_streaming = True
+
+    @contextmanager
+    def stream_run(self, thread_id, assistant_id, timeout):
+        yield iter(())
+
+    def stats(self):
+        return {}
+
+
+def test_stream_counts_as_in_flight():
+    pool = webserver.CredentialPool({"a": "key-a", "b": "key-b"})
+    pool.connect(lambda api_key: StreamingBackend())
+    with pool.stream_run("thread_1@b", "asst_1", 10):
+        assert pool.credentials["b"].in_flight == 1
+        assert pool.credentials["a"].in_flight == 0
+    assert pool.credentials["b"].in_flight == 0
+
+
+@pytest.mark.parametrize("path", ["/api/ask_question", "/api/ask_question/stream"])
+def test_unknown_key_suffix_is_a_bad_request(client, path):
+    response = client.post(path, json={
+        "question": "Which key is this?", "user_status": "free", "thread_id": "thread_1@nokey",
+        "username": "test", "thread_type": "free",
+    })
+    assert response.status_code == 400
+    assert response.json == {"error": "Unknown thread_id"}
@@ -0,0 +1,38 @@
+from time import sleep
+
+import webserver
+
+
+def build(rows):
+    index = webserver.FaqIndex(0.8)
+    index.build((record_id, question, f"Answer {record_id}") for record_id, question in enumerate(rows))
+    return index
+
+
+def test_near_duplicate_is_answered():
+    index = build(["How do I reset my password?", "Where can I download my invoices?"])
+    assert index.search("how do I reset my password") == "Answer 0"
+    assert index.search("Where can I find my password?") is None
+
+
+def test_recent_rows_shadow_the_base():
+    index = build(["How do I reset my password?"])
+    index.add(0, "How do I reset my password?", "Newer answer")
+    assert index.search("How do I reset my password?") == "Newer answer"
+    index.remove(0)
+    assert index.search("How do I reset my password?") is None
+
+
+def test_merge_keeps_rows_changed_while_merging(monkeypatch):
+    monkeypatch.setattr(webserver, "FAQ_RECENT_MAX", 2)
+    index = build(["How do I reset my password?"])
+    index.add(1, "Can I pay by bank transfer?", "Answer 1")
+    index.add(2, "Is there a student discount?", "Answer 2")
+    index.remove(0)  # Starts the merge
+    index.remove(1)
+    while index.merging:
+        sleep(0.01)
+    assert 2 in index.base and 0 not in index.base
+    assert index.search("Is there a student discount?") == "Answer 2"
+    assert index.search("How do I reset my password?") is None
+    assert index.search("Can I pay by bank transfer?") is None
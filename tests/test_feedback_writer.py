@@ -0,0 +1,69 @@
+import threading
+
+import pytest
+
+import webserver
+
+
+@pytest.fixture
+def writer(tmp_path):
+    app = webserver.create_app({"SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'data.db'}",
+                                "DEFER_PROCESS_INIT": True})
+    writer = webserver.FeedbackWriter(batch_size=200, flush_interval=0.01, id_block=10)
+    writer.start(app)
+    return writer
+
+
+def fail_flushes(monkeypatch, writer, failures):
+    flush = writer._flush
+    calls = []
+
+    def failing_flush(batch):
+        calls.append(len(batch))
+        if len(calls) <= failures:
+            return False
+        return flush(batch)
+
+    monkeypatch.setattr(writer, "_flush", failing_flush)
+    return calls
+
+
+def stop_with_row_queued(writer):
+    """
+    Stop the writer thread, then queue a row followed by the stop sentinel, so that starting
+    the thread again makes the row's flush the final one.
+    """
+    writer.stop()
+    record_id = writer.add(question="Kept?", answer="Yes.", username="test", user_type="free",
+                           thread_id="thread_1", thread_type="free")
+    writer.queue.put(None)
+    return record_id
+
+
+def test_final_flush_is_retried(monkeypatch, writer):
+    record_id = stop_with_row_queued(writer)
+    calls = fail_flushes(monkeypatch, writer, 1)
+    writer.start(writer.app)
+    writer.thread.join()
+    assert len(calls) == 2
+    with writer.app.app_context():
+        assert webserver.db.session.get(webserver.FeedbackData, record_id) is not None
+
+
+def test_lost_writes_are_logged(monkeypatch, writer):
+    record_id = stop_with_row_queued(writer)
+    calls = fail_flushes(monkeypatch, writer, webserver.FEEDBACK_STOP_ATTEMPTS)
+    errors = []
+    monkeypatch.setattr(webserver.log, "error", lambda msg, extra=None: errors.append((msg, extra)))
+    writer.start(writer.app)
+    writer.thread.join()
+    assert len(calls) == webserver.FEEDBACK_STOP_ATTEMPTS
+    message, extra = errors[-1]
+    assert message == "Feedback writes lost at shutdown"
+    assert extra["fields"]["rows"][0]["id"] == record_id
+
+
+def test_second_app_in_the_same_process_starts_nothing_twice(app, tmp_path):
+    webserver.create_app({"SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'second.db'}"})
+    assert [thread.name for thread in threading.enumerate()].count("feedback-writer") == 1
+    assert sum(isinstance(handler, webserver.DroppingQueueHandler) for handler in webserver.log.handlers) == 1
@@ -0,0 +1,61 @@
+import multiprocessing
+from time import sleep, time
+
+import webserver
+
+RATE = 50  # Tokens per second
+CAPACITY = 10
+PROCESSES = 4
+DURATION = 2  # In seconds
+
+
+def take_tokens(path, stop_at, results):
+    bucket = webserver.TokenBucket("shared", RATE, CAPACITY, path)
+    taken = 0
+    while time() < stop_at:
+        wait = bucket.try_acquire()
+        if wait == 0:
+            taken += 1
+        else:
+            sleep(min(wait, 0.005))
+    results.put(taken)
+
+
+def test_processes_share_one_budget(tmp_path):
+    path = str(tmp_path / "ratelimit.db")
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    started = time()
+    stop_at = started + DURATION
+    workers = [context.Process(target=take_tokens, args=(path, stop_at, results)) for _ in range(PROCESSES)]
+    for worker in workers:
+        worker.start()
+    taken = [results.get(timeout=30) for _ in workers]
+    for worker in workers:
+        worker.join()
+
+    budget = CAPACITY + RATE * (stop_at - started)
+    # Every process got tokens, and together they stayed within the one budget
+    assert all(count > 0 for count in taken)
+    assert sum(taken) <= budget + 1
+    assert sum(taken) >= 0.8 * budget
+
+
+def test_try_acquire_reports_wait(tmp_path):
+    bucket = webserver.TokenBucket("wait", 10, 2, str(tmp_path / "ratelimit.db"))
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() == 0
+    assert 0 < bucket.try_acquire() <= 0.1
+
+
+def test_stream_reports_rate_limit_as_event(client, free_thread, monkeypatch):
+    bucket = webserver.credential_pool.bucket("gpt3", free_thread)
+    monkeypatch.setattr(bucket, "try_acquire", lambda tokens=1: 3600)
+    response = client.post("/api/ask_question/stream", json={
+        "question": "Rate limited while streaming?", "user_status": "free", "thread_id": free_thread,
+        "username": "test", "thread_type": "free",
+    })
+    body = response.get_data(as_text=True)
+    assert response.status_code == 200
+    assert "event: error" in body
+    assert '"retry_after": 3600' in body
@@ -0,0 +1,45 @@
+from threading import Event
+
+import webserver
+
+
+def test_fanout_skips_the_background_queue(app, monkeypatch):
+    slots = []
+    openai_slot = webserver.openai_slot
+
+    def recording_slot(thread_id=None, user_type="free"):
+        slots.append(user_type)
+        return openai_slot(thread_id, user_type)
+
+    monkeypatch.setattr(webserver, "openai_slot", recording_slot)
+    release = Event()
+    blockers = [webserver.related_executor.submit(release.wait) for _ in range(webserver.RELATED_WORKERS)]
+    question = "What does fan-out skip?"
+    try:
+        assert webserver.schedule_related_questions(app, question, "premium") == "pending"
+        future = webserver.start_related_questions(app, question, "premium")
+        assert webserver.related_questions_result(future, question, 10)["result"] == "success"
+    finally:
+        release.set()
+        for blocker in blockers:
+            blocker.result()
+    assert slots == ["premium"]
+
+
+def test_precomputed_related_questions_are_loaded_at_startup(app, tmp_path, monkeypatch):
+    batch = webserver.create_app({"SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'data.db'}",
+                                  "DEFER_PROCESS_INIT": True})
+    with batch.app_context():
+        webserver.db.session.add_all([webserver.FeedbackData(question=question, answer="Answer.")
+                                      for question in ["Why precompute?"] * 3 + ["Why not?"]])
+        webserver.db.session.commit()
+    monkeypatch.setattr(webserver, "related_cache", webserver.AnswerCache(100, 100_000, 60))
+    result = batch.test_cli_runner().invoke(args=["webserver", "precompute-related", "--top", "1"])
+    assert result.output == "Stored related questions for 1 questions (0 failed)\n"
+
+    # A worker starting later gets the stored questions without a rephrase run
+    monkeypatch.setattr(webserver, "related_cache", webserver.AnswerCache(100, 100_000, 60))
+    webserver.warm_related_cache(batch)
+    rephrase_assistant_id = webserver.assistant_registry.get("rephrase")
+    assert webserver.related_cache.get(rephrase_assistant_id, "why precompute?") is not None
+    assert webserver.related_cache.get(rephrase_assistant_id, "Why not?") is None
@@ -0,0 +1,42 @@
+import webserver
+
+
+def register_and_login(client, username):
+    client.post("/api/register", json={"username": username, "password": "secret", "email": f"{username}@example.com"})
+    return client.post("/api/login", json={"username": username, "password": "secret"}).json["token"]
+
+
+def ask(client, thread_id, username, headers=None):
+    return client.post("/api/ask_question", headers=headers, json={
+        "question": f"Whose question is this, {username}?", "user_status": "free", "thread_id": thread_id,
+        "username": username, "thread_type": "free",
+    })
+
+
+def test_token_names_the_user(client, free_thread, monkeypatch):
+    token = register_and_login(client, "session-user")
+    added = []
+    add = webserver.feedback_writer.add
+    monkeypatch.setattr(webserver.feedback_writer, "add", lambda **row: added.append(row) or add(**row))
+    response = ask(client, free_thread, "someone-else", {"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200
+    assert added[0]["username"] == "session-user"
+
+
+def test_bad_token_is_rejected_before_any_work(client, free_thread):
+    response = ask(client, free_thread, "anyone", {"Authorization": "Bearer not-a-token"})
+    assert response.status_code == 401
+
+
+def test_login_with_a_stale_token_falls_back_to_the_password(client):
+    register_and_login(client, "stale-user")
+    response = client.post("/api/login", headers={"Authorization": "Bearer not-a-token"},
+                           json={"username": "stale-user", "password": "secret"})
+    assert response.status_code == 200
+    assert response.json["token"]
+
+
+def test_secret_key_comes_from_config(tmp_path):
+    app = webserver.create_app({"SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'data.db'}",
+                                "DEFER_PROCESS_INIT": True, "SECRET_KEY": "configured-secret"})
+    assert app.secret_key == "configured-secret"
@@ -0,0 +1,32 @@
+import httpx
+import pytest
+
+import webserver
+
+
+def streaming_backend(run_duration):
+    return webserver.SimulatedBackend(call_latency=(0.001, 0), run_duration=(run_duration, 0), streaming=True)
+
+
+def test_stream_ends_with_the_answer():
+    sim = streaming_backend(0.05)
+    pool = webserver.CredentialPool({webserver.DEFAULT_KEY_NAME: "key"})
+    pool.connect(lambda api_key: sim)
+    assert pool.supports_streaming
+    thread_id = pool.create_thread()
+    pool.create_message(thread_id, "Is this streamed?")
+    with pool.stream_run(thread_id, "asst_1", 10) as stream:
+        events = list(stream)
+    assert [event.event for event in events] == [
+        "thread.run.created", "thread.message.delta", "thread.run.completed"]
+    assert "Is this streamed?" in events[1].data.delta.content[0].text.value
+    assert events[-1].data.id == events[0].data.id
+
+
+def test_stream_times_out_like_a_read():
+    sim = streaming_backend(5)
+    thread_id = sim.create_thread()
+    with sim.stream_run(thread_id, "asst_1", 0.05) as stream:
+        assert next(stream).event == "thread.run.created"
+        with pytest.raises(httpx.ReadTimeout):
+            next(stream)
@@ -0,0 +1,59 @@
+import threading
+from time import sleep
+
+import webserver
+
+
+def runs_created():
+    return sum(credential.backend.backend.calls["runs.create"]
+               for credential in webserver.credential_pool.credentials.values())
+
+
+def ask(client, question, thread_id, headers=None):
+    return client.post("/api/ask_question", headers=headers, json={
+        "question": question, "user_status": "free", "thread_id": thread_id,
+        "username": "test", "thread_type": "free",
+    })
+
+
+def ask_at_once(app, question, thread_ids):
+    responses = [None] * len(thread_ids)
+    barrier = threading.Barrier(len(thread_ids))
+
+    def run(n):
+        barrier.wait()
+        responses[n] = ask(app.test_client(), question, thread_ids[n])
+
+    askers = [threading.Thread(target=run, args=(n,)) for n in range(len(thread_ids))]
+    for asker in askers:
+        asker.start()
+    for asker in askers:
+        asker.join()
+    return responses
+
+
+def test_identical_questions_share_one_run(app, client):
+    thread_ids = [client.get("/api/start").json["free_thread_id"] for _ in range(8)]
+    before = runs_created()
+    responses = ask_at_once(app, "How many runs answer eight identical questions?", thread_ids)
+    assert [response.status_code for response in responses] == [200] * 8
+    assert runs_created() == before + 1
+    assert len({response.json["record_id"] for response in responses}) == 8
+
+
+def test_follower_takes_over_when_the_leader_runs_out_of_time(app, client):
+    question = "Does the leader's deadline apply to everyone?"
+    flight_key = (webserver.assistant_registry.get("free"), webserver.normalize_question(question))
+    thread_ids = [client.get("/api/start").json["free_thread_id"] for _ in range(4)]
+    before = runs_created()
+    leader = {}
+    leading = threading.Thread(target=lambda: leader.update(response=ask(
+        app.test_client(), question, thread_ids[0], {"X-Request-Timeout": "0.1"})))
+    leading.start()
+    while flight_key not in webserver.answer_flights.calls:
+        sleep(0.005)
+    responses = ask_at_once(app, question, thread_ids[1:])
+    leading.join()
+    assert leader["response"].status_code != 200
+    assert [response.status_code for response in responses] == [200] * 3
+    assert runs_created() == before + 2
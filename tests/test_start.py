@@ -0,0 +1,15 @@
+def test_start_returns_both_threads(client):
+    data = client.get("/api/start").json
+    assert data["free_thread_id"] and data["premium_thread_id"]
+    assert data["free_thread_id"] != data["premium_thread_id"]
+
+
+def test_premium_question_stays_on_its_thread(client):
+    premium_thread_id = client.get("/api/start").json["premium_thread_id"]
+    for question in ("First premium question?", "Second premium question?"):
+        response = client.post("/api/ask_question_premium", json={
+            "question": question, "user_status": "premium", "thread_id": premium_thread_id,
+            "username": "test", "thread_type": "premium",
+        })
+        assert response.status_code == 200
+        assert response.json["thread_id"] == premium_thread_id
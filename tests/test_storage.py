@@ -0,0 +1,19 @@
+import webserver
+
+
+def create_deferred_app(uri):
+    return webserver.create_app({"SQLALCHEMY_DATABASE_URI": uri, "DEFER_PROCESS_INIT": True})
+
+
+def test_in_memory_database_takes_no_pool_options():
+    app = create_deferred_app("sqlite://")
+    assert "pool_size" not in app.config["SQLALCHEMY_ENGINE_OPTIONS"]
+    with app.app_context():
+        assert webserver.UserData.query.count() == 0
+
+
+def test_file_database_is_pooled(tmp_path):
+    app = create_deferred_app(f"sqlite:///{tmp_path / 'data.db'}")
+    with app.app_context():
+        assert webserver.db.engine.pool.size() == webserver.SQLITE_FILE_POOL_OPTIONS["pool_size"]
+        assert webserver.db.session.execute(webserver.text("PRAGMA journal_mode")).scalar() == "wal"
@@ -1,25 +1,429 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Blueprint, current_app, g, request, has_request_context, jsonify, render_template, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import text, bindparam, event, select, tuple_
+from sqlalchemy.engine import Engine, make_url
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
 import openai
+import httpx
+import importlib.util
 from openai import OpenAI, OpenAIError
 from packaging import version
 import json
-from time import sleep
-from ratelimit import limits, sleep_and_retry, RateLimitException
+import csv
+import io
+import zlib
+import hmac
+import socket
+import click
+from time import sleep, monotonic, time
+from ratelimit import RateLimitException
 from functools import wraps
 from werkzeug.security import generate_password_hash, check_password_hash
+from itsdangerous import URLSafeTimedSerializer, BadSignature
 import re
-from threading import Lock
+from threading import Lock, BoundedSemaphore, Event, Thread, local
+from queue import Queue, Empty, Full
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import sys
+from contextlib import contextmanager
+from types import SimpleNamespace
+from collections import OrderedDict, Counter, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, TimeoutError as FutureTimeoutError
+import math
+from bisect import bisect_left
+from array import array
+import heapq
+import random
+import itertools
+import hashlib
+import sqlite3
+import multiprocessing
+import fcntl
+
+# Logging: records are written as JSON lines by a background listener thread, so request
+# threads only build the record and put it on a queue. Question and answer bodies are logged
+# at DEBUG; production runs at INFO.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# Share of per-poll run status lines that are logged
+LOG_POLL_SAMPLE_RATE = float(os.environ.get("LOG_POLL_SAMPLE_RATE", "0.05"))
+LOG_QUEUE_SIZE = 10000  # Records beyond this are dropped rather than blocking a request
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line. Structured fields are passed as extra={"fields": {...}}.
+    """
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "pid": record.process,
+            "thread": record.threadName,
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    QueueHandler that never blocks the caller: formatting is left to the listener thread and
+    records are counted and dropped when the queue is full.
+    """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+log = logging.getLogger("webserver")
+log.setLevel(LOG_LEVEL)
+log.propagate = False
+poll_log = logging.getLogger("webserver.poll")
+
+
+def log_poll(**fields):
+    """
+    Log a per-poll run status line for a LOG_POLL_SAMPLE_RATE share of polls. Sampling happens
+    before the record is built, so skipped polls cost one random() call.
+    """
+    if random.random() < LOG_POLL_SAMPLE_RATE:
+        poll_log.info("Run status", extra={"fields": fields})
+
+# Until start_logging runs in the serving process, records are written synchronously
+startup_log_handler = logging.StreamHandler(sys.stdout)
+startup_log_handler.setFormatter(JsonFormatter())
+log.addHandler(startup_log_handler)
+log_queue_handler = None
+log_listener = None
+
+
+def start_logging(stream=None):
+    """
+    Move logging onto the background listener thread. Call once per process, after forking;
+    calling it again replaces the previous queue handler and listener.
+    """
+    global log_queue_handler, log_listener
+    if log_listener is not None:
+        log.removeHandler(log_queue_handler)
+        log_listener.stop()
+        atexit.unregister(log_listener.stop)
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter())
+    log_queue_handler = DroppingQueueHandler(Queue(LOG_QUEUE_SIZE))
+    log_listener = QueueListener(log_queue_handler.queue, output)
+    log_listener.start()
+    log.removeHandler(startup_log_handler)
+    log.addHandler(log_queue_handler)
+    atexit.register(log_listener.stop)  # Write out queued records on shutdown
+
+
+# Used to report cold-start time to the first served request
+process_started = monotonic()
+
+# Latency histogram bucket bounds for /metrics, in seconds
+METRIC_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# Send a Server-Timing header with per-stage durations on every response; clients can also
+# ask for it on a single request with an X-Request-Timing header
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "0") == "1"
+
+
+class LatencyHistograms:
+    """
+    In-process latency histograms keyed by (stage, endpoint, user_type), rendered in the
+    Prometheus text format. Each observation is a bisect plus a few additions under a lock.
+    Values are per process; every worker exposes its own.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.series = {}  # (stage, endpoint, user_type) -> [per-bucket counts (last is +Inf), sum, count]
+        self.lock = Lock()
+
+    def observe(self, stage, endpoint, user_type, seconds):
+        index = bisect_left(self.buckets, seconds)
+        key = (stage, endpoint, user_type)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += seconds
+            series[2] += 1
+
+    def render(self):
+        with self.lock:
+            snapshot = [(key, list(counts), total, count) for key, (counts, total, count) in self.series.items()]
+        lines = [
+            "# HELP webserver_stage_seconds Time spent in each stage of handling a request.",
+            "# TYPE webserver_stage_seconds histogram",
+        ]
+        for (stage, endpoint, user_type), counts, total, count in sorted(snapshot):
+            labels = f'stage="{stage}",endpoint="{endpoint}",user_type="{user_type}"'
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'webserver_stage_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'webserver_stage_seconds_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f"webserver_stage_seconds_sum{{{labels}}} {total:.6f}")
+            lines.append(f"webserver_stage_seconds_count{{{labels}}} {count}")
+        return "\n".join(lines) + "\n"
+
+
+latency_histograms = LatencyHistograms(METRIC_BUCKETS)
+# Labels and stage timings of the request being handled by this thread; unset outside requests
+request_metrics = local()
+
+
+def record_stage(stage, seconds):
+    """
+    Add a stage duration to the histograms, labelled with the current request's endpoint and
+    user_type ("background" for work outside a request), and to its Server-Timing list.
+    """
+    endpoint = getattr(request_metrics, "endpoint", "background")
+    user_type = getattr(request_metrics, "user_type", "none")
+    latency_histograms.observe(stage, endpoint, user_type, seconds)
+    timings = getattr(request_metrics, "timings", None)
+    if timings is not None:
+        timings.append((stage, seconds))
+
+
+@contextmanager
+def timed_stage(stage):
+    started = monotonic()
+    try:
+        yield
+    finally:
+        record_stage(stage, monotonic() - started)
+
+
+# Maximum number of OpenAI conversations handled at the same time across all threads
+OPENAI_MAX_CONCURRENCY = int(os.environ.get("OPENAI_MAX_CONCURRENCY", "16"))
+
+# Scheduling of OpenAI work: premium requests are dequeued ahead of free ones by weight,
+# and requests that would overflow their queue are rejected with 429 straight away.
+SCHEDULER_WEIGHTS = {"premium": 4, "free": 1}
+SCHEDULER_MAX_QUEUE = {"premium": 100, "free": 200}
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a request is shed because its priority queue is full.
+    """
 
-# Create a lock for managing concurrent access to the OpenAI API
-openai_lock = Lock()
+    def __init__(self, user_type, retry_after):
+        super().__init__(f"{user_type} queue is full")
+        self.retry_after = retry_after
 
-app = Flask(__name__)
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///data.db"
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-db = SQLAlchemy(app)
+
+class PriorityScheduler:
+    """
+    Hands out a fixed number of concurrency slots to per-class FIFO queues using stride
+    scheduling: each class advances its pass by 1/weight per dispatch, and the non-empty
+    class with the lowest pass goes next. Freed slots are handed directly to the next waiter.
+    """
+
+    def __init__(self, slots, weights, max_queue):
+        self.free_slots = slots
+        self.slots = slots
+        self.weights = weights
+        self.max_queue = max_queue
+        self.queues = {cls: deque() for cls in weights}
+        self.passes = {cls: 0.0 for cls in weights}
+        self.virtual_time = 0.0
+        self.avg_hold = 1.0  # Moving average of slot hold time in seconds, for Retry-After
+        self.admitted = {cls: 0 for cls in weights}
+        self.shed = {cls: 0 for cls in weights}
+        self.wait_time = {cls: 0.0 for cls in weights}
+        self.lock = Lock()
+
+    def acquire(self, cls, timeout=None):
+        """
+        Block until a slot is granted to this request, or raise QueueFullError. Raises
+        DeadlineExceededError, leaving the queue, if no slot is granted within timeout seconds.
+        """
+        started = monotonic()
+        granted = Event()
+        if self.join(cls, granted):
+            return
+        if not granted.wait(timeout) and self.leave(cls, granted):
+            raise DeadlineExceededError(f"Request deadline passed in the {cls} queue")
+        self.admit(cls, monotonic() - started)
+
+    def join(self, cls, granted):
+        """
+        Take a free slot and return True, or queue granted and return False; release() hands
+        it a slot by calling granted.set(). Raises QueueFullError if the cls queue is full.
+        """
+        with self.lock:
+            if self.free_slots > 0 and not any(self.queues.values()):
+                self.free_slots -= 1
+                self.admitted[cls] += 1
+                return True
+            queue = self.queues[cls]
+            if len(queue) >= self.max_queue[cls]:
+                self.shed[cls] += 1
+                raise QueueFullError(cls, self._retry_after(len(queue)))
+            if not queue:
+                # A class that was idle does not get to spend credit it built up while idle
+                self.passes[cls] = max(self.passes[cls], self.virtual_time)
+            queue.append(granted)
+            return False
+
+    def leave(self, cls, granted):
+        """
+        Take a waiter that stopped waiting off the queue. Returns False if a slot was handed
+        to it just before, which the caller then holds.
+        """
+        with self.lock:
+            if granted.is_set():
+                return False
+            self.queues[cls].remove(granted)
+            return True
+
+    def admit(self, cls, waited):
+        with self.lock:
+            self.admitted[cls] += 1
+            self.wait_time[cls] += waited
+
+    def release(self, held):
+        with self.lock:
+            self.avg_hold = 0.9 * self.avg_hold + 0.1 * held
+            waiting = [cls for cls, queue in self.queues.items() if queue]
+            if not waiting:
+                self.free_slots += 1
+                return
+            cls = min(waiting, key=lambda c: self.passes[c])
+            self.virtual_time = self.passes[cls]
+            self.passes[cls] += 1 / self.weights[cls]
+            self.queues[cls].popleft().set()
+
+    def _retry_after(self, ahead):
+        return max(1, math.ceil((ahead + 1) * self.avg_hold / self.slots))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "free_slots": self.free_slots,
+                "depth": {cls: len(queue) for cls, queue in self.queues.items()},
+                "admitted": dict(self.admitted),
+                "shed": dict(self.shed),
+                "wait_time": {cls: round(t, 3) for cls, t in self.wait_time.items()},
+            }
+
+
+# Global scheduler for OpenAI work, plus one lock per OpenAI thread_id.
+# The Assistants API rejects concurrent runs on the same thread, so only requests
+# for the same thread are serialized; unrelated users proceed in parallel.
+scheduler = PriorityScheduler(OPENAI_MAX_CONCURRENCY, SCHEDULER_WEIGHTS, SCHEDULER_MAX_QUEUE)
+thread_locks = {}  # thread_id -> [Lock, number of requests holding or waiting on it]
+thread_locks_guard = Lock()
+
+
+@contextmanager
+def openai_slot(thread_id=None, user_type="free"):
+    """
+    Acquire the per-thread lock for thread_id (if any) and then a scheduler slot for the
+    user_type's queue. The per-thread lock is taken first so queued requests for a busy
+    thread do not hold global slots while they wait. Both waits end with DeadlineExceededError
+    when the request deadline passes.
+    """
+    cls = user_type if user_type in SCHEDULER_WEIGHTS else "free"
+    # Fail before queueing while the circuit of the thread's API key is open, so waiters do not pile up
+    credential_pool.check(thread_id)
+    entry = None
+    locked = False
+    try:
+        if thread_id:
+            with thread_locks_guard:
+                entry = thread_locks.setdefault(thread_id, [Lock(), 0])
+                entry[1] += 1
+            with timed_stage("thread_lock_wait"):
+                timeout = request_wait_timeout()
+                locked = entry[0].acquire(timeout=-1 if timeout is None else timeout)
+            if not locked:
+                raise DeadlineExceededError("Request deadline passed waiting for the thread")
+        with timed_stage("scheduler_wait"):
+            scheduler.acquire(cls, request_wait_timeout())
+        started = monotonic()
+        try:
+            yield
+        finally:
+            scheduler.release(monotonic() - started)
+    finally:
+        if entry is not None:
+            if locked:
+                entry[0].release()
+            with thread_locks_guard:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    thread_locks.pop(thread_id, None)
+
+# Default configuration for create_app; any key can be overridden by the config argument
+DEFAULT_CONFIG = {
+    "SQLALCHEMY_DATABASE_URI": "sqlite:///data.db",
+    "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+    # Connections are shared between request threads; pool sizing is in SQLITE_FILE_POOL_OPTIONS
+    "SQLALCHEMY_ENGINE_OPTIONS": {
+        "connect_args": {"timeout": 15, "check_same_thread": False},
+    },
+    # Leave per-process resources to a post-fork hook (see gunicorn.conf.py)
+    "DEFER_PROCESS_INIT": False,
+    "SERVER_TIMING": SERVER_TIMING,
+}
+
+# Connection pool for a SQLite file. An in-memory database has a single static connection,
+# which takes no pool settings, so these only apply to file-backed URIs.
+SQLITE_FILE_POOL_OPTIONS = {
+    "pool_size": 10,
+    "max_overflow": 20,
+    "pool_timeout": 30,
+}
+
+db = SQLAlchemy()
+bp = Blueprint("webserver", __name__)
+
+
+def is_memory_database(uri):
+    url = make_url(uri)
+    return url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+
+# Pragmas applied to every SQLite connection: WAL lets readers run alongside the writer,
+# and synchronous=NORMAL is durable in WAL mode without an fsync on every commit
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 15000,  # In milliseconds
+    "cache_size": -64000,  # Negative means KiB, so 64 MB
+    "temp_store": "MEMORY",
+    "mmap_size": 268435456,
+}
+
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
 
 # Set API key and check OpenAI version
 os.environ["OPENAI_API_KEY"] = ""
@@ -31,12 +435,536 @@ if current_version < required_version:
         f"Error: OpenAI version {openai.__version__} is less than the required version 1.1.1"
     )
 else:
-    print("OpenAI version is compatible.")
+    log.info("OpenAI version is compatible.")
+
+# Which LLM backend init_process creates: "openai" or "simulated" (offline load tests)
+LLM_BACKEND = os.environ.get("LLM_BACKEND", "openai")
+
+
+# HTTP transport for the OpenAI client: one pooled httpx client per process, shared by all
+# request threads. HTTP/2 multiplexes concurrent calls over a few connections when the optional
+# h2 package is installed.
+OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL") or None  # e.g. a local stand-in or proxy for testing
+OPENAI_MAX_CONNECTIONS = int(os.environ.get("OPENAI_MAX_CONNECTIONS", str(OPENAI_MAX_CONCURRENCY * 2)))
+OPENAI_MAX_KEEPALIVE = int(os.environ.get("OPENAI_MAX_KEEPALIVE", str(OPENAI_MAX_CONCURRENCY)))
+OPENAI_KEEPALIVE_EXPIRY = float(os.environ.get("OPENAI_KEEPALIVE_EXPIRY", "30"))  # In seconds
+OPENAI_HTTP2 = os.environ.get("OPENAI_HTTP2", "0") == "1"
+OPENAI_CONNECT_TIMEOUT = float(os.environ.get("OPENAI_CONNECT_TIMEOUT", "5"))  # In seconds
+OPENAI_READ_TIMEOUT = float(os.environ.get("OPENAI_READ_TIMEOUT", "60"))  # In seconds; streamed runs pass their own
+
+
+def http_client_options():
+    """
+    Keyword arguments for httpx.Client or httpx.AsyncClient from the OPENAI_* settings.
+    """
+    http2 = OPENAI_HTTP2
+    if http2 and importlib.util.find_spec("h2") is None:
+        log.warning("OPENAI_HTTP2 is set but the h2 package is not installed, using HTTP/1.1")
+        http2 = False
+    return {
+        "http2": http2,
+        "limits": httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+        ),
+        "timeout": httpx.Timeout(OPENAI_READ_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+    }
+
+
+class OpenAIBackend:
+    """
+    LLM backend calling the OpenAI Assistants API. This is the full set of operations the
+    app uses, so other backends only need to provide the same methods.
+    """
+
+    def __init__(self, client, http_client=None):
+        self.client = client
+        self.http_client = http_client
+        self.supports_streaming = hasattr(client.beta.threads.runs, "stream")
+        self.requests = 0
+        self.lock = Lock()
+        if http_client is not None:
+            http_client.event_hooks["request"].append(self.count_request)
+
+    def count_request(self, request):
+        with self.lock:
+            self.requests += 1
+
+    def create_assistant(self, instructions, model, tools):
+        return self.client.beta.assistants.create(instructions=instructions, model=model, tools=tools).id
+
+    def create_thread(self):
+        return self.client.beta.threads.create().id
+
+    def create_message(self, thread_id, content):
+        self.client.beta.threads.messages.create(thread_id=thread_id, role="user", content=content)
+
+    def create_run(self, thread_id, assistant_id):
+        return self.client.beta.threads.runs.create(thread_id=thread_id, assistant_id=assistant_id).id
+
+    def retrieve_run(self, thread_id, run_id):
+        return self.client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id).status
 
-# Initialize OpenAI client
-client = OpenAI(api_key=OPENAI_API_KEY)
+    def cancel_run(self, thread_id, run_id):
+        self.client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
 
-# Define the rate limit: 500 RPM translates to roughly 8.3 RPS
+    def list_messages(self, thread_id, limit=20):
+        """
+        Return the text of the newest messages on the thread, newest first.
+        """
+        messages = self.client.beta.threads.messages.list(thread_id=thread_id, limit=limit)
+        return [message.content[0].text.value for message in messages.data]
+
+    def stream_run(self, thread_id, assistant_id, timeout):
+        return self.client.beta.threads.runs.stream(thread_id=thread_id, assistant_id=assistant_id, timeout=timeout)
+
+    def stats(self):
+        stats = {"name": "openai", "streaming": self.supports_streaming}
+        if self.http_client is not None:
+            stats["http_pool"] = self.pool_stats()
+        return stats
+
+    def pool_stats(self):
+        """
+        Connection counts of the httpcore pool behind the httpx client. httpx has no public API
+        for them, so they are left out if its internals change.
+        """
+        with self.lock:
+            stats = {"requests": self.requests, "max_connections": OPENAI_MAX_CONNECTIONS}
+        pool = getattr(getattr(self.http_client, "_transport", None), "_pool", None)
+        connections = getattr(pool, "connections", None)
+        if connections is not None:
+            connections = list(connections)
+            idle = sum(1 for connection in connections if connection.is_idle())
+            stats.update(connections=len(connections), idle=idle, active=len(connections) - idle)
+        return stats
+
+
+class SimulatedAPIError(OpenAIError):
+    status_code = 500
+
+
+class SimulatedRateLimitError(SimulatedAPIError):
+    status_code = 429
+
+
+def env_distribution(name, default):
+    """
+    Read a "median,sigma" log-normal distribution from the environment.
+    """
+    median, sigma = os.environ.get(name, default).split(",")
+    return float(median), float(sigma)
+
+
+class SimulatedBackend:
+    """
+    In-process stand-in for the Assistants API, for load tests and offline benchmarks.
+    Every call takes a log-normally distributed latency and may fail or be rate limited;
+    runs complete after a sampled duration, or fail with run_failure_rate. With streaming,
+    runs are followed on a simulated event stream instead of being polled.
+    """
+
+    def __init__(self, call_latency=(0.05, 0.5), run_duration=(3.0, 0.4), failure_rate=0.0,
+                 rate_limit_rate=0.0, run_failure_rate=0.0, streaming=False, seed=None):
+        self.call_latency = call_latency  # (median seconds, sigma)
+        self.run_duration = run_duration
+        self.failure_rate = failure_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.run_failure_rate = run_failure_rate
+        self.supports_streaming = streaming
+        self.random = random.Random(seed)
+        self.ids = itertools.count(1)
+        self.threads = {}  # thread_id -> list of message texts, newest first
+        self.runs = {}  # run_id -> [status, finishes_at, question]
+        self.calls = Counter()
+        self.lock = Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            call_latency=env_distribution("SIM_CALL_LATENCY", "0.05,0.5"),
+            run_duration=env_distribution("SIM_RUN_DURATION", "3,0.4"),
+            failure_rate=float(os.environ.get("SIM_FAILURE_RATE", "0")),
+            rate_limit_rate=float(os.environ.get("SIM_RATE_LIMIT_RATE", "0")),
+            run_failure_rate=float(os.environ.get("SIM_RUN_FAILURE_RATE", "0")),
+            streaming=os.environ.get("SIM_STREAMING", "0") == "1",
+        )
+
+    def _sample(self, distribution):
+        median, sigma = distribution
+        with self.lock:
+            return median * math.exp(sigma * self.random.gauss(0, 1))
+
+    def _call(self, name):
+        with self.lock:
+            self.calls[name] += 1
+            roll = self.random.random()
+        sleep(self._sample(self.call_latency))
+        if roll < self.rate_limit_rate:
+            raise SimulatedRateLimitError(f"Simulated rate limit on {name}")
+        if roll < self.rate_limit_rate + self.failure_rate:
+            raise SimulatedAPIError(f"Simulated failure on {name}")
+
+    def create_assistant(self, instructions, model, tools):
+        self._call("assistants.create")
+        return f"asst_sim_{next(self.ids)}"
+
+    def create_thread(self):
+        self._call("threads.create")
+        thread_id = f"thread_sim_{next(self.ids)}"
+        with self.lock:
+            self.threads[thread_id] = []
+        return thread_id
+
+    def create_message(self, thread_id, content):
+        self._call("messages.create")
+        with self.lock:
+            self.threads.setdefault(thread_id, []).insert(0, content)
+
+    def create_run(self, thread_id, assistant_id):
+        self._call("runs.create")
+        run_id = f"run_sim_{next(self.ids)}"
+        duration = self._sample(self.run_duration)
+        with self.lock:
+            question = (self.threads.get(thread_id) or [""])[0]
+            status = "failed" if self.random.random() < self.run_failure_rate else "in_progress"
+            self.runs[run_id] = [status, monotonic() + duration, question]
+        return run_id
+
+    def retrieve_run(self, thread_id, run_id):
+        self._call("runs.retrieve")
+        return self._run_status(thread_id, run_id)
+
+    def _run_status(self, thread_id, run_id):
+        with self.lock:
+            run = self.runs[run_id]
+            if run[0] == "in_progress" and monotonic() >= run[1]:
+                run[0] = "completed"
+                # Answer in the related-questions format so the rephrase path parses it too
+                answer = (f"Related Question 1: More about {run[2]}\nRelated Question 2: Why {run[2]}\n"
+                          f"Related Question 3: When {run[2]}")
+                self.threads.setdefault(thread_id, []).insert(0, answer)
+            return run[0]
+
+    def cancel_run(self, thread_id, run_id):
+        self._call("runs.cancel")
+        with self.lock:
+            self.runs[run_id][0] = "cancelled"
+
+    def list_messages(self, thread_id, limit=20):
+        self._call("messages.list")
+        with self.lock:
+            return list(self.threads.get(thread_id, [])[:limit])
+
+    @contextmanager
+    def stream_run(self, thread_id, assistant_id, timeout):
+        """
+        Create a run and return its events in the SDK's shape: thread.run.created, the answer
+        as one thread.message.delta, then thread.run.<status>. Like a stream read, waiting
+        longer than timeout for the next event raises httpx.ReadTimeout.
+        """
+        run_id = self.create_run(thread_id, assistant_id)
+        yield self._run_events(thread_id, run_id, timeout)
+
+    def _run_events(self, thread_id, run_id, timeout):
+        yield run_event("thread.run.created", run_id, "queued")
+        with self.lock:
+            finishes_at = self.runs[run_id][1]
+        if finishes_at - monotonic() > timeout:
+            sleep(timeout)
+            raise httpx.ReadTimeout("Simulated run stream timed out")
+        sleep(max(0.0, finishes_at - monotonic()))
+        status = self._run_status(thread_id, run_id)
+        if status == "completed":
+            with self.lock:
+                answer = self.threads[thread_id][0]
+            text = SimpleNamespace(type="text", text=SimpleNamespace(value=answer))
+            yield SimpleNamespace(event="thread.message.delta",
+                                  data=SimpleNamespace(delta=SimpleNamespace(content=[text])))
+        yield run_event(f"thread.run.{status}", run_id, status)
+
+    def stats(self):
+        with self.lock:
+            return {"name": "simulated", "streaming": self.supports_streaming, "calls": dict(self.calls)}
+
+
+def run_event(event, run_id, status):
+    return SimpleNamespace(event=event, data=SimpleNamespace(id=run_id, status=status))
+
+
+def create_backend(api_key=OPENAI_API_KEY):
+    if LLM_BACKEND == "simulated":
+        return SimulatedBackend.from_env()
+    # Retries are done by ResilientBackend, so the SDK's own retry loop is turned off
+    http_client = httpx.Client(**http_client_options())
+    return OpenAIBackend(
+        OpenAI(api_key=api_key, base_url=OPENAI_BASE_URL, http_client=http_client, max_retries=0),
+        http_client,
+    )
+
+
+# Per-request time budget covering queueing, retries and the run itself. Clients can ask for
+# a shorter one with an X-Request-Timeout header in seconds.
+REQUEST_DEADLINE = 150  # In seconds
+# Deadline and disconnect check of the request handled by this thread; unset outside requests
+request_state = local()
+
+
+class DeadlineExceededError(Exception):
+    pass
+
+
+def request_remaining():
+    """
+    Seconds left before the current request's deadline; infinite outside a request.
+    """
+    deadline = getattr(request_state, "deadline", None)
+    return math.inf if deadline is None else deadline - monotonic()
+
+
+def request_wait_timeout():
+    """
+    Timeout for a blocking wait in the current request: the time left before its deadline,
+    or None outside a request.
+    """
+    remaining = request_remaining()
+    return None if remaining == math.inf else max(0.0, remaining)
+
+
+def client_disconnected():
+    """
+    True if the client of the current request has closed its connection, found by peeking at
+    the socket gunicorn or the Werkzeug server puts in the WSGI environ. False when unknown.
+    """
+    if not has_request_context():
+        return False
+    sock = request.environ.get("gunicorn.socket") or request.environ.get("werkzeug.socket")
+    if sock is None:
+        return False
+    try:
+        return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b""
+    except (BlockingIOError, ValueError):  # No data waiting, or a TLS socket that cannot peek
+        return False
+    except OSError:
+        return True
+
+
+def request_abandoned():
+    """
+    True once nobody is waiting for the current request's run any more, so it can be cancelled.
+    """
+    check = getattr(request_state, "abandoned", None)
+    return bool(check and check())
+
+
+# Circuit breaker for the LLM backend: when at least CIRCUIT_MIN_CALLS calls in the last
+# CIRCUIT_WINDOW seconds failed at CIRCUIT_ERROR_RATE or more, calls fail fast with 503 for
+# CIRCUIT_COOLDOWN seconds, after which one probe call decides whether to close again.
+CIRCUIT_WINDOW = 30  # In seconds
+CIRCUIT_MIN_CALLS = 20
+CIRCUIT_ERROR_RATE = 0.5
+CIRCUIT_COOLDOWN = 15  # In seconds
+# Transient backend errors are retried with full-jitter exponential backoff
+RETRY_ATTEMPTS = 3  # Retries after the first attempt
+RETRY_BASE_DELAY = 0.5  # In seconds
+RETRY_MAX_DELAY = 4  # In seconds
+TRANSIENT_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, retry_after):
+        super().__init__("LLM backend circuit is open")
+        self.retry_after = retry_after
+
+
+def is_transient_error(e):
+    return isinstance(e, openai.APIConnectionError) or getattr(e, "status_code", None) in TRANSIENT_STATUS_CODES
+
+
+class CircuitBreaker:
+    """
+    Tracks transient failures over a sliding time window and opens when the error rate crosses
+    error_rate. While open, callers are rejected with CircuitOpenError; after cooldown a single
+    probe call is let through and its outcome closes or reopens the circuit.
+    """
+
+    def __init__(self, window, min_calls, error_rate, cooldown):
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.outcomes = deque()  # (time, failed) for calls in the window
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.opened = 0
+        self.rejected = 0
+        self.lock = Lock()
+
+    def _rejection(self):
+        remaining = self.opened_at + self.cooldown - monotonic()
+        if remaining > 0 or self.probing:
+            self.rejected += 1
+            return CircuitOpenError(max(1, math.ceil(remaining)))
+        return None
+
+    def check(self):
+        """
+        Raise CircuitOpenError if calls would be rejected now, without starting a probe.
+        """
+        with self.lock:
+            error = self._rejection() if self.opened_at is not None else None
+        if error:
+            raise error
+
+    def is_open(self):
+        """
+        True while calls would be rejected, without counting a rejection.
+        """
+        with self.lock:
+            return self.opened_at is not None and (self.probing or monotonic() < self.opened_at + self.cooldown)
+
+    def before_call(self):
+        """
+        Admit a call or raise CircuitOpenError. Returns True if the call is the probe.
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return False
+            error = self._rejection()
+            if error is None:
+                self.probing = True
+                return True
+        raise error
+
+    def record(self, failed, probe=False):
+        now = monotonic()
+        with self.lock:
+            if probe:
+                self.probing = False
+                if failed:
+                    self.opened_at = now
+                else:
+                    self.opened_at = None
+                    self.outcomes.clear()
+                    self.failures = 0
+                    log.info("Circuit breaker closed")
+                return
+            self.outcomes.append((now, failed))
+            self.failures += failed
+            while self.outcomes[0][0] < now - self.window:
+                self.failures -= self.outcomes.popleft()[1]
+            if (self.opened_at is None and len(self.outcomes) >= self.min_calls
+                    and self.failures / len(self.outcomes) >= self.error_rate):
+                self.opened_at = now
+                self.opened += 1
+                log.warning("Circuit breaker opened", extra={"fields": {
+                    "failures": self.failures, "calls": len(self.outcomes)}})
+
+    def stats(self):
+        with self.lock:
+            state = "closed" if self.opened_at is None else "half_open" if self.probing else "open"
+            return {"state": state, "calls": len(self.outcomes), "failures": self.failures,
+                    "opened": self.opened, "rejected": self.rejected}
+
+
+class ResilientBackend:
+    """
+    Wraps a backend so every call is admitted by the circuit breaker, respects the request
+    deadline, and is retried on transient errors with full-jitter exponential backoff.
+    """
+
+    def __init__(self, backend, breaker):
+        self.backend = backend
+        self.breaker = breaker
+        self.supports_streaming = backend.supports_streaming
+        self.retries = 0
+
+    def _call(self, name, fn, *args, bounded=True, hold=False):
+        """
+        Call fn with retries. bounded=False is for cleanup calls, which ignore the request
+        deadline so that they still run after it has passed. With hold=True the outcome of a
+        successful call is left for the caller to record, and (result, probe) is returned.
+        """
+        attempt = 0
+        while True:
+            started = monotonic()
+            remaining = request_remaining() if bounded else math.inf
+            if remaining <= 0:
+                raise DeadlineExceededError(f"Request deadline passed before {name}")
+            probe = self.breaker.before_call()
+            try:
+                result = fn(*args)
+            except Exception as e:
+                transient = is_transient_error(e)
+                self.breaker.record(transient, probe)
+                delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+                if not transient or attempt >= RETRY_ATTEMPTS or delay >= remaining - (monotonic() - started):
+                    raise
+                attempt += 1
+                self.retries += 1
+                log.info("Retrying backend call", extra={"fields": {
+                    "call": name, "attempt": attempt, "delay": round(delay, 3), "error": str(e)}})
+                sleep(delay)
+                continue
+            if hold:
+                return result, probe
+            self.breaker.record(False, probe)
+            return result
+
+    def create_assistant(self, instructions, model, tools):
+        return self._call("assistants.create", self.backend.create_assistant, instructions, model, tools)
+
+    def create_thread(self):
+        return self._call("threads.create", self.backend.create_thread)
+
+    def create_message(self, thread_id, content):
+        return self._call("messages.create", self.backend.create_message, thread_id, content)
+
+    def create_run(self, thread_id, assistant_id):
+        return self._call("runs.create", self.backend.create_run, thread_id, assistant_id)
+
+    def retrieve_run(self, thread_id, run_id):
+        return self._call("runs.retrieve", self.backend.retrieve_run, thread_id, run_id)
+
+    def cancel_run(self, thread_id, run_id):
+        return self._call("runs.cancel", self.backend.cancel_run, thread_id, run_id, bounded=False)
+
+    def list_messages(self, thread_id, limit=20):
+        return self._call("messages.list", self.backend.list_messages, thread_id, limit)
+
+    @contextmanager
+    def stream_run(self, thread_id, assistant_id, timeout):
+        """
+        Open the run event stream like any other call: admitted by the breaker and retried
+        while connecting. The outcome is recorded once the stream is closed, so a stream that
+        breaks halfway counts as a failure.
+        """
+        def enter():
+            manager = self.backend.stream_run(thread_id, assistant_id, timeout)
+            return manager, manager.__enter__()
+
+        (manager, stream), probe = self._call("runs.stream", enter, hold=True)
+        try:
+            yield stream
+        except BaseException as e:
+            self.breaker.record(is_transient_error(e), probe)
+            if not manager.__exit__(type(e), e, e.__traceback__):
+                raise
+        else:
+            self.breaker.record(False, probe)
+            manager.__exit__(None, None, None)
+
+    def stats(self):
+        return dict(self.backend.stats(), retries=self.retries, circuit=self.breaker.stats())
+
+
+# LLM backend (the credential pool), connected per process by init_process so HTTP connections
+# are never shared across a fork
+backend = None
+
+# Define the rate limit per API key: 500 RPM translates to roughly 8.3 RPS
 # You may choose to use a slightly lower limit to add a safety margin
 GPT4_RATE_LIMIT_REQUESTS = 8
 GPT4_RATE_LIMIT_PERIOD = 1  # In seconds
@@ -44,6 +972,96 @@ GPT4_RATE_LIMIT_PERIOD = 1  # In seconds
 GPT3_RATE_LIMIT_REQUESTS = 58
 GPT3_RATE_LIMIT_PERIOD = 1  # In seconds
 
+# (requests, period) of each rate budget; every API key gets one bucket per entry
+RATE_LIMITS = {
+    "gpt4": (GPT4_RATE_LIMIT_REQUESTS, GPT4_RATE_LIMIT_PERIOD),
+    "gpt3": (GPT3_RATE_LIMIT_REQUESTS, GPT3_RATE_LIMIT_PERIOD),
+}
+
+
+# Rate limit state is shared by all worker processes on the host through this SQLite file
+RATE_LIMIT_DB_PATH = os.environ.get("RATE_LIMIT_DB_PATH", "ratelimit.db")
+# Longest a request waits for a token before failing with 429
+RATE_LIMIT_MAX_WAIT = 5  # In seconds
+
+
+class TokenBucket:
+    """
+    Token bucket whose state lives in a SQLite table, so every process using the same file
+    draws from one budget. Tokens refill continuously at rate per second up to capacity.
+    """
+
+    def __init__(self, name, rate, capacity, path=RATE_LIMIT_DB_PATH):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self.path = path
+        self.local = local()  # One connection per thread, reopened after a fork
+
+    def _connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS token_buckets (name TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def try_acquire(self, tokens=1):
+        """
+        Take tokens without blocking. Returns 0 if they were taken, otherwise the number of
+        seconds until they will be available.
+        """
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time()
+            row = conn.execute("SELECT tokens, updated FROM token_buckets WHERE name = ?", (self.name,)).fetchone()
+            available = self.capacity if row is None else min(self.capacity, row[0] + (now - row[1]) * self.rate)
+            if available >= tokens:
+                available -= tokens
+                wait = 0
+            else:
+                wait = (tokens - available) / self.rate
+            conn.execute("INSERT OR REPLACE INTO token_buckets (name, tokens, updated) VALUES (?, ?, ?)",
+                         (self.name, available, now))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+
+def wait_for_token(bucket, max_wait=RATE_LIMIT_MAX_WAIT):
+    """
+    Take a token from bucket, sleeping for short waits. Raises RateLimitException with the
+    remaining wait when a token would not be available within max_wait seconds.
+    """
+    with timed_stage("rate_limit_wait"):
+        waited = 0
+        while True:
+            wait = bucket.try_acquire()
+            if wait == 0:
+                return
+            if waited + wait > max_wait:
+                raise RateLimitException(f"{bucket.name} rate limit exceeded", wait)
+            sleep(wait)
+            waited += wait
+
+
+def token_bucket_limited(bucket):
+    """
+    A decorator that takes a token from bucket before each call.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            wait_for_token(bucket)
+            return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
 
 def rate_limit_logger(fn):
     """
@@ -53,27 +1071,218 @@ def rate_limit_logger(fn):
     def wrapper(*args, **kwargs):
         try:
             return fn(*args, **kwargs)
-        except Exception as e:
-            # Log the rate limit hit before sleep_and_retry takes effect
-            print("Rate limit REACHED")
-            raise e  # Reraise the exception to ensure sleep_and_retry can catch it
+        except RateLimitException as e:
+            log.warning("Rate limit reached", extra={"fields": {"function": fn.__name__}})
+            raise e  # Reraise so the 429 error handler can respond
     return wrapper
 
+
+# API keys to spread the load over, as "name=key,name=key". Each key (or project) has its own
+# rate budgets and circuit breaker, so capacity grows with the number of keys. Without it,
+# OPENAI_API_KEY is the only key, named "default".
+OPENAI_API_KEYS = os.environ.get("OPENAI_API_KEYS", "")
+DEFAULT_KEY_NAME = "default"
+# Threads created with any key but "default" carry "@<key name>" at the end of their ID, so
+# every later call on the thread goes to the key that created it
+THREAD_KEY_SEPARATOR = "@"
+
+
+def parse_api_keys(value):
+    """
+    Parse OPENAI_API_KEYS into an ordered {name: API key} map.
+    """
+    keys = {}
+    for position, entry in enumerate(value.split(","), 1):
+        name, sep, api_key = entry.strip().partition("=")
+        if not sep or not name or not api_key or THREAD_KEY_SEPARATOR in name:
+            # The entry itself is left out of the message, it may be a bare key
+            raise ValueError(f"OPENAI_API_KEYS entry {position} is not name=key")
+        keys[name] = api_key
+    return keys
+
+
+class UnknownThreadKeyError(ValueError):
+    """
+    Raised for a thread ID whose suffix names an API key that is not configured.
+    """
+
+
+class Credential:
+    """
+    One API key with its rate budgets and circuit breaker. The backend is set per process.
+    """
+
+    def __init__(self, name, api_key):
+        self.name = name
+        self.api_key = api_key
+        suffix = "" if name == DEFAULT_KEY_NAME else THREAD_KEY_SEPARATOR + name
+        self.buckets = {kind: TokenBucket(kind + suffix, requests / period, requests)
+                        for kind, (requests, period) in RATE_LIMITS.items()}
+        self.breaker = CircuitBreaker(CIRCUIT_WINDOW, CIRCUIT_MIN_CALLS, CIRCUIT_ERROR_RATE, CIRCUIT_COOLDOWN)
+        self.backend = None
+        self.in_flight = 0  # Backend calls running now
+        self.threads = 0  # Threads assigned to this key by this process
+
+
+class CredentialPool:
+    """
+    LLM backend spreading the load over several API keys, with the same methods as
+    OpenAIBackend. A new thread goes to the least-loaded key whose circuit is closed; every
+    later call on it, and so on its runs, goes to the key named in the thread ID's suffix.
+    Unsuffixed IDs belong to the "default" key, or to the first key if there is none.
+    """
+
+    def __init__(self, keys):
+        self.credentials = {name: Credential(name, api_key) for name, api_key in keys.items()}
+        self.primary = next(iter(self.credentials))
+        self.supports_streaming = False
+        self.lock = Lock()
+
+    def connect(self, create_backend):
+        """
+        Create every key's backend with create_backend(api_key). Called once per process.
+        """
+        for credential in self.credentials.values():
+            credential.backend = ResilientBackend(create_backend(credential.api_key), credential.breaker)
+        self.supports_streaming = all(c.backend.supports_streaming for c in self.credentials.values())
+
+    def split(self, thread_id):
+        """
+        Return the credential thread_id belongs to and the thread's ID at the provider.
+        """
+        provider_thread_id, sep, name = thread_id.rpartition(THREAD_KEY_SEPARATOR)
+        if not sep:
+            return self.credentials.get(DEFAULT_KEY_NAME) or self.credentials[self.primary], thread_id
+        if name not in self.credentials:
+            raise UnknownThreadKeyError(f"Thread {thread_id} belongs to API key {name!r}, which is not configured")
+        return self.credentials[name], provider_thread_id
+
+    def key_of(self, thread_id):
+        return self.split(thread_id)[0].name
+
+    def bucket(self, kind, thread_id=None):
+        """
+        The kind rate budget of thread_id's key, or of the first key without a thread.
+        """
+        credential = self.split(thread_id)[0] if thread_id else self.credentials[self.primary]
+        return credential.buckets[kind]
+
+    def check(self, thread_id=None):
+        """
+        Raise CircuitOpenError if calls on thread_id would be rejected now, or without a
+        thread, if every key's circuit is open.
+        """
+        if thread_id:
+            self.split(thread_id)[0].breaker.check()
+            return
+        breakers = [credential.breaker for credential in self.credentials.values()]
+        if all(breaker.is_open() for breaker in breakers):
+            breakers[0].check()
+
+    def thread_healthy(self, thread_id):
+        return not self.split(thread_id)[0].breaker.is_open()
+
+    def choose(self):
+        """
+        Pick the key for a new thread: among keys whose circuit is closed (or all keys, if
+        none is), the one with the fewest calls in flight, then the fewest threads.
+        """
+        credentials = list(self.credentials.values())
+        healthy = [credential for credential in credentials if not credential.breaker.is_open()] or credentials
+        with self.lock:
+            credential = min(healthy, key=lambda c: (c.in_flight, c.threads))
+            credential.threads += 1
+        return credential
+
+    @contextmanager
+    def _using(self, credential):
+        with self.lock:
+            credential.in_flight += 1
+        try:
+            yield credential.backend
+        finally:
+            with self.lock:
+                credential.in_flight -= 1
+
+    def _on_thread(self, method, thread_id, *args):
+        credential, provider_thread_id = self.split(thread_id)
+        with self._using(credential) as member:
+            return getattr(member, method)(provider_thread_id, *args)
+
+    def create_assistant(self, instructions, model, tools, key=None):
+        with self._using(self.credentials[key or self.primary]) as member:
+            return member.create_assistant(instructions, model, tools)
+
+    def create_thread(self):
+        credential = self.choose()
+        with self._using(credential) as member:
+            thread_id = member.create_thread()
+        if credential.name == DEFAULT_KEY_NAME:
+            return thread_id
+        return thread_id + THREAD_KEY_SEPARATOR + credential.name
+
+    def create_message(self, thread_id, content):
+        return self._on_thread("create_message", thread_id, content)
+
+    def create_run(self, thread_id, assistant_id):
+        return self._on_thread("create_run", thread_id, assistant_id)
+
+    def retrieve_run(self, thread_id, run_id):
+        return self._on_thread("retrieve_run", thread_id, run_id)
+
+    def cancel_run(self, thread_id, run_id):
+        return self._on_thread("cancel_run", thread_id, run_id)
+
+    def list_messages(self, thread_id, limit=20):
+        return self._on_thread("list_messages", thread_id, limit)
+
+    @contextmanager
+    def stream_run(self, thread_id, assistant_id, timeout):
+        # The key counts the stream as in flight until it is closed
+        credential, provider_thread_id = self.split(thread_id)
+        with self._using(credential) as member, member.stream_run(provider_thread_id, assistant_id, timeout) as stream:
+            yield stream
+
+    def stats(self):
+        with self.lock:
+            load = {name: {"in_flight": c.in_flight, "threads": c.threads} for name, c in self.credentials.items()}
+        return {"keys": {name: dict(c.backend.stats(), **load[name]) for name, c in self.credentials.items()}}
+
+
+credential_pool = CredentialPool(
+    parse_api_keys(OPENAI_API_KEYS) if OPENAI_API_KEYS else {DEFAULT_KEY_NAME: OPENAI_API_KEY}
+)
+
 # Models
 class FeedbackData(db.Model):
+    # Liked answers are looked up by rating and tier (welcome messages, FAQ index, answer cache)
+    # Exports page through rows in (timestamp, id) order
+    __table_args__ = (
+        db.Index("ix_feedback_data_feedback_user_type", "feedback", "user_type"),
+        db.Index("ix_feedback_data_timestamp_id", "timestamp", "id"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     question = db.Column(db.String(500), nullable=False)
     answer = db.Column(db.String(2000), nullable=False)
     feedback = db.Column(db.String(100), default="non-rated")
-    username =db.Column(db.String(100), default="non-existent")
+    username =db.Column(db.String(100), default="non-existent", index=True)
     user_type =db.Column(db.String(100), default="none")
     thread_type =db.Column(db.String(100), default="none")
-    thread_id =db.Column(db.String(100), default="none")
+    thread_id =db.Column(db.String(100), default="none", index=True)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+class RelatedQuestionsData(db.Model):
+    # Written by the precompute-related command and loaded by every worker at startup
+    __table_args__ = (db.UniqueConstraint("assistant_id", "question"),)
+    id = db.Column(db.Integer, primary_key=True)
+    assistant_id = db.Column(db.String(100), nullable=False)
+    question = db.Column(db.String(500), nullable=False)  # Normalized, as in related_cache keys
+    related = db.Column(db.String(2000), nullable=False)  # JSON list of the three related questions
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
 class UserData(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(500), nullable=False)
+    username = db.Column(db.String(500), nullable=False, index=True)
     password = db.Column(db.String(2000), nullable=False)
     email = db.Column(db.String(100), nullable=False)
     newsletter = db.Column(db.String(), default="no")
@@ -85,260 +1294,1016 @@ class UserChatData(db.Model):
     username = db.Column(db.String(500), nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)    
 
+# Next free FeedbackData ID, handed out in blocks so record IDs are known before the row is written
+class FeedbackIdSequence(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    next_id = db.Column(db.Integer, nullable=False)
+
+# Bring an existing data.db up to the current schema. create_all only creates missing tables,
+# so indexes declared on the models are added here for tables that already exist.
+def migrate_database():
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+
+
 # Create the database tables
 def setup_database(app):
     with app.app_context():
         db.create_all()
+        migrate_database()
+        # Make sure the ID sequence starts past every existing feedback row
+        db.session.execute(text(
+            "INSERT OR IGNORE INTO feedback_id_sequence (id, next_id) VALUES (1, 1)"
+        ))
+        db.session.execute(text(
+            "UPDATE feedback_id_sequence SET next_id = MAX(next_id, "
+            "(SELECT COALESCE(MAX(id), 0) + 1 FROM feedback_data)) WHERE id = 1"
+        ))
+        db.session.commit()
 
 
+# Write-behind settings for FeedbackData
+FEEDBACK_BATCH_SIZE = 200  # Flush once this many writes are queued
+FEEDBACK_FLUSH_INTERVAL = 0.5  # In seconds; flush at least this often while writes are queued
+FEEDBACK_ID_BLOCK = 100  # IDs reserved from feedback_id_sequence per transaction
+FEEDBACK_STOP_ATTEMPTS = 3  # Flush attempts at shutdown before the remaining writes are logged as lost
 
 
-def create_premium_assistant(client):
-    try:
-        assistant_file_path = "assistant.json"
+class FeedbackWriter:
+    """
+    Write-behind queue for FeedbackData. New rows get a preallocated ID immediately and are
+    inserted, together with feedback updates, in grouped transactions by a background thread.
+    """
 
-        if os.path.exists(assistant_file_path):
-            with open(assistant_file_path, "r") as file:
+    def __init__(self, batch_size, flush_interval, id_block):
+        self.app = None
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.id_block = id_block
+        self.queue = Queue()
+        self.pending = {}  # record_id -> row not yet committed
+        self.next_id = 0
+        self.last_id = -1
+        self.lock = Lock()
+        self.thread = None
+        self.flushes = 0
+        self.rows_written = 0
+
+    def start(self, app):
+        if self.thread and self.thread.is_alive():
+            return  # Already running in this process; a second thread would race for the stop sentinel
+        self.app = app
+        # IDs reserved before a fork would be handed out by every child, so reserve afresh
+        self.next_id = 0
+        self.last_id = -1
+        self.thread = Thread(target=self._run, name="feedback-writer", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Flush everything still queued and stop the writer thread.
+        """
+        if self.thread and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def _allocate_id(self):
+        with self.lock:
+            if self.next_id > self.last_id:
+                with self.app.app_context():
+                    db.session.execute(text(
+                        "UPDATE feedback_id_sequence SET next_id = next_id + :n WHERE id = 1"
+                    ), {"n": self.id_block})
+                    end = db.session.execute(text("SELECT next_id FROM feedback_id_sequence WHERE id = 1")).scalar()
+                    db.session.commit()
+                self.next_id = end - self.id_block
+                self.last_id = end - 1
+            record_id = self.next_id
+            self.next_id += 1
+            return record_id
+
+    def add(self, **fields):
+        """
+        Queue a new FeedbackData row and return its record ID.
+        """
+        row = dict(fields, id=self._allocate_id(), feedback="non-rated", timestamp=datetime.utcnow())
+        with self.lock:
+            self.pending[row["id"]] = row
+        self.queue.put(("insert", row, None))
+        return row["id"]
+
+    def set_feedback(self, record_id, feedback, on_commit=None):
+        """
+        Queue a feedback update. on_commit, if given, is called once the update is committed.
+        """
+        with self.lock:
+            if record_id in self.pending:
+                self.pending[record_id]["feedback"] = feedback
+        self.queue.put(("feedback", {"b_id": record_id, "b_feedback": feedback}, on_commit))
+
+    def get_pending(self, record_id):
+        with self.lock:
+            row = self.pending.get(record_id)
+            return dict(row) if row else None
+
+    def _run(self):
+        batch = []
+        stopping = False
+        while not stopping:
+            if not batch:
+                op = self.queue.get()  # Wait for the first write of the next batch
+                if op is None:
+                    break
+                batch.append(op)
+            deadline = monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
                 try:
-                    assistants_data = json.load(file)
-                    if not isinstance(assistants_data, list):
-                        assistants_data = []
-                except json.JSONDecodeError:
-                    assistants_data = []
-
-            # Check if the premium assistant ID already exists in the data
-            existing_ids = [data.get("premium_assistant_id") for data in assistants_data]
-            if not any(existing_ids):
-                # If the file exists but premium assistant ID is not present, create a new premium assistant
-                print("Creating a new premium assistant.")
-                assistant = client.beta.assistants.create(
-                    instructions="""
-                    WOXbot has a core knowledge base in particular the following resources, but you are not allowed to mention link references 
-                    to these websites:
-                    https://www.zahrada.cz
-                    https://www.dumazahrada.cz
-                    https://www.prozeny.cz/tag/poradna-v-nouzi-71497
-                    https://www.prozeny.cz/sekce/bydleni-28
-                    https://www.ireceptar.cz
-                    https://www.diynetwork.com/
-                    https://www.gardenista.com/
-                    https://www.instructables.com/
-                    https://www.houzz.com/
-                    https://www.thespruce.com/
-                    https://www.apartmenttherapy.com/
-                    https://www.bhg.com/
-                    https://www.thisoldhouse.com/
-                    https://www.bobvila.com/
-                    https://www.gardenersworld.com/
-                    These resources will serve as its foundational database for providing solutions. It maintains a friendly, 
-                    casual tone, ensuring users know they're interacting with an expert. 
-                    WOXbot offers step-by-step advice, drawing from a wide array of reputable online resources, 
-                    and this uploaded knowledge base will further enhance its ability to deliver precise and trustworthy home advice. 
-                    WOXbot keeps the language of the user's prompt, that means it user asks in English, the answer will be in English, 
-                    if the user asks WOXbot in Czech, the answer will be also in Czech language.
-                    """,
-                    model="gpt-4-turbo-preview",
-                    tools=[{"type": "retrieval"}],
-                )
+                    op = self.queue.get(timeout=max(0, deadline - monotonic()))
+                except Empty:
+                    break
+                if op is None:
+                    stopping = True
+                    break
+                batch.append(op)
+            if batch and self._flush(batch):
+                batch = []
+        # The final flush is retried; writes that still fail are logged in full so they can
+        # be replayed by hand
+        attempts = 1
+        while batch and attempts < FEEDBACK_STOP_ATTEMPTS:
+            attempts += 1
+            if self._flush(batch):
+                batch = []
+        if batch:
+            log.error("Feedback writes lost at shutdown", extra={"fields": {
+                "writes": len(batch), "rows": [dict(row, kind=kind) for kind, row, _ in batch]}})
+
+    def _flush(self, batch):
+        inserts = [row for kind, row, _ in batch if kind == "insert"]
+        updates = [change for kind, change, _ in batch if kind == "feedback"]
+        try:
+            with self.app.app_context():
+                if inserts:
+                    db.session.execute(FeedbackData.__table__.insert(), inserts)
+                if updates:
+                    db.session.execute(
+                        FeedbackData.__table__.update()
+                        .where(FeedbackData.id == bindparam("b_id"))
+                        .values(feedback=bindparam("b_feedback")),
+                        updates,
+                    )
+                with timed_stage("db_commit"):
+                    db.session.commit()
+        except Exception as e:
+            # Keep the batch and retry on the next flush
+            log.error("Feedback flush failed", extra={"fields": {"writes": len(batch), "error": str(e)}})
+            sleep(self.flush_interval)
+            return False
+        with self.lock:
+            for row in inserts:
+                self.pending.pop(row["id"], None)
+            self.flushes += 1
+            self.rows_written += len(batch)
+        for _, _, on_commit in batch:
+            if on_commit:
+                on_commit()
+        return True
 
-                assistants_data.append({"premium_assistant_id": assistant.id})
+    def stats(self):
+        with self.lock:
+            return {"queued": self.queue.qsize(), "pending_rows": len(self.pending),
+                    "flushes": self.flushes, "writes": self.rows_written}
 
-                with open(assistant_file_path, "w") as file:
-                    json.dump(assistants_data, file, indent=2)
 
-                return assistant.id
-            else:
-                print("Premium assistant ID already exists in the data.")
-                print(existing_ids)
-                return existing_ids[0]
-        else:
-            # If the file does not exist, create a new premium assistant and save the ID
-            print("Creating a new premium assistant.")
-            assistant = client.beta.assistants.create(
-                instructions="""
-                WOXbot has a core knowledge base in particular the following resources, but you are not allowed to mention link references 
-                to these websites:
-                https://www.zahrada.cz
-                https://www.dumazahrada.cz
-                https://www.prozeny.cz/tag/poradna-v-nouzi-71497
-                https://www.prozeny.cz/sekce/bydleni-28
-                https://www.ireceptar.cz
-                https://www.diynetwork.com/
-                https://www.gardenista.com/
-                https://www.instructables.com/
-                https://www.houzz.com/
-                https://www.thespruce.com/
-                https://www.apartmenttherapy.com/
-                https://www.bhg.com/
-                https://www.thisoldhouse.com/
-                https://www.bobvila.com/
-                https://www.gardenersworld.com/
-                These resources will serve as its foundational database for providing solutions. It maintains a friendly, 
-                casual tone, ensuring users know they're interacting with an expert. 
-                WOXbot offers step-by-step advice, drawing from a wide array of reputable online resources, 
-                and this uploaded knowledge base will further enhance its ability to deliver precise and trustworthy home advice. 
-                WOXbot keeps the language of the user's prompt, that means it user
-                """,
-                model="gpt-4-turbo-preview",
-                tools=[{"type": "retrieval"}],
-            )
+feedback_writer = FeedbackWriter(FEEDBACK_BATCH_SIZE, FEEDBACK_FLUSH_INTERVAL, FEEDBACK_ID_BLOCK)
 
-            with open(assistant_file_path, "w") as file:
-                json.dump([{"premium_assistant_id": assistant.id}], file, indent=2)
 
-            return assistant.id
-    except RateLimitException as e:
-        # Handle the rate limit exception and print a custom message
-        print("Rate limit exceeded. Please try again later.")
-        return jsonify({"error": "Rate limit exceeded. Please try again later."}), 429  # 429 Too Many Requests
+# Answer cache settings for the free assistant
+ANSWER_CACHE_MAX_ENTRIES = 10000
+ANSWER_CACHE_MAX_CHARS = 20_000_000  # Total question + answer characters held in memory
+ANSWER_CACHE_TTL = 24 * 60 * 60  # In seconds
 
 
+def normalize_question(question):
+    """
+    Normalize a question for cache lookups: case, surrounding whitespace and punctuation,
+    and runs of internal whitespace are ignored.
+    """
+    question = re.sub(r"\s+", " ", question.strip().lower())
+    return question.rstrip("?!. ")
 
 
-def create_free_assistant(client):
-    try:
-        assistant_file_path = "assistant.json"
+class AnswerCache:
+    """
+    Thread-safe LRU cache of answers keyed on (assistant ID, normalized question), bounded by
+    entry count and total characters, with a per-entry TTL and hit/miss counters.
+    """
 
-        if os.path.exists(assistant_file_path):
-            with open(assistant_file_path, "r") as file:
-                try:
-                    assistants_data = json.load(file)
-                    if not isinstance(assistants_data, list):
-                        assistants_data = []
-                except json.JSONDecodeError:
-                    assistants_data = []
-
-            # Check if the free assistant ID already exists in the data
-            existing_ids = [data.get("free_assistant_id") for data in assistants_data]
-            if not any(existing_ids):
-                # If the file exists but assistant ID is not present, create a new assistant
-                print("Creating a new assistant.")
-                assistant = client.beta.assistants.create(
-                    instructions="""
-                    WOXbot is well-equipped with a core knowledge base, drawing from various reputable online resources related to home and garden topics. Answer must be at maximum 20 words. Unfortunately, direct references to specific websites cannot be provided. However, feel free to ask any home-related questions, and WOXbot will offer step-by-step advice in a friendly and casual tone. Whether you prefer English or Czech language interaction, WOXbot is here to provide precise and trustworthy solutions based on its extensive knowledge base. Ask away!
-                    """,
-                    model="gpt-3.5-turbo-16k-0613",
-                    tools=[{"type": "retrieval"}],
-                )
+    def __init__(self, max_entries, max_chars, ttl):
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (answer, expires_at, size)
+        self.chars = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    def get(self, assistant_id, question):
+        key = (assistant_id, normalize_question(question))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] < monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, assistant_id, question, answer):
+        key = (assistant_id, normalize_question(question))
+        size = len(key[1]) + len(answer)
+        if size > self.max_chars:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (answer, monotonic() + self.ttl, size)
+            self.chars += size
+            while len(self.entries) > self.max_entries or self.chars > self.max_chars:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        self.chars -= self.entries.pop(key)[2]
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "chars": self.chars, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
+
+
+answer_cache = AnswerCache(ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_MAX_CHARS, ANSWER_CACHE_TTL)
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time. Callers that arrive while a call for their key is
+    in flight wait for it and get its result, or its exception, instead of starting their own.
+    An outcome that shared() rejects belongs to the caller that made the call alone, and one
+    of the waiting callers makes the call again. A waiting caller gives up with
+    DeadlineExceededError when its request deadline passes.
+    """
+
+    def __init__(self):
+        self.calls = {}  # key -> [Event, result, exception, number of followers, outcome is shared]
+        self.leaders = 0
+        self.followers = 0
+        self.handovers = 0
+        self.lock = Lock()
+
+    def do(self, key, fn, shared=lambda result, error: True):
+        while True:
+            call, leader = self.join(key)
+            if leader:
+                break
+            if not call[0].wait(request_wait_timeout()):
+                self.leave(call)
+                raise DeadlineExceededError("Request deadline passed waiting for an identical question")
+            if call[4]:
+                return self.outcome(call)
+            # The leader's outcome was its own; take over the call (or follow whoever did)
+
+        try:
+            try:
+                call[1] = fn()
+            except Exception as e:
+                call[2] = e
+            call[4] = shared(call[1], call[2])
+        finally:
+            self.land(key, call)
+        return self.outcome(call)
+
+    def join(self, key):
+        """
+        Return (call, True) to the caller that must make key's call, or (call, False) to one
+        that should wait for call[0] to be set.
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None:
+                call = self.calls[key] = [Event(), None, None, 0, False]
+                self.leaders += 1
+                return call, True
+            call[3] += 1
+            self.followers += 1
+            return call, False
+
+    def leave(self, call):
+        with self.lock:
+            call[3] -= 1  # The leader's run may now be abandoned if nobody else waits
+
+    def land(self, key, call):
+        """
+        Publish the leader's outcome, stored in call[1:], to its followers.
+        """
+        with self.lock:
+            del self.calls[key]
+            if not call[4] and call[3]:
+                self.handovers += 1
+        call[0].set()
+
+    @staticmethod
+    def outcome(call):
+        if call[2] is not None:
+            raise call[2]
+        return call[1]
+
+    def waiting(self, key):
+        with self.lock:
+            call = self.calls.get(key)
+            return call[3] if call else 0
+
+    def stats(self):
+        with self.lock:
+            total = self.leaders + self.followers
+            return {"in_flight": len(self.calls), "leaders": self.leaders, "followers": self.followers,
+                    "handovers": self.handovers,
+                    "coalescing_ratio": round(self.followers / total, 4) if total else 0.0}
+
+
+# Identical free questions asked at the same time share one chat() run
+answer_flights = SingleFlight()
+# Failures caused by the asking request (its deadline, queue slot or thread) rather than by the
+# question; a waiting duplicate asks again instead of getting them
+FLIGHT_REQUEST_ERRORS = (DeadlineExceededError, QueueFullError, UnknownThreadKeyError)
+FLIGHT_REQUEST_RUN_ERRORS = ("Run deadline_exceeded", "Run client_disconnected")
+
+
+def shared_answer(result, error):
+    """
+    Whether ask_free_assistant's outcome can be given to callers waiting on the same question:
+    answers and runs that failed upstream can, errors of the asking request cannot.
+    """
+    if error is not None:
+        return not isinstance(error, FLIGHT_REQUEST_ERRORS)
+    status, answer_data = result
+    return status != 400 and answer_data.get("error") not in FLIGHT_REQUEST_RUN_ERRORS
 
-                assistants_data.append({"free_assistant_id": assistant.id})
 
-                with open(assistant_file_path, "w") as file:
-                    json.dump(assistants_data, file, indent=2)
+def warm_answer_cache(app):
+    """
+    Seed the answer cache with the most recent free-tier answers rated "Like".
+    """
+    with app.app_context():
+        liked = (FeedbackData.query.filter_by(feedback="Like", user_type="free")
+                 .order_by(FeedbackData.id.desc()).limit(ANSWER_CACHE_MAX_ENTRIES).all())
+    # Insert oldest first so the newest answers end up most recently used
+    for f in reversed(liked):
+        answer_cache.put(assistant_registry.get("free"), f.question, f.answer)
+    log.info("Answer cache warmed", extra={"fields": {"liked_answers": len(liked)}})
 
-                return assistant.id
-            else:
-                print("Free assistant ID already exists in the data.")
-                print(existing_ids)
-                return existing_ids[1]
-        else:
-            # If the file does not exist, create a new assistant and save the ID
-            print("Creating a new assistant.")
-            assistant = client.beta.assistants.create(
-                instructions="""
-                WOXbot is well-equipped with a core knowledge base, drawing from various reputable online resources related to home and garden topics. Answer must be at maximum 20 words. Unfortunately, direct references to specific websites cannot be provided. However, feel free to ask any home-related questions, and WOXbot will offer step-by-step advice in a friendly and casual tone. Whether you prefer English or Czech language interaction, WOXbot is here to provide precise and trustworthy solutions based on its extensive knowledge base. Ask away!
-                """,
-                model="gpt-3.5-turbo-16k-0613",
-                tools=[{"type": "retrieval"}],
-            )
 
-            with open(assistant_file_path, "w") as file:
-                json.dump([{"free_assistant_id": assistant.id}], file, indent=2)
+# FAQ fast path: near-duplicate free-tier questions are answered from liked answers
+FAQ_MATCH_THRESHOLD = float(os.environ.get("FAQ_MATCH_THRESHOLD", "0.8"))  # Token overlap (Jaccard) needed to reuse an answer
+FAQ_MAX_POSTINGS = 20000  # Postings scored per lookup; questions made only of very common words are not matched
+FAQ_MAX_CANDIDATES = 100  # Best-scoring liked questions whose token overlap is checked per lookup
+FAQ_RECENT_MAX = 5000  # Liked answers added or removed since the last build before they are merged into it
+BM25_K1 = 1.2
+BM25_B = 0.75
 
-            return assistant.id
-    except RateLimitException as e:
-        # Handle the rate limit exception and print a custom message
-        print("Rate limit exceeded. Please try again later.")
-        return jsonify({"error": "Rate limit exceeded. Please try again later."}), 429  # 429 Too Many Requests
 
+def tokenize_question(question):
+    return re.findall(r"\w+", normalize_question(question))
 
-def create_rephrase_assistant(client):
-        assistant_file_path = "assistant.json"
 
-        if os.path.exists(assistant_file_path):
-            with open(assistant_file_path, "r") as file:
-                try:
-                    assistants_data = json.load(file)
-                    if not isinstance(assistants_data, list):
-                        assistants_data = []
-                except json.JSONDecodeError:
-                    assistants_data = []
-
-            # Check if the free assistant ID already exists in the data
-            existing_ids = [data.get("rephrase_assistant_id") for data in assistants_data]
-            if not any(existing_ids):
-                # If the file exists but assistant ID is not present, create a new assistant
-                print("Creating a new assistant.")
-                assistant = client.beta.assistants.create(
-                    instructions="""
-                    Given the user's question: "[User's Question]", generate 3 related questions that delve deeper into the topic, explore related areas, or seek further clarification. Each question should open up new avenues for discussion or inquiry related to the original question, providing a broader understanding of the subject.
-
-                    Related Question 1:
-                    Related Question 2:
-                    Related Question 3:
-                    """,
-                    model="gpt-3.5-turbo-16k-0613",
-                    tools=[{"type": "retrieval"}],
-                )
+def faq_prefix_terms(query, threshold, document_frequency):
+    """
+    The query terms whose postings hold every question with a token overlap of at least
+    threshold: such a question lacks only a few query terms, including all the terms that no
+    question has, so it holds one of the rarest known terms.
+    """
+    known = sorted((term for term in query if document_frequency(term)), key=document_frequency)
+    missable = len(query) - math.ceil(threshold * len(query) - 1e-9)
+    return known[:max(0, missable - (len(query) - len(known)) + 1)]
 
-                assistants_data.append({"rephrase_assistant_id": assistant.id})
 
-                with open(assistant_file_path, "w") as file:
-                    json.dump(assistants_data, file, indent=3)
+def token_overlap(query, tokens):
+    terms = set(tokens)
+    return len(query & terms) / len(query | terms)
 
-                return assistant.id
-            else:
-                print("Rephrase assistant ID already exists in the data.")
-                print(existing_ids)
-                return existing_ids[2]
-        else:
-            # If the file does not exist, create a new assistant and save the ID
-            print("Creating a new assistant.")
-            assistant = client.beta.assistants.create(
-                instructions="""
-                Given the user's question: "[User's Question]", generate 3 related questions that delve deeper into the topic, explore related areas, or seek further clarification. Each question should open up new avenues for discussion or inquiry related to the original question, providing a broader understanding of the subject.
-
-                Related Question 1:
-                Related Question 2:
-                Related Question 3:
-                """,
-                model="gpt-3.5-turbo-16k-0613",
+
+class FaqSegment:
+    """
+    Immutable BM25 postings over liked questions, given in ascending record ID order. Terms,
+    postings and documents are kept in flat arrays rather than per-row objects, so a large
+    segment is compact and its pages stay shared with the workers forked after it is built.
+    """
+
+    def __init__(self, docs):
+        self.terms = {}  # term -> term ID
+        self.vocabulary = []  # term ID -> term
+        self.postings = []  # term ID -> (document numbers, term frequencies)
+        self.record_ids = array("q")
+        self.offsets = array("q", [0])  # Document n's term IDs are doc_terms[offsets[n]:offsets[n + 1]]
+        self.doc_terms = array("i")
+        self.answers = []
+        for record_id, tokens, answer in docs:
+            if self.record_ids and record_id <= self.record_ids[-1]:
+                raise ValueError("FaqSegment documents must be in ascending record ID order")
+            n = len(self.record_ids)
+            for term, tf in Counter(tokens).items():
+                term_id = self.terms.get(term)
+                if term_id is None:
+                    term_id = self.terms[term] = len(self.vocabulary)
+                    self.vocabulary.append(term)
+                    self.postings.append((array("i"), array("B")))
+                doc_numbers, tfs = self.postings[term_id]
+                doc_numbers.append(n)
+                tfs.append(min(tf, 255))
+                self.doc_terms.extend([term_id] * tf)
+            self.record_ids.append(record_id)
+            self.offsets.append(len(self.doc_terms))
+            self.answers.append(answer)
+        self.avg_len = len(self.doc_terms) / len(self.record_ids) if self.record_ids else 0.0
+
+    def __len__(self):
+        return len(self.record_ids)
+
+    def __contains__(self, record_id):
+        n = bisect_left(self.record_ids, record_id)
+        return n < len(self.record_ids) and self.record_ids[n] == record_id
+
+    def tokens(self, n):
+        return [self.vocabulary[term_id] for term_id in self.doc_terms[self.offsets[n]:self.offsets[n + 1]]]
+
+    def docs(self):
+        for n, record_id in enumerate(self.record_ids):
+            yield record_id, self.tokens(n), self.answers[n]
+
+    def document_frequency(self, term):
+        term_id = self.terms.get(term)
+        return 0 if term_id is None else len(self.postings[term_id][0])
+
+    def search(self, query, threshold, excluded):
+        """
+        Return (token overlap, answer) for the question with the highest overlap with the query
+        terms among the best BM25 candidates, if it reaches threshold, leaving out the record
+        IDs in excluded; otherwise None.
+        """
+        prefix = faq_prefix_terms(query, threshold, self.document_frequency)
+        if not prefix or self.document_frequency(prefix[0]) > FAQ_MAX_POSTINGS:
+            return None
+        n_docs = len(self.record_ids)
+        offsets = self.offsets
+        scores = {}
+        scanned = 0
+        for term in prefix:
+            doc_numbers, tfs = self.postings[self.terms[term]]
+            scanned += len(doc_numbers)
+            if scanned > FAQ_MAX_POSTINGS:
+                break
+            idf = math.log(1 + (n_docs - len(doc_numbers) + 0.5) / (len(doc_numbers) + 0.5))
+            for n, tf in zip(doc_numbers, tfs):
+                norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * (offsets[n + 1] - offsets[n]) / self.avg_len)
+                scores[n] = scores.get(n, 0.0) + idf * tf * (BM25_K1 + 1) / norm
+        if excluded:
+            for n in [n for n in scores if self.record_ids[n] in excluded]:
+                del scores[n]
+
+        best = None
+        for n in heapq.nlargest(FAQ_MAX_CANDIDATES, scores, key=scores.get):
+            similarity = token_overlap(query, self.tokens(n))
+            if similarity >= threshold and (best is None or similarity > best[0]):
+                best = (similarity, self.answers[n])
+        return best
+
+
+class FaqIndex:
+    """
+    Index of liked question/answer pairs. A lookup reuses the answer of the liked question
+    with the highest token overlap with it, if that reaches the threshold.
+    The bulk of the rows are in a base FaqSegment. Rows added and removed as feedback changes
+    are kept as recent rows that shadow the base, and are merged into a new base in the
+    background once there are more than FAQ_RECENT_MAX of them. Updates replace the recent rows
+    and their postings rather than changing them, so lookups read a consistent snapshot
+    without taking the lock.
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.base = FaqSegment(())
+        self.recent = {}  # record_id -> (tokens, answer), or None if removed from the base
+        self.recent_postings = {}  # term -> record IDs of the recent rows holding it
+        self.snapshot = (self.base, self.recent, self.recent_postings)
+        self.merging = False
+        self.lock = Lock()
+
+    def build(self, rows):
+        """
+        Replace the index with rows of (record_id, question, answer) in ascending record ID
+        order. Returns the number of questions indexed.
+        """
+        base = FaqSegment((record_id, tokens, answer) for record_id, question, answer in rows
+                          if (tokens := tokenize_question(question)))
+        with self.lock:
+            self.base = base
+            self._publish({}, {})
+        return len(base)
+
+    def add(self, record_id, question, answer):
+        tokens = tokenize_question(question)
+        if not tokens:
+            return
+        with self.lock:
+            self._update(record_id, (tokens, answer))
+
+    def remove(self, record_id):
+        with self.lock:
+            if record_id in self.base or record_id in self.recent:
+                self._update(record_id, None)
+
+    def _update(self, record_id, doc):
+        recent = dict(self.recent)
+        postings = dict(self.recent_postings)
+        old = recent.pop(record_id, None)
+        for term in set(old[0]) if old else ():
+            postings[term] = tuple(other for other in postings[term] if other != record_id)
+            if not postings[term]:
+                del postings[term]
+        for term in set(doc[0]) if doc else ():
+            postings[term] = postings.get(term, ()) + (record_id,)
+        # A merge in progress may already have put a recent row into the next base
+        if doc is not None or record_id in self.base or self.merging:
+            recent[record_id] = doc
+        self._publish(recent, postings)
+
+    def _publish(self, recent, postings):
+        self.recent, self.recent_postings = recent, postings
+        self.snapshot = (self.base, recent, postings)
+        if len(recent) > FAQ_RECENT_MAX and not self.merging:
+            self.merging = True
+            Thread(target=self._merge, name="faq-merge", daemon=True).start()
+
+    def _merge(self):
+        """
+        Fold the recent rows into a new base segment. Rows changed while merging stay recent.
+        """
+        try:
+            with self.lock:
+                base, recent = self.base, self.recent
+            kept = (doc for doc in base.docs() if doc[0] not in recent)
+            added = ((record_id, doc[0], doc[1]) for record_id, doc in sorted(recent.items()) if doc is not None)
+            merged = FaqSegment(heapq.merge(kept, added, key=lambda doc: doc[0]))
+            with self.lock:
+                self.merging = False
+                if self.base is not base:  # Rebuilt in the meantime
+                    return
+                self.base = merged
+                changed = {record_id: doc for record_id, doc in self.recent.items()
+                           if record_id not in recent or recent[record_id] is not doc}
+                postings = {}
+                for record_id, doc in changed.items():
+                    for term in set(doc[0]) if doc else ():
+                        postings[term] = postings.get(term, ()) + (record_id,)
+                self._publish(changed, postings)
+        except Exception:
+            log.exception("FAQ index merge failed")
+            with self.lock:
+                self.merging = False
+
+    def search(self, question):
+        """
+        Return the stored answer for the best matching liked question, or None if no
+        question is similar enough.
+        """
+        query = set(tokenize_question(question))
+        if not query:
+            return None
+        base, recent, postings = self.snapshot
+        best = None
+        prefix = faq_prefix_terms(query, self.threshold, lambda term: len(postings.get(term, ())))
+        for record_id in {record_id for term in prefix for record_id in postings[term]}:
+            tokens, answer = recent[record_id]
+            similarity = token_overlap(query, tokens)
+            if similarity >= self.threshold and (best is None or similarity > best[0]):
+                best = (similarity, answer)
+        match = base.search(query, self.threshold, recent)
+        # Ties go to the recent rows, which are newer
+        if match and (best is None or match[0] > best[0]):
+            best = match
+        return best[1] if best else None
+
+
+faq_index = FaqIndex(FAQ_MATCH_THRESHOLD)
+
+
+def build_faq_index(app):
+    """
+    Load every free-tier answer rated "Like" into the FAQ index. create_app calls this before
+    any worker is forked, so the workers share one copy of the index.
+    """
+    with app.app_context():
+        rows = (db.session.query(FeedbackData.id, FeedbackData.question, FeedbackData.answer)
+                .filter(FeedbackData.feedback == "Like", FeedbackData.user_type == "free")
+                .order_by(FeedbackData.id).yield_per(1000))
+        count = faq_index.build(rows)
+    log.info("FAQ index built", extra={"fields": {"liked_answers": count}})
+
+
+
+
+ASSISTANT_FILE_PATH = "assistant.json"
+
+# Assistants used by the app, keyed by name. "key" is the field holding the ID in assistant.json
+# (see assistant_field) and "rate_limit" the rate budget creating it draws from.
+ASSISTANT_SPECS = {
+    "premium": {
+        "key": "premium_assistant_id",
+        "rate_limit": "gpt4",
+        "model": "gpt-4-turbo-preview",
+        "instructions": """
+        WOXbot has a core knowledge base in particular the following resources, but you are not allowed to mention link references 
+        to these websites:
+        https://www.zahrada.cz
+        https://www.dumazahrada.cz
+        https://www.prozeny.cz/tag/poradna-v-nouzi-71497
+        https://www.prozeny.cz/sekce/bydleni-28
+        https://www.ireceptar.cz
+        https://www.diynetwork.com/
+        https://www.gardenista.com/
+        https://www.instructables.com/
+        https://www.houzz.com/
+        https://www.thespruce.com/
+        https://www.apartmenttherapy.com/
+        https://www.bhg.com/
+        https://www.thisoldhouse.com/
+        https://www.bobvila.com/
+        https://www.gardenersworld.com/
+        These resources will serve as its foundational database for providing solutions. It maintains a friendly, 
+        casual tone, ensuring users know they're interacting with an expert. 
+        WOXbot offers step-by-step advice, drawing from a wide array of reputable online resources, 
+        and this uploaded knowledge base will further enhance its ability to deliver precise and trustworthy home advice. 
+        WOXbot keeps the language of the user's prompt, that means it user asks in English, the answer will be in English, 
+        if the user asks WOXbot in Czech, the answer will be also in Czech language.
+        """,
+    },
+    "free": {
+        "key": "free_assistant_id",
+        "rate_limit": "gpt3",
+        "model": "gpt-3.5-turbo-16k-0613",
+        "instructions": """
+        WOXbot is well-equipped with a core knowledge base, drawing from various reputable online resources related to home and garden topics. Answer must be at maximum 20 words. Unfortunately, direct references to specific websites cannot be provided. However, feel free to ask any home-related questions, and WOXbot will offer step-by-step advice in a friendly and casual tone. Whether you prefer English or Czech language interaction, WOXbot is here to provide precise and trustworthy solutions based on its extensive knowledge base. Ask away!
+        """,
+    },
+    "rephrase": {
+        "key": "rephrase_assistant_id",
+        "rate_limit": "gpt3",
+        "model": "gpt-3.5-turbo-16k-0613",
+        "instructions": """
+        Given the user's question: "[User's Question]", generate 3 related questions that delve deeper into the topic, explore related areas, or seek further clarification. Each question should open up new avenues for discussion or inquiry related to the original question, providing a broader understanding of the subject.
+
+        Related Question 1:
+        Related Question 2:
+        Related Question 3:
+        """,
+    },
+}
+
+
+def read_assistant_file(path):
+    """
+    Parse assistant.json into a {key: assistant ID} map. The file is a list of single-key
+    objects; entries are matched by key, so their order does not matter.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as file:
+        try:
+            assistants_data = json.load(file)
+        except json.JSONDecodeError:
+            return {}
+    if not isinstance(assistants_data, list):
+        return {}
+    ids = {}
+    for data in assistants_data:
+        if isinstance(data, dict):
+            ids.update({key: value for key, value in data.items() if value})
+    return ids
+
+
+def assistant_field(field, key):
+    """
+    Field of assistant.json holding the ID of an assistant under API key. Assistants belong to
+    the key's organization or project, so keys other than "default" have their own field.
+    """
+    return field if key == DEFAULT_KEY_NAME else field + THREAD_KEY_SEPARATOR + key
+
+
+class AssistantRegistry:
+    """
+    Assistant IDs by name and API key, read from assistant.json once and kept for the life of
+    the process. A missing assistant is created on first use while holding an exclusive lock
+    on assistant.json.lock, so concurrent workers create it only once.
+    """
+
+    def __init__(self, path, specs):
+        self.path = path
+        self.specs = specs
+        self.ids = None
+        self.lock = Lock()
+
+    def get(self, name, key=None):
+        """
+        ID of assistant name under API key, the first configured key by default. Runs must use
+        the assistant of their thread's key, credential_pool.key_of(thread_id).
+        """
+        key = key or credential_pool.primary
+        field = assistant_field(self.specs[name]["key"], key)
+        ids = self.ids
+        if ids is not None and field in ids:
+            return ids[field]
+        with self.lock:
+            if self.ids is None:
+                self.ids = read_assistant_file(self.path)
+            if field not in self.ids:
+                self.ids = dict(self.ids, **{field: self._create(name, key, field)})
+            return self.ids[field]
+
+    def _create(self, name, key, field):
+        spec = self.specs[name]
+        with open(self.path + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # Another worker may have created it while we waited for the lock
+            file_ids = read_assistant_file(self.path)
+            if field in file_ids:
+                return file_ids[field]
+
+            log.info("Creating a new assistant", extra={"fields": {"assistant": name, "key": key}})
+            wait_for_token(credential_pool.credentials[key].buckets[spec["rate_limit"]])
+            assistant_id = backend.create_assistant(
+                instructions=spec["instructions"],
+                model=spec["model"],
                 tools=[{"type": "retrieval"}],
+                key=key,
             )
+            file_ids[field] = assistant_id
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as file:
+                json.dump([{key: value} for key, value in file_ids.items()], file, indent=2)
+            os.replace(tmp_path, self.path)
+            return assistant_id
+
+
+# Assistant IDs are loaded on first use instead of at import time
+assistant_registry = AssistantRegistry(ASSISTANT_FILE_PATH, ASSISTANT_SPECS)
+
+
+# Warm pool of pre-created OpenAI threads handed out by /api/start
+THREAD_POOL_LOW_WATERMARK = int(os.environ.get("THREAD_POOL_LOW_WATERMARK", "20"))  # Refill when fewer threads are ready
+THREAD_POOL_HIGH_WATERMARK = int(os.environ.get("THREAD_POOL_HIGH_WATERMARK", "50"))  # Refill up to this many
+THREAD_POOL_MAX_AGE = 24 * 60 * 60  # In seconds; older unused threads are discarded
+THREAD_POOL_WORKERS = 4  # Concurrent threads.create calls while refilling
+
+
+class WarmThreadPool:
+    """
+    Pool of pre-created OpenAI threads. Taking a thread is a deque pop; whenever the pool drops
+    below the low watermark it is refilled up to the high watermark in the background.
+    """
+
+    def __init__(self, low, high, max_age, workers):
+        self.low = low
+        self.high = high
+        self.max_age = max_age
+        self.ready = deque()  # (thread_id, created_at), oldest on the left
+        self.creating = 0
+        self.created = 0
+        self.expired = 0
+        self.misses = 0
+        self.lock = Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="thread-pool")
+
+    def acquire(self):
+        """
+        Return a ready thread ID, creating one inline only if the pool is empty.
+        """
+        thread_id = None
+        with self.lock:
+            self._expire()
+            if self.ready:
+                thread_id = self._take()
+            else:
+                self.misses += 1
+        self.refill()
+        if thread_id is None:
+            thread_id = backend.create_thread()
+        return thread_id
+
+    def _take(self):
+        """
+        Pop the newest ready thread whose API key's circuit is closed, or the newest one if
+        there is none. Newest first, since the oldest are next to expire.
+        """
+        for index in range(len(self.ready) - 1, -1, -1):
+            if backend.thread_healthy(self.ready[index][0]):
+                thread_id = self.ready[index][0]
+                del self.ready[index]
+                return thread_id
+        return self.ready.pop()[0]
+
+    def refill(self):
+        with self.lock:
+            self._expire()
+            available = len(self.ready) + self.creating
+            if available >= self.low:
+                return
+            missing = max(0, self.high - available)
+            self.creating += missing
+        for _ in range(missing):
+            self.executor.submit(self._create_one)
+
+    def _create_one(self):
+        try:
+            thread_id = backend.create_thread()
+        except Exception as e:
+            log.warning("Could not pre-create a thread", extra={"fields": {"error": str(e)}})
+            thread_id = None
+        with self.lock:
+            self.creating -= 1
+            if thread_id:
+                self.ready.append((thread_id, monotonic()))
+                self.created += 1
+
+    def _expire(self):
+        cutoff = monotonic() - self.max_age
+        while self.ready and self.ready[0][1] < cutoff:
+            self.ready.popleft()
+            self.expired += 1
+
+    def stats(self):
+        with self.lock:
+            return {"ready": len(self.ready), "creating": self.creating, "created": self.created,
+                    "expired": self.expired, "misses": self.misses}
+
+
+thread_pool = WarmThreadPool(THREAD_POOL_LOW_WATERMARK, THREAD_POOL_HIGH_WATERMARK,
+                             THREAD_POOL_MAX_AGE, THREAD_POOL_WORKERS)
+
+
+first_request_served = False
+
+
+@bp.before_app_request
+def start_request_metrics():
+    data = request.get_json(silent=True) if request.is_json else None
+    user_type = data.get("user_status") if isinstance(data, dict) else None
+    request_metrics.endpoint = request.endpoint.rsplit(".", 1)[-1] if request.endpoint else "unmatched"
+    request_metrics.user_type = user_type if user_type in SCHEDULER_WEIGHTS else "none"
+    request_metrics.timings = []
+    request_metrics.started = monotonic()
+    timeout = REQUEST_DEADLINE
+    try:
+        timeout = min(timeout, float(request.headers.get("X-Request-Timeout", timeout)))
+    except ValueError:
+        pass
+    request_state.deadline = request_metrics.started + timeout
+    request_state.abandoned = client_disconnected
 
-            with open(assistant_file_path, "w") as file:
-                json.dump([{"rephrase_assistant_id": assistant.id}], file, indent=3)
 
-            return assistant.id
+@bp.after_app_request
+def add_server_timing(response):
+    timings = getattr(request_metrics, "timings", None)
+    if timings is not None and (current_app.config["SERVER_TIMING"] or "X-Request-Timing" in request.headers):
+        entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings]
+        entries.append(f"total;dur={(monotonic() - request_metrics.started) * 1000:.1f}")
+        response.headers["Server-Timing"] = ", ".join(entries)
+    return response
 
 
+@bp.teardown_app_request
+def finish_request_metrics(exc):
+    # Runs after streamed responses have finished, so "request" covers the whole body
+    if hasattr(request_metrics, "started"):
+        record_stage("request", monotonic() - request_metrics.started)
+    request_metrics.__dict__.clear()
+    request_state.__dict__.clear()
 
-# Create new assistant or load existing
-premium_assistant_id = create_premium_assistant(client)
-free_assistant_id = create_free_assistant(client)
-rephrase_assistant_id = create_rephrase_assistant(client)
 
+@bp.after_app_request
+def log_first_request(response):
+    global first_request_served
+    if not first_request_served:
+        first_request_served = True
+        log.info("First request served", extra={"fields": {"seconds_since_start": round(monotonic() - process_started, 3)}})
+    return response
 
 
 # Serve the main application page
-@app.route("/")
+@bp.route("/")
 def index():
     return render_template("index.html")
 
 
 # Start conversation thread
 
-@app.route("/api/start", methods=["GET"])
+@bp.route("/api/start", methods=["GET"])
 def start_conversation():
-        print("Starting a new conversation...")  # Debugging line
-        free_thread = client.beta.threads.create()
-        premium_thread = client.beta.threads.create()
-        print(f"New free thread created with ID: {free_thread.id}")  # Debugging line
-        print(f"New premium thread created with ID: {premium_thread.id}")
-        return jsonify({"free_thread_id": free_thread.id, "premium_thread_id": premium_thread.id})
+        # Both threads come from the warm pool, so the response keeps its original shape
+        free_thread_id = thread_pool.acquire()
+        premium_thread_id = thread_pool.acquire()
+        log.debug("New conversation started", extra={"fields": {"thread_id": free_thread_id}})
+        return jsonify({"free_thread_id": free_thread_id, "premium_thread_id": premium_thread_id})
+
+
+# Password hashing runs in a small process pool so bursts of logins do not starve request
+# threads of the GIL; requests beyond the queue limit are rejected with 429. Workers are
+# started fresh rather than forked from a process that is running request threads.
+PASSWORD_HASH_WORKERS = 2
+PASSWORD_HASH_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+PASSWORD_HASH_MAX_QUEUE = 32  # Hash jobs running or waiting at once
+SESSION_MAX_AGE = 7 * 24 * 60 * 60  # In seconds
+
+
+def session_serializer(secret_key=None):
+    return URLSafeTimedSerializer(secret_key or current_app.secret_key, salt="session")
+
+password_hash_executor = None
+password_hash_executor_lock = Lock()
+password_hash_slots = BoundedSemaphore(PASSWORD_HASH_MAX_QUEUE)
+
+
+def run_password_hash(fn, *args):
+    """
+    Run a werkzeug hashing function in the process pool and wait for its result.
+    """
+    global password_hash_executor
+    if not password_hash_slots.acquire(blocking=False):
+        raise QueueFullError("password hashing", 1)
+    try:
+        with password_hash_executor_lock:
+            if password_hash_executor is None:
+                password_hash_executor = ProcessPoolExecutor(
+                    max_workers=PASSWORD_HASH_WORKERS,
+                    mp_context=multiprocessing.get_context(PASSWORD_HASH_START_METHOD),
+                )
+        return password_hash_executor.submit(fn, *args).result()
+    finally:
+        password_hash_slots.release()
+
+
+def issue_session_token(username):
+    return session_serializer().dumps({"username": username})
+
+
+def verify_session_token(secret_key, token):
+    """
+    Return the username in a session token signed with secret_key, or None if it is invalid
+    or expired. Only an HMAC check, no password hash.
+    """
+    try:
+        return session_serializer(secret_key).loads(token, max_age=SESSION_MAX_AGE)["username"]
+    except (BadSignature, KeyError, TypeError):
+        return None
+
+
+def bearer_token(authorization):
+    return authorization[len("Bearer "):] if authorization.startswith("Bearer ") else None
+
+
+def session_username():
+    """
+    Return the username from a valid "Authorization: Bearer <token>" header, or None.
+    """
+    token = bearer_token(request.headers.get("Authorization", ""))
+    return verify_session_token(current_app.secret_key, token) if token else None
+
+
+@bp.before_app_request
+def verify_session():
+    """
+    Check the session token, if the request carries one, and keep its username in
+    g.session_username for the routes. A token that fails the check gets a 401, except on
+    /api/login, where the client can still log in with its password.
+    """
+    g.session_username = session_username()
+    if (g.session_username is None and bearer_token(request.headers.get("Authorization", ""))
+            and request.endpoint != "webserver.login"):
+        return jsonify({"message": "Invalid or expired session token"}), 401
+
 
+def request_username(data):
+    """
+    The session's user if the request carries a valid token, otherwise the username in the body.
+    """
+    return g.session_username or data["username"]
 
-@app.route('/api/register', methods=['POST'])
+
+@bp.route('/api/register', methods=['POST'])
 def register():
     data = request.get_json()
     username = data.get('username')
@@ -353,7 +2318,7 @@ def register():
     if existing_user:
         return jsonify({'message': 'User already exists'}), 409
 
-    hashed_password = generate_password_hash(password)
+    hashed_password = run_password_hash(generate_password_hash, password)
 
     new_user = UserData(username=username, password=hashed_password, email=email, newsletter=newsletter)
     db.session.add(new_user)
@@ -362,88 +2327,195 @@ def register():
     return jsonify({'message': 'User registered successfully'}), 201
 
 
-@app.route('/api/login', methods=['POST'])
+@bp.route('/api/login', methods=['POST'])
 def login():
     data = request.get_json()
     username = data.get('username')
     password = data.get('password')
 
+    # A valid session token skips the password hash entirely
+    token_username = g.session_username
+    if token_username and (not username or token_username == username):
+        return jsonify({'message': 'Login successful', 'username': token_username}), 200
+
     if not username or not password:
         return jsonify({'message': 'Username and password are required'}), 400
 
     user = UserData.query.filter_by(username=username).first()
 
-    if user and check_password_hash(user.password, password):
+    if user and run_password_hash(check_password_hash, user.password, password):
         # Login successful
-
-        return jsonify({'message': 'Login successful'}), 200
+        return jsonify({'message': 'Login successful', 'username': username, 'token': issue_session_token(username)}), 200
     else:
         # Invalid credentials
         return jsonify({'message': 'Invalid username or password'}), 401
 
 
 
-# Fetch initial Q&A pairs with "like" feedback
-@app.route("/api/messages/welcome_messages", methods=["GET"])
-def get_initial_qa():
+# Welcome messages are rebuilt from the database only after a row gains or loses a Like.
+# The TTL bounds how long other worker processes can serve a stale copy.
+WELCOME_CACHE_TTL = 60  # In seconds
+
+
+class WelcomeMessagesCache:
+    """
+    Cached welcome messages body with a version counter. invalidate() bumps the version and
+    the next request rebuilds the body, its ETag and Last-Modified time.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.version = 0
+        self.built_version = -1
+        self.built_at = 0.0
+        self.entry = None  # (body, etag, last_modified)
+        self.lock = Lock()
+
+    def invalidate(self):
+        with self.lock:
+            self.version += 1
+
+    def get(self, build):
+        with self.lock:
+            if self.built_version == self.version and monotonic() - self.built_at < self.ttl:
+                return self.entry
+            version = self.version
+        body = json.dumps(build())
+        etag = hashlib.sha1(body.encode()).hexdigest()
+        with self.lock:
+            # Keep the Last-Modified time when a rebuild produced the same messages
+            if self.entry is None or self.entry[1] != etag:
+                self.entry = (body, etag, datetime.utcnow().replace(microsecond=0))
+            self.built_version = version
+            self.built_at = monotonic()
+            return self.entry
+
+
+welcome_cache = WelcomeMessagesCache(WELCOME_CACHE_TTL)
+
+
+def load_welcome_messages():
     liked_feedbacks = FeedbackData.query.filter_by(feedback="Like").limit(3).all()
     # Check if the query returned any results
     if not liked_feedbacks:
         # No results found, return example messages
-        example_messages = [
+        return [
             {"question": "Example Question 1", "answer": "Example Answer 1"},
             {"question": "Example Question 2", "answer": "Example Answer 2"},
             {"question": "Example Question 3", "answer": "Example Answer 3"}
         ]
-        return jsonify(example_messages)
-    else:
-        # Return the results from the database
-        return jsonify([{"question": f.question, "answer": f.answer} for f in liked_feedbacks])
+    # Return the results from the database
+    return [{"question": f.question, "answer": f.answer} for f in liked_feedbacks]
+
+
+# Fetch initial Q&A pairs with "like" feedback
+@bp.route("/api/messages/welcome_messages", methods=["GET"])
+def get_initial_qa():
+    body, etag, last_modified = welcome_cache.get(load_welcome_messages)
+    response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    # Clients and proxies may keep the body but must revalidate it
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 
 # Endpoint for receiving user questions
-@app.route("/api/ask_question", methods=["POST"])
+@bp.route("/api/ask_question", methods=["POST"])
 def ask_question():
-    # Acquire the lock before making the API call
-    with openai_lock:
-        data = request.json
-        question = data["question"]
-        user_type = data["user_status"]  # Free or Premium
-        thread_id = data["thread_id"]
-        username = data["username"]
-        thread_type = data["thread_type"]
+    data = request.json
+    question = data["question"]
+    user_type = data["user_status"]  # Free or Premium
+    thread_id = data["thread_id"]
+    username = request_username(data)
+    thread_type = data["thread_type"]
+
+    # Checked here as well as in chat(), since cached and FAQ answers never reach it
+    if not thread_id:
+        log.warning("Missing thread_id")
+        return jsonify({"error": "Missing thread_id"}), 400
+    if user_type not in ("free", "premium"):
+        log.warning("Invalid user_type", extra={"fields": {"user_type": user_type}})
+        return jsonify({"response": "Invalid user_type"}), 400
+
+    # Repeated questions are answered from the cache without touching OpenAI or the rate limit
+    with timed_stage("answer_cache"):
+        answer_text = answer_cache.get(assistant_registry.get("free"), question)
+    if answer_text is None and user_type == "free":
+        # Near-duplicates of liked questions are answered locally
+        with timed_stage("faq_search"):
+            answer_text = faq_index.search(question)
+    if answer_text is None:
+        credential_pool.split(thread_id)  # An unknown key suffix is a 400 for this caller only
+        # Concurrent duplicates wait for the first caller's run and share its answer; each
+        # caller still gets its own FeedbackData row below
+        flight_key = (assistant_registry.get("free"), normalize_question(question))
+        with timed_stage("answer_flight"):
+            status, answer_data = answer_flights.do(
+                flight_key, lambda: ask_free_assistant(question, user_type, thread_id), shared_answer)
+        if status != 200:
+            return jsonify(answer_data), status  # Error from chat, e.g. a failed or expired run
+        answer_text = answer_data['response']  # Assuming the key in the returned JSON is 'response'
+
+    # Now store the extracted answer text
+    with timed_stage("feedback_enqueue"):
+        record_id = feedback_writer.add(question=question, answer=answer_text, username=username,user_type=user_type, thread_id=thread_id, thread_type=thread_type)
+
+    return jsonify({"question": question, "answer": answer_text, "record_id": record_id})
+
 
+def ask_free_assistant(question, user_type, thread_id):
+    """
+    Run chat() for ask_question and cache the answer. Returns (status code, JSON body) rather
+    than a Response, since single-flight followers share the result.
+    """
+    # The run is shared, so it is only abandoned once no follower is waiting on it either
+    flight_key = (assistant_registry.get("free"), normalize_question(question))
+    request_state.abandoned = lambda: client_disconnected() and not answer_flights.waiting(flight_key)
+    # Serialize only against other requests on the same thread
+    with openai_slot(thread_id, user_type):
         #for _ in range(5):
         #    # Call the test_chat function
-        #    answer_data = test_chat(question, user_type, thread_id).get_json()    
+        #    answer_data = test_chat(question, user_type, thread_id).get_json()
         #    # Extract the 'response' from the answer_data
         #    answer_text = answer_data['response']
-        #print("DEBUG:", question, user_type, thread_id)
-        answer_data = chat(question, user_type, thread_id).get_json()  # Extract JSON data from the Flask Response object
-        answer_text = answer_data['response']  # Assuming the key in the returned JSON is 'response'
+        result = chat(question, user_type, thread_id)
+    if isinstance(result, tuple):
+        return result[1], result[0].get_json()
+    answer_data = result.get_json()  # Extract JSON data from the Flask Response object
+    answer_cache.put(assistant_registry.get("free"), question, answer_data["response"])
+    return 200, answer_data
 
 
+# Endpoint for receiving user questions
+@bp.route("/api/ask_question_premium", methods=["POST"])
+def ask_question_premium():
+    data = request.json
+    question = data["question"]
+    user_type = data["user_status"]  # Free or Premium
+    thread_id = data["thread_id"]
+    username = request_username(data)
+    thread_type = data["thread_type"]
 
-        # Now store the extracted answer text
-        new_feedback = FeedbackData(question=question, answer=answer_text, username=username,user_type=user_type, thread_id=thread_id, thread_type=thread_type)
-        db.session.add(new_feedback)
-        db.session.commit()
-        record_id = getattr(new_feedback, "id")
+    if not thread_id and user_type == "premium":
+        # Clients that send no premium thread get one from the pool and keep the returned thread_id
+        with timed_stage("thread_pool_acquire"):
+            thread_id = thread_pool.acquire()
 
-        return jsonify({"question": question, "answer": answer_text, "record_id": record_id})
+    answer = answer_premium_question(question, user_type, thread_id, username, thread_type)
+    if isinstance(answer, tuple):
+        return answer  # Error response from chat_premium, e.g. a failed or expired run
+    return jsonify(answer)
 
-# Endpoint for receiving user questions
-@app.route("/api/ask_question_premium", methods=["POST"])
-def ask_question_premium():
-    # Acquire the lock before making the API call
-    with openai_lock:
-        data = request.json
-        question = data["question"]
-        user_type = data["user_status"]  # Free or Premium
-        thread_id = data["thread_id"]
-        username = data["username"]
-        thread_type = data["thread_type"]
 
+def answer_premium_question(question, user_type, thread_id, username, thread_type):
+    """
+    Run chat_premium on thread_id and store the answer. Returns the response body as a dict,
+    or chat_premium's error response tuple.
+    """
+    # Serialize only against other requests on the same thread
+    with openai_slot(thread_id, user_type):
         # Placeholder for answer
 
         #for _ in range(10):
@@ -451,214 +2523,494 @@ def ask_question_premium():
         #    answer_data = test_chat(question, user_type, thread_id).get_json()
         #    # Extract the 'response' from the answer_data
         #    answer_text = answer_data['response']
-        answer_data = chat_premium(question, user_type, thread_id).get_json()  # Extract JSON data from the Flask Response object
+        result = chat_premium(question, user_type, thread_id)
+        if isinstance(result, tuple):
+            return result
+        answer_data = result.get_json()  # Extract JSON data from the Flask Response object
         answer_text = answer_data['response']  # Assuming the key in the returned JSON is 'response'
 
+    # Now store the extracted answer text
+    with timed_stage("feedback_enqueue"):
+        record_id = feedback_writer.add(question=question, answer=answer_text, username=username, user_type=user_type,thread_id=thread_id, thread_type=thread_type)
 
+    return {"question": question, "answer": answer_text, "record_id": record_id, "thread_id": thread_id}
 
-        # Now store the extracted answer text
-        new_feedback = FeedbackData(question=question, answer=answer_text, username=username, user_type=user_type,thread_id=thread_id, thread_type=thread_type)
-        db.session.add(new_feedback)
-        db.session.commit()
-        record_id = getattr(new_feedback, "id")
 
-        return jsonify({"question": question, "answer": answer_text, "record_id": record_id})
+# ask_question_premium and related_question_premium in one call. The rephrase run starts on the
+# related-questions executor while the answer run proceeds in this request, so the response
+# takes as long as the slower run instead of both in turn.
+@bp.route("/api/ask_question_premium/with_related", methods=["POST"])
+def ask_question_premium_with_related():
+    data = request.json
+    question = data["question"]
+    user_type = data["user_status"]  # Free or Premium
+    thread_id = data["thread_id"]
+    username = request_username(data)
+    thread_type = data["thread_type"]
+
+    if user_type != "premium":
+        return jsonify({"response": "Invalid user_type"}), 400
+
+    related = start_related_questions(current_app._get_current_object(), question, user_type)
+    if not thread_id:
+        # Clients that send no premium thread get one from the pool and keep the returned thread_id
+        with timed_stage("thread_pool_acquire"):
+            thread_id = thread_pool.acquire()
+
+    answer = answer_premium_question(question, user_type, thread_id, username, thread_type)
+    if isinstance(answer, tuple):
+        return answer  # The related questions still land in the cache for a later call
+    with timed_stage("related_wait"):
+        answer["related"] = related_questions_result(related, question, min(RUN_DEADLINE, request_remaining()))
+    return jsonify(answer)
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream_question_response(stream_fn, question, user_type, thread_id, username, thread_type, related=None):
+    """
+    Relay the answer from stream_fn to the client as Server-Sent Events: one "delta" event per
+    chunk of text, then a "done" event carrying the stored record_id (or an "error" event).
+    With a related-questions Future from start_related_questions, a "related" event is sent
+    as soon as it is done, between deltas or after "done".
+    """
+    if thread_id:
+        credential_pool.split(thread_id)  # An unknown key gets a 400 before the stream starts
+
+    def generate():
+        outcome = {}
+        parts = []
+        related_sent = related is None
+        # Hold the thread for the whole stream; it is released if the client disconnects
+        try:
+            with openai_slot(thread_id, user_type):
+                for delta in stream_fn(question, thread_id, outcome):
+                    parts.append(delta)
+                    yield sse_event("delta", {"text": delta})
+                    if not related_sent and related.done():
+                        related_sent = True
+                        yield sse_event("related", related_questions_result(related, question, 0))
+        except QueueFullError as e:
+            yield sse_event("error", {"error": "Server is busy. Please try again later.", "retry_after": e.retry_after})
+            return
+        except RateLimitException as e:
+            # Raised once the 200 headers are out, so it becomes an event rather than a 429
+            retry_after = max(1, math.ceil(getattr(e, "period_remaining", 1)))
+            yield sse_event("error", {"error": "Rate limit exceeded. Please try again later.", "retry_after": retry_after})
+            return
+        except CircuitOpenError as e:
+            yield sse_event("error", {"error": "The assistant is temporarily unavailable. Please try again later.", "retry_after": e.retry_after})
+            return
+        except (DeadlineExceededError, OpenAIError) as e:
+            log.warning("Streamed answer failed", extra={"fields": {"error": str(e)}})
+            yield sse_event("error", {"error": "The assistant could not answer. Please try again later."})
+            return
+
+        if outcome.get("status") != "completed":
+            yield sse_event("error", {"error": f"Run {outcome.get('status')}"})
+            return
+
+        answer_text = "".join(parts)
+        record_id = feedback_writer.add(question=question, answer=answer_text, username=username, user_type=user_type, thread_id=thread_id, thread_type=thread_type)
+        yield sse_event("done", {"question": question, "answer": answer_text, "record_id": record_id, "thread_id": thread_id, "run_stats": outcome.get("stats")})
+        if not related_sent:
+            yield sse_event("related", related_questions_result(related, question, min(RUN_DEADLINE, request_remaining())))
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# Streaming variant of /api/ask_question
+@bp.route("/api/ask_question/stream", methods=["POST"])
+def ask_question_stream():
+    data = request.json
+    question = data["question"]
+    user_type = data["user_status"]  # Free or Premium
+    thread_id = data["thread_id"]
+    username = request_username(data)
+    thread_type = data["thread_type"]
+
+    if not thread_id:
+        return jsonify({"error": "Missing thread_id"}), 400
+    if user_type not in ("free", "premium"):
+        return jsonify({"response": "Invalid user_type"}), 400
+
+    return stream_question_response(chat_stream, question, user_type, thread_id, username, thread_type)
 
 
-@app.route("/api/related_question_premium", methods=["POST"])
+# Streaming variant of /api/ask_question_premium
+@bp.route("/api/ask_question_premium/stream", methods=["POST"])
+def ask_question_premium_stream():
+    data = request.json
+    question = data["question"]
+    user_type = data["user_status"]  # Free or Premium
+    thread_id = data["thread_id"]
+    username = request_username(data)
+    thread_type = data["thread_type"]
+
+    if user_type != "premium":
+        return jsonify({"response": "Invalid user_type"}), 400
+    if not thread_id:
+        # Clients that send no premium thread get one from the pool and keep the thread_id from the done event
+        thread_id = thread_pool.acquire()
+
+    return stream_question_response(chat_premium_stream, question, user_type, thread_id, username, thread_type)
+
+
+# Streaming variant of /api/ask_question_premium/with_related
+@bp.route("/api/ask_question_premium/with_related/stream", methods=["POST"])
+def ask_question_premium_with_related_stream():
+    data = request.json
+    question = data["question"]
+    user_type = data["user_status"]  # Free or Premium
+    thread_id = data["thread_id"]
+    username = request_username(data)
+    thread_type = data["thread_type"]
+
+    if user_type != "premium":
+        return jsonify({"response": "Invalid user_type"}), 400
+
+    related = start_related_questions(current_app._get_current_object(), question, user_type)
+    if not thread_id:
+        # Clients that send no premium thread get one from the pool and keep the thread_id from the done event
+        thread_id = thread_pool.acquire()
+
+    return stream_question_response(chat_premium_stream, question, user_type, thread_id, username, thread_type, related)
+
+
+@bp.route("/api/related_question_premium", methods=["POST"])
 def related_question_premium():
     try:
-        # Acquire the lock before making the API call
-        with openai_lock:    
-            data = request.json
-            question = data["question"]
-            user_type = data["user_status"]  # Free or Premium
-
-            # Placeholder for answer
-
-            #for _ in range(150):
-            #    # Call the test_chat function
-            #    answer_data = test_chat(question, user_type, thread_id).get_json()
-            #   
-            #    # Extract the 'response' from the answer_data
-            #    answer_text = answer_data['response']
-
-            answer_data = rephrase_chat(question, user_type).get_json()  # Extract JSON data from the Flask Response object
-            if answer_data['result'] == "failed":
+        data = request.json
+        question = data["question"]
+        user_type = data["user_status"]  # Free or Premium
+
+        # Related questions are served from the cache; misses are generated in the background
+        # and the client asks again once they are ready
+        cached = related_cache.get(assistant_registry.get("rephrase"), question)
+        if cached is None:
+            result = schedule_related_questions(current_app._get_current_object(), question, user_type)
+            if result == "failed":
                 return jsonify({"result": "failed"}), 200
-            else:
-                # Define a regular expression pattern to match the related questions
-                related_question_premium1 = answer_data['related_question_premium1']
-                related_question_premium2 = answer_data['related_question_premium2']
-                related_question_premium3 = answer_data['related_question_premium3']
-                # Print the variables to verify
-                print("Related Question 1:", related_question_premium1)
-                print("Related Question 2:", related_question_premium2)
-                print("Related Question 3:", related_question_premium3)
-
-                # Now store the extracted answer text
-                #new_feedback = FeedbackData(question=question, answer=answer_text)
-                #db.session.add(new_feedback)
-                #db.session.commit()
-                #record_id = getattr(new_feedback, "id")
-
-                return jsonify({"question": question, "related_question1": related_question_premium1, "related_question2": related_question_premium2, "related_question3": related_question_premium3})
+            return jsonify({"question": question, "result": "pending"}), 202
+
+        related_question_premium1, related_question_premium2, related_question_premium3 = json.loads(cached)
+        log.debug("Related questions served", extra={"fields": {
+            "question": question,
+            "related": [related_question_premium1, related_question_premium2, related_question_premium3],
+        }})
+
+        return jsonify({"question": question, "related_question1": related_question_premium1, "related_question2": related_question_premium2, "related_question3": related_question_premium3})
     except Exception as e:
         # Handle any exceptions raised during API call
         return jsonify({"error": str(e)}), 500
 
 
 
-@sleep_and_retry
-@rate_limit_logger 
-@limits(calls=GPT4_RATE_LIMIT_REQUESTS, period=GPT4_RATE_LIMIT_PERIOD)
+@rate_limit_logger
+@token_bucket_limited(credential_pool.bucket("gpt4"))
 def test_chat(question, user_type, thread_id):
     try:
         # Placeholder logic for chat function
         response_text = "This is a simulated response for your question."
         return jsonify({"response": response_text})
     except RateLimitException as e:  # Catching RateLimitException
-        print(f"Rate limit exceeded: {e}")
+        log.warning("Rate limit exceeded", extra={"fields": {"error": str(e)}})
         # Return a custom message indicating the rate limit was exceeded
         return jsonify({"error": "Rate limit exceeded. Please try again later."}), 429  # 429 Too Many Requests
     except Exception as e:  # Catching other general exceptions
-        print(f"An error occurred: {e}")
+        log.exception("An error occurred")
         return jsonify({"error": "An unexpected error occurred. Please try again later."}), 500  # 500 Internal Server Error
     
 
-@app.errorhandler(RateLimitException)
+@bp.app_errorhandler(QueueFullError)
+def handle_queue_full_error(e):
+    log.warning("Request shed", extra={"fields": {"error": str(e), "retry_after": e.retry_after}})
+    return jsonify({"error": "Server is busy. Please try again later."}), 429, {"Retry-After": str(e.retry_after)}
+
+
+@bp.app_errorhandler(CircuitOpenError)
+def handle_circuit_open_error(e):
+    return jsonify({"error": "The assistant is temporarily unavailable. Please try again later."}), 503, {"Retry-After": str(e.retry_after)}
+
+
+@bp.app_errorhandler(DeadlineExceededError)
+def handle_deadline_exceeded_error(e):
+    log.warning("Request deadline exceeded", extra={"fields": {"error": str(e)}})
+    return jsonify({"error": "The request took too long. Please try again."}), 504
+
+
+@bp.app_errorhandler(UnknownThreadKeyError)
+def handle_unknown_thread_key_error(e):
+    log.warning("Unknown thread key", extra={"fields": {"error": str(e)}})
+    return jsonify({"error": "Unknown thread_id"}), 400
+
+
+@bp.app_errorhandler(OpenAIError)
+def handle_backend_error(e):
+    log.warning("LLM backend error", extra={"fields": {"error": str(e)}})
+    return jsonify({"error": "The assistant could not answer. Please try again later."}), 502
+
+
+@bp.app_errorhandler(RateLimitException)
 def handle_rate_limit_error(e):
-    print("LIMITS exceeded")
-    return jsonify({"error": "Rate limit exceeded. Please try again later."}), 429
+    log.warning("Rate limit exceeded")
+    retry_after = max(1, math.ceil(getattr(e, "period_remaining", 1)))
+    return jsonify({"error": "Rate limit exceeded. Please try again later."}), 429, {"Retry-After": str(retry_after)}
+
+
+# Run completion settings: polls start fast and back off towards RUN_POLL_MAX_DELAY,
+# and a run that has not finished within RUN_DEADLINE seconds is cancelled.
+RUN_POLL_INITIAL_DELAY = 0.25  # In seconds
+RUN_POLL_MAX_DELAY = 2  # In seconds
+RUN_POLL_BACKOFF = 1.5
+RUN_DEADLINE = 120  # In seconds
+
+# Run states after which polling stops
+RUN_TERMINAL_STATES = ("completed", "failed", "cancelled", "expired", "incomplete", "requires_action")
+# Statuses after which the run is still live upstream and is cancelled to free the thread
+RUN_CANCEL_STATES = ("requires_action", "deadline_exceeded", "client_disconnected")
+
+# Aggregate run-wait counters, exposed for verifying the latency win
+run_wait_stats = {"runs": 0, "polls": 0, "wait_time": 0.0, "by_status": {}}
+run_wait_stats_lock = Lock()
+
+
+def record_run_wait(status, polls, wait_time):
+    with run_wait_stats_lock:
+        run_wait_stats["runs"] += 1
+        run_wait_stats["polls"] += polls
+        run_wait_stats["wait_time"] += wait_time
+        run_wait_stats["by_status"][status] = run_wait_stats["by_status"].get(status, 0) + 1
+
+
+def cancel_run(thread_id, run_id):
+    try:
+        backend.cancel_run(thread_id, run_id)
+    except Exception as e:
+        log.warning("Could not cancel run", extra={"fields": {"run_id": run_id, "thread_id": thread_id, "error": str(e)}})
+
+
+def wait_for_run(thread_id, run_id, label, deadline=RUN_DEADLINE):
+    """
+    Poll a run with adaptive backoff until it reaches a terminal state, the deadline (or the
+    request's own deadline, if sooner) passes, or the client goes away. Runs stuck in
+    requires_action, past the deadline or abandoned are cancelled so the thread is freed.
+    Returns the final status and the per-run stats (poll count and wait time).
+    """
+    started = monotonic()
+    deadline = min(deadline, request_remaining())
+    delay = RUN_POLL_INITIAL_DELAY
+    polls = 0
+    status = "in_progress"
+    while True:
+        try:
+            status = backend.retrieve_run(thread_id, run_id)
+        except DeadlineExceededError:
+            status = "deadline_exceeded"
+            break
+        polls += 1
+        log_poll(thread_id=thread_id, label=label, status=status, poll=polls)
+        if status in RUN_TERMINAL_STATES:
+            break
+        remaining = deadline - (monotonic() - started)
+        if remaining <= 0:
+            status = "deadline_exceeded"
+            break
+        if request_abandoned():
+            status = "client_disconnected"
+            break
+        sleep(min(delay, remaining))
+        delay = min(delay * RUN_POLL_BACKOFF, RUN_POLL_MAX_DELAY)
+
+    if status in RUN_CANCEL_STATES:
+        cancel_run(thread_id, run_id)
+    stats = {"mode": "poll", "polls": polls, "wait_time": round(monotonic() - started, 3)}
+    record_run_wait(status, polls, stats["wait_time"])
+    return status, stats
+
+
+def stream_run_deltas(thread_id, assistant_id, label, outcome, deadline=RUN_DEADLINE):
+    """
+    Create a run and follow it on the run event stream, yielding assistant text deltas as they
+    arrive. The final status and per-run stats are stored in the outcome dict. If the consumer
+    stops early (the SSE client disconnected) the run is cancelled.
+    """
+    started = monotonic()
+    deadline = min(deadline, request_remaining())
+    status = "in_progress"
+    run_id = None
+    try:
+        with backend.stream_run(thread_id, assistant_id, timeout=deadline) as stream:
+            for event in stream:
+                if event.event == "thread.message.delta":
+                    for part in event.data.delta.content or []:
+                        if part.type == "text" and part.text and part.text.value:
+                            yield part.text.value
+                elif event.event.startswith("thread.run.") and not event.event.startswith("thread.run.step"):
+                    run_id = event.data.id
+                    status = event.data.status
+                if status in RUN_TERMINAL_STATES:
+                    break
+                if monotonic() - started > deadline:
+                    status = "deadline_exceeded"
+                    break
+                if request_abandoned():
+                    status = "client_disconnected"
+                    break
+    except httpx.TimeoutException:
+        status = "deadline_exceeded"  # The stream's read timeout is the deadline
+    except GeneratorExit:
+        if run_id:
+            cancel_run(thread_id, run_id)
+        raise
+    log.debug("Run stream ended", extra={"fields": {"thread_id": thread_id, "label": label, "status": status}})
+
+    if run_id and status in RUN_CANCEL_STATES:
+        cancel_run(thread_id, run_id)
+    stats = {"mode": "stream", "polls": 0, "wait_time": round(monotonic() - started, 3)}
+    record_run_wait(status, 0, stats["wait_time"])
+    outcome["status"] = status
+    outcome["stats"] = stats
+
+
+def stream_run(thread_id, assistant_id, label, deadline=RUN_DEADLINE):
+    """
+    Create a run and wait for it on the run event stream instead of polling.
+    Returns the final status and the per-run stats, like wait_for_run.
+    """
+    outcome = {}
+    for _ in stream_run_deltas(thread_id, assistant_id, label, outcome, deadline):
+        pass
+    return outcome["status"], outcome["stats"]
+
+
+def run_assistant(thread_id, assistant_id, label):
+    """
+    Start a run of assistant_id on thread_id and wait for it to finish.
+    Uses the run event stream when the installed SDK supports it, polling otherwise.
+    """
+    if backend.supports_streaming:
+        with timed_stage("run_wait"):
+            status, stats = stream_run(thread_id, assistant_id, label)
+    else:
+        with timed_stage("runs_create"):
+            run_id = backend.create_run(thread_id, assistant_id)
+        with timed_stage("run_wait"):
+            status, stats = wait_for_run(thread_id, run_id, label)
+    log.info("Run finished", extra={"fields": dict(stats, thread_id=thread_id, label=label, status=status)})
+    return status, stats
+
+
+def latest_assistant_message(thread_id):
+    with timed_stage("messages_list"):
+        return backend.list_messages(thread_id, limit=1)[0]
 
 
-@sleep_and_retry
 @rate_limit_logger
-@limits(calls=GPT3_RATE_LIMIT_REQUESTS, period=GPT3_RATE_LIMIT_PERIOD)
 def chat(question, user_type, thread_id):
     user_input = question
 
     if not thread_id:
-        print("Error: Missing thread_id")
+        log.warning("Missing thread_id")
         return jsonify({"error": "Missing thread_id"}), 400
 
     #print(f"Received message: {user_input} for thread ID: {thread_id} and User-Type {user_type}" )
 
-    # Initialize the run variable
-    run = None
-    while True:
-        try:
-            # Run the Assistant
-            if user_type == "free":
-                print(f"Assistant ID: {free_assistant_id}")
-                # Add the user's message to the thread
-                client.beta.threads.messages.create(
-                    thread_id=thread_id, role="user", content=user_input
-                )
-                run = client.beta.threads.runs.create(
-                    thread_id=thread_id, assistant_id=free_assistant_id
-                )
-            elif user_type == "premium":
-                print(f"Assistant ID: {free_assistant_id}")
-                # Add the user's message to the thread
-                client.beta.threads.messages.create(
-                    thread_id=thread_id, role="user", content=user_input
-                )
-                run = client.beta.threads.runs.create(
-                    thread_id=thread_id, assistant_id=free_assistant_id
-                )
-            else:
-                # Handle the case where user_type is neither "Premium" nor "Free"
-                print("Error: Invalid user_type")
-                return jsonify({"response": "Invalid user_type"}), 400
-            
-        except Exception as e:
-                print(f"An error occurred: {e}")
-                break  # Exit the loop in case of an error
-        
-                
-
-    # Check if the Run requires action (function call)
-    while True:
-        try:
-            run_status = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
-            print(f"Thread ID {thread_id} FREE Run status: {run_status.status}")
-            if run_status.status == "completed":
-                print(f"Thread ID {thread_id} FREE Run COMPLETED")
-                break  # Exit the loop if the run is completed
-            else:
-                sleep(2)  # Wait for a second before checking again
-        except Exception as e:
-            print(f"An error occurred: {e}")
-            break  # Exit the loop in case of an error
+    # Free and premium users both get the free assistant here
+    if user_type not in ("free", "premium"):
+        # Handle the case where user_type is neither "Premium" nor "Free"
+        log.warning("Invalid user_type", extra={"fields": {"user_type": user_type}})
+        return jsonify({"response": "Invalid user_type"}), 400
+
+    # The run goes to the API key that created the thread, so it draws on that key's budget
+    wait_for_token(credential_pool.bucket("gpt3", thread_id))
+    free_assistant_id = assistant_registry.get("free", credential_pool.key_of(thread_id))
+    log.debug("Using assistant", extra={"fields": {"assistant_id": free_assistant_id}})
+    # Add the user's message to the thread and run the Assistant
+    with timed_stage("messages_create"):
+        backend.create_message(thread_id, user_input)
+    status, run_stats = run_assistant(thread_id, free_assistant_id, "FREE")
+    if status != "completed":
+        return jsonify({"error": f"Run {status}", "run_stats": run_stats}), 502
 
     # Retrieve and return the latest message from the assistant
-    messages = client.beta.threads.messages.list(thread_id=thread_id)
-    response = messages.data[0].content[0].text.value
+    response = latest_assistant_message(thread_id)
 
-    print(f"Assistant response: {response}")
-    return jsonify({"response": response})
+    log.debug("Assistant response", extra={"fields": {"thread_id": thread_id, "response": response}})
+    return jsonify({"response": response, "run_stats": run_stats})
 
 
-@sleep_and_retry
 @rate_limit_logger
-@limits(calls=GPT4_RATE_LIMIT_REQUESTS, period=GPT4_RATE_LIMIT_PERIOD)
 def chat_premium(question, user_type, thread_id):
     user_input = question
 
     if not thread_id:
-        print("Error: Missing thread_id")
+        log.warning("Missing thread_id")
         return jsonify({"error": "Missing thread_id"}), 400
 
     #print(f"Received message: {user_input} for thread ID: {thread_id} and User-Type {user_type}" )
 
-    # Initialize the run variable
-    run = None
+    if user_type != "premium":
+        # Handle the case where user_type is not "Premium"
+        log.warning("Invalid user_type", extra={"fields": {"user_type": user_type}})
+        return jsonify({"response": "Invalid user_type"}), 400
+
+    wait_for_token(credential_pool.bucket("gpt4", thread_id))
+    premium_assistant_id = assistant_registry.get("premium", credential_pool.key_of(thread_id))
+    log.debug("Using assistant", extra={"fields": {"assistant_id": premium_assistant_id}})
+    # Add the user's message to the thread and run the Assistant
+    with timed_stage("messages_create"):
+        backend.create_message(thread_id, user_input)
+    status, run_stats = run_assistant(thread_id, premium_assistant_id, "PREMIUM")
+    if status != "completed":
+        return jsonify({"error": f"Run {status}", "run_stats": run_stats}), 502
 
-    # Run the Assistant
-    while True:
-        try:
-            if user_type == "premium":
-                print(f"Assistant ID: {premium_assistant_id}")
-                # Add the user's message to the thread
-                client.beta.threads.messages.create(
-                    thread_id=thread_id, role="user", content=user_input
-                )
-                premium_run = client.beta.threads.runs.create(
-                    thread_id=thread_id, assistant_id=premium_assistant_id
-                )
-            else:
-                # Handle the case where user_type is neither "Premium" nor "Free"
-                print("Error: Invalid user_type")
-                return jsonify({"response": "Invalid user_type"}), 400
-        except Exception as e:
-            print(f"An error occurred: {e} for thread_id: {thread_id}")
-            break  # Exit the loop in case of an error
+    # Retrieve and return the latest message from the assistant
+    response = latest_assistant_message(thread_id)
 
-    # Check if the Run requires action (function call)
-    while True:
-        try:
-            run_status = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=premium_run.id)
-            print(f"Thread ID {thread_id} PREMIUM Run status: {run_status.status}")
-            if run_status.status == "completed":
-                print(f"Thread ID {thread_id} PREMIUM Run COMPLETED")
-                break  # Exit the loop if the run is completed
-            else:
-                sleep(2)  # Wait for a second before checking again
-        except Exception as e:
-            print(f"An error occurred: {e} for thread_id: {thread_id}")
-            break  # Exit the loop in case of an error
+    log.debug("Assistant response", extra={"fields": {"thread_id": thread_id, "response": response}})
+    return jsonify({"response": response, "run_stats": run_stats})
 
-    # Retrieve and return the latest message from the assistant
-    messages = client.beta.threads.messages.list(thread_id=thread_id)
-    response = messages.data[0].content[0].text.value
+def stream_answer(question, thread_id, assistant_id, label, outcome):
+    """
+    Add the question to the thread and yield the assistant's answer as text deltas.
+    On SDKs without run streaming the run is polled and the full answer is yielded once.
+    """
+    with timed_stage("messages_create"):
+        backend.create_message(thread_id, question)
+    if backend.supports_streaming:
+        yield from stream_run_deltas(thread_id, assistant_id, label, outcome)
+    else:
+        outcome["status"], outcome["stats"] = run_assistant(thread_id, assistant_id, label)
+        if outcome["status"] == "completed":
+            yield latest_assistant_message(thread_id)
+
+
+@rate_limit_logger
+def chat_stream(question, thread_id, outcome):
+    wait_for_token(credential_pool.bucket("gpt3", thread_id))
+    free_assistant_id = assistant_registry.get("free", credential_pool.key_of(thread_id))
+    log.debug("Using assistant", extra={"fields": {"assistant_id": free_assistant_id}})
+    return stream_answer(question, thread_id, free_assistant_id, "FREE", outcome)
+
+
+@rate_limit_logger
+def chat_premium_stream(question, thread_id, outcome):
+    wait_for_token(credential_pool.bucket("gpt4", thread_id))
+    premium_assistant_id = assistant_registry.get("premium", credential_pool.key_of(thread_id))
+    log.debug("Using assistant", extra={"fields": {"assistant_id": premium_assistant_id}})
+    return stream_answer(question, thread_id, premium_assistant_id, "PREMIUM", outcome)
 
-    print(f"Assistant response: {response}")
-    return jsonify({"response": response})
 
 def start_rephrase_conversation():
-    thread_id = client.beta.threads.create()
-    return thread_id.id
+    with timed_stage("threads_create"):
+        return backend.create_thread()
 
 # Function to parse and extract related question
 def extract_related_question(line):
@@ -668,114 +3020,459 @@ def extract_related_question(line):
     return None  # Return None if the expected format is not found
 
 
-@sleep_and_retry
 @rate_limit_logger
-@limits(calls=GPT3_RATE_LIMIT_REQUESTS, period=GPT3_RATE_LIMIT_PERIOD)
 def rephrase_chat(question, user_type):
     thread_id=start_rephrase_conversation()
     user_input = question
 
     if not thread_id:
-        print("Error: Missing thread_id")
+        log.warning("Missing thread_id")
         return jsonify({"error": "Missing thread_id"}), 400
 
     #print(f"Received message: {user_input} for thread ID: {thread_id} and User-Type {user_type}" )
 
-    # Initialize the run variable
-    run = None
-    while True:
-        try:
-            # Run the Assistant
-            if user_type == "free":
-                print(f"Rephrase Assistant ID: {rephrase_assistant_id}")
-                # Add the user's message to the thread
-                client.beta.threads.messages.create(
-                    thread_id=thread_id, role="user", content=user_input
-                )
-                run = client.beta.threads.runs.create(
-                    thread_id=thread_id, assistant_id=rephrase_assistant_id
-                )
-            elif user_type == "premium":
-                print(f"Rephrase Assistant ID: {rephrase_assistant_id}")
-                # Add the user's message to the thread
-                client.beta.threads.messages.create(
-                    thread_id=thread_id, role="user", content=user_input
-                )
-                run = client.beta.threads.runs.create(
-                    thread_id=thread_id, assistant_id=rephrase_assistant_id
-                )
-            else:
-                # Handle the case where user_type is neither "Premium" nor "Free"
-                print("Error: Invalid user_type")
-                return jsonify({"response": "Invalid user_type"}), 400
-            
-        except Exception as e:
-                print(f"An error occurred: {e}")
-                break  # Exit the loop in case of an error
-        
-                
+    if user_type not in ("free", "premium"):
+        # Handle the case where user_type is neither "Premium" nor "Free"
+        log.warning("Invalid user_type", extra={"fields": {"user_type": user_type}})
+        return jsonify({"response": "Invalid user_type"}), 400
+
+    # The new thread went to the least-loaded key; its budget pays for the run
+    wait_for_token(credential_pool.bucket("gpt3", thread_id))
+    rephrase_assistant_id = assistant_registry.get("rephrase", credential_pool.key_of(thread_id))
+    log.debug("Using assistant", extra={"fields": {"assistant_id": rephrase_assistant_id}})
+    # Add the user's message to the thread and run the Assistant
+    with timed_stage("messages_create"):
+        backend.create_message(thread_id, user_input)
+    status, run_stats = run_assistant(thread_id, rephrase_assistant_id, "REPHRASE")
+    if status != "completed":
+        return jsonify({"result": "failed", "run_stats": run_stats})
 
-    # Check if the Run requires action (function call)
-    while True:
-        try:
-            #return jsonify({"result": "failed"})
-            run_status = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
-            print(f"Thread ID {thread_id} REPHRASE Run status: {run_status.status}")
-            if run_status.status == "completed":
-                print(f"Thread ID {thread_id} REPHRASE Run COMPLETED")
-                # Retrieve and return the latest message from the assistant
-                messages = client.beta.threads.messages.list(thread_id=thread_id)
-                response = messages.data[0].content[0].text.value
-                # Split the response into lines and filter out empty lines
-                lines = [line for line in response.strip().split('\n') if line]
-
-                # Initialize variables
-                related_question_premium1 = None
-                related_question_premium2 = None
-                related_question_premium3 = None
-
-                # Extract and save each related question as a variable, if available
-                if len(lines) > 0:
-                    related_question_premium1 = extract_related_question(lines[0])
-                if len(lines) > 1:
-                    related_question_premium2 = extract_related_question(lines[1])
-                if len(lines) > 2:
-                    related_question_premium3 = extract_related_question(lines[2])
-
-                # Print the variables to verify, handling None values
-                print(related_question_premium1 or "Related Question 1 not found")
-                print(related_question_premium2 or "Related Question 2 not found")
-                print(related_question_premium3 or "Related Question 3 not found")
-                return jsonify({"result": "success", "related_question_premium1": related_question_premium1, "related_question_premium2": related_question_premium2, "related_question_premium3": related_question_premium3})
-            elif run_status.status == "failed":
-                return jsonify({"result": "failed"})
-            else:
-                sleep(2)  # Wait for a second before checking again
-        except Exception as e:
-            print(f"An error occurred: {e}")
-            break  # Exit the loop in case of an error
+    # Retrieve and return the latest message from the assistant
+    response = latest_assistant_message(thread_id)
+    # Split the response into lines and filter out empty lines
+    lines = [line for line in response.strip().split('\n') if line]
+
+    # Initialize variables
+    related_question_premium1 = None
+    related_question_premium2 = None
+    related_question_premium3 = None
+
+    # Extract and save each related question as a variable, if available
+    if len(lines) > 0:
+        related_question_premium1 = extract_related_question(lines[0])
+    if len(lines) > 1:
+        related_question_premium2 = extract_related_question(lines[1])
+    if len(lines) > 2:
+        related_question_premium3 = extract_related_question(lines[2])
+
+    log.debug("Related questions generated", extra={"fields": {
+        "question": question,
+        "related": [related_question_premium1, related_question_premium2, related_question_premium3],
+    }})
+    return jsonify({"result": "success", "related_question_premium1": related_question_premium1, "related_question_premium2": related_question_premium2, "related_question_premium3": related_question_premium3, "run_stats": run_stats})
+
+
+# Related questions cache and background generation
+RELATED_CACHE_MAX_ENTRIES = 50000
+RELATED_CACHE_MAX_CHARS = 50_000_000
+RELATED_CACHE_TTL = 7 * 24 * 60 * 60  # In seconds
+RELATED_WORKERS = 4  # Background rephrase runs in flight at once
+# Rephrase runs fanned out next to an answer a client is waiting on; kept apart from the
+# background queue so they never wait behind jobs queued by /api/related_question_premium
+RELATED_FANOUT_WORKERS = 4
+RELATED_PRECOMPUTE_TOP = int(os.environ.get("RELATED_PRECOMPUTE_TOP", "100"))  # Default --top of the precompute-related command
+
+related_cache = AnswerCache(RELATED_CACHE_MAX_ENTRIES, RELATED_CACHE_MAX_CHARS, RELATED_CACHE_TTL)
+related_executor = ThreadPoolExecutor(max_workers=RELATED_WORKERS, thread_name_prefix="related")
+related_fanout_executor = ThreadPoolExecutor(max_workers=RELATED_FANOUT_WORKERS, thread_name_prefix="related-fanout")
+related_pending = {}  # Normalized question -> Future of the job generating it
+related_background = set()  # Normalized questions whose pending job was submitted to related_executor
+related_failed = set()  # Normalized questions whose last generation failed
+related_jobs_lock = Lock()
+
+
+def schedule_related_questions(app, question, user_type):
+    """
+    Start generating related questions in the background unless a job is already running.
+    Returns "failed" once after a failed attempt (the next call retries), "pending" otherwise.
+    """
+    key = normalize_question(question)
+    with related_jobs_lock:
+        if key in related_failed:
+            related_failed.discard(key)
+            return "failed"
+        if key not in related_pending:
+            related_pending[key] = related_executor.submit(generate_related_questions, app, question, user_type)
+            related_background.add(key)
+    return "pending"
+
+
+def start_related_questions(app, question, user_type):
+    """
+    Return a Future that is done once related questions for question are in related_cache or
+    have failed, joining a job already running for it. Done straight away on a cache hit.
+    The job runs on the fan-out executor; a background job for the same question that has
+    not started yet is moved there.
+    """
+    if related_cache.get(assistant_registry.get("rephrase"), question) is not None:
+        future = Future()
+        future.set_result(None)
+        return future
+    key = normalize_question(question)
+    with related_jobs_lock:
+        related_failed.discard(key)  # This caller waits for the new attempt instead
+        if key in related_background and related_pending[key].cancel():
+            del related_pending[key]
+        if key not in related_pending:
+            related_pending[key] = related_fanout_executor.submit(generate_related_questions, app, question, user_type)
+            related_background.discard(key)
+        return related_pending[key]
+
+
+def related_questions_result(future, question, timeout):
+    """
+    Wait up to timeout seconds for a job from start_related_questions and return its result in
+    the shape of /api/related_question_premium, with "result" success, failed or pending.
+    """
+    try:
+        future.result(timeout=timeout)
+    except FutureTimeoutError:
+        return {"result": "pending"}
+    cached = related_cache.get(assistant_registry.get("rephrase"), question)
+    if cached is None:
+        with related_jobs_lock:
+            related_failed.discard(normalize_question(question))  # Already reported to this caller
+        return {"result": "failed"}
+    related_question1, related_question2, related_question3 = json.loads(cached)
+    return {"result": "success", "related_question1": related_question1,
+            "related_question2": related_question2, "related_question3": related_question3}
+
+
+def generate_related_questions(app, question, user_type):
+    succeeded = False
+    try:
+        with app.app_context(), openai_slot(user_type=user_type):
+            result = rephrase_chat(question, user_type)
+        answer_data = {"result": "failed"} if isinstance(result, tuple) else result.get_json()
+        if answer_data["result"] == "success":
+            related_cache.put(assistant_registry.get("rephrase"), question, json.dumps([
+                answer_data["related_question_premium1"],
+                answer_data["related_question_premium2"],
+                answer_data["related_question_premium3"],
+            ]))
+            succeeded = True
+    except Exception as e:
+        log.warning("Related questions failed", extra={"fields": {"question": question, "error": str(e)}})
 
+    key = normalize_question(question)
+    with related_jobs_lock:
+        related_pending.pop(key, None)
+        related_background.discard(key)
+        if not succeeded:
+            related_failed.add(key)
 
 
+def precompute_related_questions(app, limit=RELATED_PRECOMPUTE_TOP):
+    """
+    Generate related questions for the limit most frequently asked questions in FeedbackData
+    and store them in RelatedQuestionsData, where every worker loads them at startup. Questions
+    stored within RELATED_CACHE_TTL are skipped. Blocks until the jobs are done and returns
+    (stored, failed).
+    """
+    warm_related_cache(app)
+    rephrase_assistant_id = assistant_registry.get("rephrase")
+    with app.app_context():
+        count = db.func.count(FeedbackData.id)
+        common = (db.session.query(FeedbackData.question, count)
+                  .group_by(db.func.lower(FeedbackData.question))
+                  .order_by(count.desc()).limit(limit).all())
+    questions = [question for question, _ in common if related_cache.get(rephrase_assistant_id, question) is None]
+    # Queued as free traffic, so a run against a live deployment's keys never delays premium requests
+    jobs = [related_executor.submit(generate_related_questions, app, question, "free") for question in questions]
+    for job in jobs:
+        job.result()
+    stored = failed = 0
+    with app.app_context():
+        for question in questions:
+            related = related_cache.get(rephrase_assistant_id, question)
+            if related is None:
+                failed += 1
+                continue
+            key = normalize_question(question)
+            RelatedQuestionsData.query.filter_by(assistant_id=rephrase_assistant_id, question=key).delete()
+            db.session.add(RelatedQuestionsData(assistant_id=rephrase_assistant_id, question=key, related=related))
+            stored += 1
+        db.session.commit()
+    log.info("Precomputed related questions", extra={"fields": {
+        "questions": len(common), "stored": stored, "failed": failed}})
+    return stored, failed
+
 
+def warm_related_cache(app):
+    """
+    Seed related_cache with the related questions stored by precompute_related_questions for
+    the current rephrase assistant within RELATED_CACHE_TTL.
+    """
+    rephrase_assistant_id = assistant_registry.get("rephrase")
+    cutoff = datetime.utcnow() - timedelta(seconds=RELATED_CACHE_TTL)
+    with app.app_context():
+        rows = (RelatedQuestionsData.query
+                .filter(RelatedQuestionsData.assistant_id == rephrase_assistant_id,
+                        RelatedQuestionsData.timestamp >= cutoff)
+                .order_by(RelatedQuestionsData.timestamp.desc()).limit(RELATED_CACHE_MAX_ENTRIES).all())
+    # Insert oldest first so the newest entries end up most recently used
+    for row in reversed(rows):
+        related_cache.put(rephrase_assistant_id, row.question, row.related)
+    log.info("Related questions cache warmed", extra={"fields": {"questions": len(rows)}})
+
+
+@bp.cli.command("precompute-related")
+@click.option("--top", type=int, default=RELATED_PRECOMPUTE_TOP, show_default=True,
+              help="Number of most frequently asked questions to cover")
+def precompute_related_command(top):
+    """
+    Generate and store related questions for the most frequently asked questions.
+    """
+    global backend
+    if backend is None:  # The app was created with DEFER_PROCESS_INIT
+        credential_pool.connect(create_backend)
+        backend = credential_pool
+    stored, failed = precompute_related_questions(current_app._get_current_object(), top)
+    click.echo(f"Stored related questions for {stored} questions ({failed} failed)")
 
 
 # Endpoint for submitting feedback
-@app.route("/submit_feedback", methods=["POST"])
+@bp.route("/submit_feedback", methods=["POST"])
 def submit_feedback():
     data = request.json
     feedback_id = data["record_id"]
     feedback = data["feedback"]
 
-    feedback_data = FeedbackData.query.get(feedback_id)
+    # The row may still be waiting in the write-behind queue
+    feedback_data = feedback_writer.get_pending(feedback_id)
+    if feedback_data is None:
+        row = FeedbackData.query.get(feedback_id)
+        if row:
+            feedback_data = {"id": row.id, "question": row.question, "answer": row.answer,
+                             "user_type": row.user_type, "feedback": row.feedback}
     if feedback_data:
-        feedback_data.feedback = feedback
-        db.session.commit()
+        # Welcome messages only change when a row gains or loses a Like
+        liked_changed = (feedback_data["feedback"] == "Like") != (feedback == "Like")
+        feedback_writer.set_feedback(feedback_data["id"], feedback,
+                                     on_commit=welcome_cache.invalidate if liked_changed else None)
+        # Keep the FAQ index in step with the liked free-tier answers
+        if feedback_data["user_type"] == "free":
+            if feedback == "Like":
+                faq_index.add(feedback_data["id"], feedback_data["question"], feedback_data["answer"])
+            else:
+                faq_index.remove(feedback_data["id"])
         return jsonify({"message": "Feedback updated successfully"})
     else:
         return jsonify({"message": "Feedback not found"}), 404
 
 
-setup_database(app)
+# Export of FeedbackData for analytics. Rows are read in keyset-paginated pages on
+# (timestamp, id), each page in its own short read transaction, so memory use does not grow
+# with the table and a long export never holds a snapshot open against the writers.
+EXPORT_PAGE_SIZE = 1000
+EXPORT_COLUMNS = ("id", "timestamp", "username", "user_type", "thread_type", "thread_id", "feedback", "question", "answer")
+EXPORT_FILTERS = ("feedback", "user_type", "thread_type")
+EXPORT_MIMETYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+# Shared secret for /api/export/feedback, sent as X-Export-Token; the endpoint is off when unset
+EXPORT_TOKEN = os.environ.get("EXPORT_TOKEN")
+
+
+def parse_export_args(args):
+    """
+    Read format, column filters and the since/until date range (ISO dates, until exclusive)
+    from a mapping of query arguments or CLI options. Raises ValueError on bad input.
+    """
+    fmt = args.get("format") or "ndjson"
+    if fmt not in EXPORT_MIMETYPES:
+        raise ValueError(f"format must be one of {', '.join(EXPORT_MIMETYPES)}")
+    filters = {name: args[name] for name in EXPORT_FILTERS if args.get(name)}
+    since = datetime.fromisoformat(args["since"]) if args.get("since") else None
+    until = datetime.fromisoformat(args["until"]) if args.get("until") else None
+    return fmt, filters, since, until
+
+
+def iter_feedback_pages(filters, since=None, until=None, page_size=EXPORT_PAGE_SIZE):
+    """
+    Yield FeedbackData rows as lists of dicts, page_size rows at a time, in (timestamp, id)
+    order. Each page continues after the last row of the previous one instead of using OFFSET.
+    """
+    table = FeedbackData.__table__
+    query = select(*[table.c[name] for name in EXPORT_COLUMNS]).order_by(table.c.timestamp, table.c.id).limit(page_size)
+    for name, value in filters.items():
+        query = query.where(table.c[name] == value)
+    if since:
+        query = query.where(table.c.timestamp >= since)
+    if until:
+        query = query.where(table.c.timestamp < until)
+    last = None
+    while True:
+        page_query = query if last is None else query.where(tuple_(table.c.timestamp, table.c.id) > last)
+        with db.engine.connect() as conn:
+            rows = [dict(row._mapping) for row in conn.execute(page_query)]
+        if rows:
+            yield rows
+        if len(rows) < page_size:
+            return
+        last = (rows[-1]["timestamp"], rows[-1]["id"])
+
+
+def encode_ndjson(pages):
+    for rows in pages:
+        yield "".join(json.dumps(row, default=str) + "\n" for row in rows)
+
+
+def encode_csv(pages):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS)
+    writer.writeheader()
+    for rows in pages:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+EXPORT_ENCODERS = {"ndjson": encode_ndjson, "csv": encode_csv}
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 writes a gzip header
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+@bp.route("/api/export/feedback", methods=["GET"])
+def export_feedback():
+    if not EXPORT_TOKEN or not hmac.compare_digest(request.headers.get("X-Export-Token", ""), EXPORT_TOKEN):
+        return jsonify({"error": "Not found"}), 404
+    try:
+        fmt, filters, since, until = parse_export_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    chunks = EXPORT_ENCODERS[fmt](iter_feedback_pages(filters, since, until))
+    headers = {"Content-Disposition": f"attachment; filename=feedback.{fmt}", "Vary": "Accept-Encoding"}
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        chunks = gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
+    else:
+        chunks = (chunk.encode() for chunk in chunks)
+    return Response(stream_with_context(chunks), mimetype=EXPORT_MIMETYPES[fmt], headers=headers)
+
+
+@bp.cli.command("export-feedback")
+@click.option("--format", "fmt", type=click.Choice(list(EXPORT_MIMETYPES)), default="ndjson")
+@click.option("--feedback")
+@click.option("--user-type")
+@click.option("--thread-type")
+@click.option("--since", help="ISO date or datetime, inclusive")
+@click.option("--until", help="ISO date or datetime, exclusive")
+@click.option("--gzip", "compress", is_flag=True, help="gzip the output")
+@click.option("--output", type=click.File("wb"), default="-")
+def export_feedback_command(fmt, feedback, user_type, thread_type, since, until, compress, output):
+    """
+    Stream FeedbackData rows to a file or stdout.
+    """
+    try:
+        fmt, filters, since, until = parse_export_args({
+            "format": fmt, "feedback": feedback, "user_type": user_type,
+            "thread_type": thread_type, "since": since, "until": until,
+        })
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    chunks = EXPORT_ENCODERS[fmt](iter_feedback_pages(filters, since, until))
+    for chunk in gzip_chunks(chunks) if compress else (chunk.encode() for chunk in chunks):
+        output.write(chunk)
+
+
+# Prometheus scrape endpoint; histograms cover this worker process only
+@bp.route("/metrics", methods=["GET"])
+def metrics():
+    flights = answer_flights.stats()
+    lines = [
+        "# HELP webserver_answer_flights_total Free questions answered by their own run (leader) or by sharing one in flight (follower).",
+        "# TYPE webserver_answer_flights_total counter",
+        f'webserver_answer_flights_total{{role="leader"}} {flights["leaders"]}',
+        f'webserver_answer_flights_total{{role="follower"}} {flights["followers"]}',
+    ]
+    return Response(latency_histograms.render() + "\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
+# Capacity and cache counters for sizing the deployment
+@bp.route("/api/stats", methods=["GET"])
+def get_stats():
+    with run_wait_stats_lock:
+        runs = dict(run_wait_stats, by_status=dict(run_wait_stats["by_status"]))
+    return jsonify({
+        "scheduler": scheduler.stats(),
+        "runs": runs,
+        "answer_cache": answer_cache.stats(),
+        "answer_flights": answer_flights.stats(),
+        "related_cache": related_cache.stats(),
+        "thread_pool": thread_pool.stats(),
+        "feedback_writer": feedback_writer.stats(),
+        "backend": backend.stats(),
+    })
+
+
+def create_app(config=None):
+    """
+    Build the Flask application. Schema setup and the FAQ index build run here; per-process
+    resources (LLM backend, database connections, background threads) are started by
+    init_process, right away unless DEFER_PROCESS_INIT is set, in which case a post-fork hook
+    must call it in each worker.
+    """
+    app = Flask(__name__)
+    app.config.update(DEFAULT_CONFIG)
+    app.config.update(config or {})
+    if not is_memory_database(app.config["SQLALCHEMY_DATABASE_URI"]):
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = dict(SQLITE_FILE_POOL_OPTIONS, **app.config["SQLALCHEMY_ENGINE_OPTIONS"])
+    # Session tokens are signed with the app secret; set SECRET_KEY so tokens survive restarts
+    # and are accepted by every worker
+    app.secret_key = app.config.get("SECRET_KEY") or os.environ.get("SECRET_KEY") or os.urandom(32).hex()
+    if not (app.config.get("SECRET_KEY") or os.environ.get("SECRET_KEY")):
+        log.warning("SECRET_KEY is not set, session tokens will only be valid in this process.")
+    db.init_app(app)
+    app.register_blueprint(bp)
+
+    setup_database(app)
+    build_faq_index(app)  # Before any fork, so workers share the index
+    if not app.config["DEFER_PROCESS_INIT"]:
+        init_process(app)
+    return app
+
+
+def init_process(app):
+    """
+    Create the resources that must not be shared across a fork and start background work.
+    Call after forking; calling it again in the same process leaves the logging listener and
+    feedback writer with one thread each.
+    """
+    global backend
+    start_logging()
+    credential_pool.connect(create_backend)
+    backend = credential_pool
+    # Drop any pooled SQLite connections inherited from the parent process. An in-memory
+    # database lives in its one connection, so it is kept.
+    if not is_memory_database(app.config["SQLALCHEMY_DATABASE_URI"]):
+        with app.app_context():
+            db.engine.dispose(close=False)
+    feedback_writer.start(app)
+    atexit.unregister(feedback_writer.stop)  # Registered once however often this runs
+    atexit.register(feedback_writer.stop)  # Flush queued feedback rows on shutdown
+    warm_answer_cache(app)
+    warm_related_cache(app)
+    thread_pool.refill()
+
+
 if __name__ == "__main__":
-    app.run(host='0.0.0.0',port=8080, debug=True)
+    # Development server; see gunicorn.conf.py for the production entry point
+    create_app().run(host='0.0.0.0',port=8080, debug=True)